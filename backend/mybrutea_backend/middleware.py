@@ -1,10 +1,377 @@
+import cProfile
+import functools
+import gzip
+import hashlib
+import hmac
+import io
+import pstats
+import re
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.signals import setting_changed
+from django.db import OperationalError, connections
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.cache import patch_vary_headers
+from social_django.middleware import SocialAuthExceptionMiddleware
+
+from shop import metrics, replicas
+from shop.cache import catalog_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
 class CorsMiddleware:
+    """Cross-origin access for the frontend, configured by the CORS_* settings.
+
+    Preflights (OPTIONS with Access-Control-Request-Method) are answered here,
+    before sessions, authentication or CSRF run, with Access-Control-Max-Age
+    so browsers reuse them. They never reach URL resolution, so they are
+    marked ``request.cors_preflight`` for MetricsMiddleware to label. Header values and the origin regexes are compiled
+    once; ``cors_policy.cache_clear()`` runs when a CORS_* setting changes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        origin = request.META.get('HTTP_ORIGIN')
+        policy = cors_policy()
+        if (request.method == 'OPTIONS' and origin
+                and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in request.META):
+            request.cors_preflight = True
+            response = HttpResponse(status=200)
+            response['Content-Length'] = '0'
+            if policy.allows(origin):
+                self._allow(response, origin, policy, policy.preflight_headers)
+            return response
+
+        response = self.get_response(request)
+        if origin and policy.allows(origin):
+            self._allow(response, origin, policy)
+        return response
+
+    @staticmethod
+    def _allow(response, origin, policy, extra=None):
+        response['Access-Control-Allow-Origin'] = origin if policy.credentials or not policy.allow_all else '*'
+        for name, value in (extra or {}).items():
+            response[name] = value
+        for name, value in policy.response_headers.items():
+            response[name] = value
+        patch_vary_headers(response, ('Origin',))
+
+
+class CorsPolicy:
+    def __init__(self):
+        self.allow_all = getattr(settings, 'CORS_ALLOW_ALL_ORIGINS', False)
+        self.credentials = getattr(settings, 'CORS_ALLOW_CREDENTIALS', False)
+        self.origins = frozenset(getattr(settings, 'CORS_ALLOWED_ORIGINS', ()))
+        regexes = getattr(settings, 'CORS_ALLOWED_ORIGIN_REGEXES', ())
+        self.origin_regex = re.compile('|'.join(f'(?:{r})' for r in regexes)) if regexes else None
+
+        self.response_headers = {}
+        if self.credentials:
+            self.response_headers['Access-Control-Allow-Credentials'] = 'true'
+        expose = getattr(settings, 'CORS_EXPOSE_HEADERS', ())
+        if expose:
+            self.response_headers['Access-Control-Expose-Headers'] = ', '.join(expose)
+        self.preflight_headers = {
+            'Access-Control-Allow-Headers': ', '.join(getattr(settings, 'CORS_ALLOW_HEADERS', ())),
+            'Access-Control-Allow-Methods': ', '.join(getattr(settings, 'CORS_ALLOW_METHODS', ())),
+            'Access-Control-Max-Age': str(getattr(settings, 'CORS_PREFLIGHT_MAX_AGE', 86400)),
+        }
+
+    def allows(self, origin):
+        return (self.allow_all or origin in self.origins
+                or (self.origin_regex is not None and self.origin_regex.match(origin) is not None))
+
+
+@functools.lru_cache(maxsize=None)
+def cors_policy():
+    return CorsPolicy()
+
+
+@receiver(setting_changed)
+def _reset_cors_policy(setting, **kwargs):
+    if setting.startswith('CORS_'):
+        cors_policy.cache_clear()
+
+
+REQUEST_SECONDS = metrics.histogram(
+    'http_request_duration_seconds', 'Request latency by route', ['method', 'route'])
+REQUESTS = metrics.counter(
+    'http_requests_total', 'Requests by route and status code', ['method', 'route', 'status'])
+DB_QUERIES = metrics.histogram(
+    'db_queries_per_request', 'Database queries executed per request', ['method', 'route'],
+    buckets=metrics.COUNT_BUCKETS)
+DB_SECONDS = metrics.histogram(
+    'db_query_seconds_per_request', 'Time spent in database queries per request', ['method', 'route'])
+SERIALIZER_SECONDS = metrics.histogram(
+    'serializer_seconds_per_request', 'Time spent in DRF serializers per request', ['method', 'route'])
+DB_LOCK_ERRORS = metrics.counter(
+    'db_lock_errors_total', 'Queries that failed waiting for a database lock', ['vendor'])
+
+
+class MetricsMiddleware:
+    """Record latency, query count/time and serializer time per route.
+
+    Sending ``X-Profile: <METRICS_TOKEN>`` runs that single request under
+    cProfile and returns the profile as text instead of the normal response.
+    """
+    profile_lock = threading.Lock()
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        metrics.instrument_serializers()
+
+    def __call__(self, request):
+        stats = {'queries': 0, 'db_time': 0.0, 'serializer_time': 0.0, 'serializing': False}
+        token = metrics.request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for conn in connections.all():
+                    stack.enter_context(conn.execute_wrapper(self._track_query(stats)))
+                if self._profiling_requested(request) and self.profile_lock.acquire(blocking=False):
+                    try:
+                        response = self._profile(request, stats)
+                    finally:
+                        self.profile_lock.release()
+                else:
+                    response = self.get_response(request)
+        finally:
+            metrics.request_stats.reset(token)
+
+        elapsed = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        if match:
+            route = match.route
+        else:
+            # Keep CORS preflights apart from 404 probes
+            route = 'preflight' if getattr(request, 'cors_preflight', False) else 'unmatched'
+        labels = {'method': request.method, 'route': route}
+        REQUEST_SECONDS.observe(elapsed, **labels)
+        REQUESTS.inc(status=response.status_code, **labels)
+        DB_QUERIES.observe(stats['queries'], **labels)
+        DB_SECONDS.observe(stats['db_time'], **labels)
+        SERIALIZER_SECONDS.observe(stats['serializer_time'], **labels)
+        return response
+
+    @staticmethod
+    def _track_query(stats):
+        def wrapper(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            except OperationalError as e:
+                if 'lock' in str(e).lower():
+                    DB_LOCK_ERRORS.inc(vendor=context['connection'].vendor)
+                raise
+            finally:
+                stats['queries'] += 1
+                stats['db_time'] += time.perf_counter() - start
+        return wrapper
+
+    @staticmethod
+    def _profiling_requested(request):
+        header = request.META.get('HTTP_X_PROFILE')
+        token = getattr(settings, 'METRICS_TOKEN', '')
+        return bool(header and token and hmac.compare_digest(header, token))
+
+    def _profile(self, request, stats):
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+        if hasattr(response, 'render') and not response.is_rendered:
+            profiler.runcall(response.render)
+
+        out = io.StringIO()
+        out.write(f'{request.method} {request.path} -> {response.status_code}\n')
+        out.write(f"{stats['queries']} queries, {stats['db_time'] * 1000:.1f} ms in database, "
+                  f"{stats['serializer_time'] * 1000:.1f} ms in serializers\n\n")
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        return HttpResponse(out.getvalue(), content_type='text/plain', status=response.status_code)
+
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/xml', 'text/', 'image/svg+xml')
+
+# (brotli quality, gzip level): fast for per-request bodies, maximal for bodies compressed once and cached
+DYNAMIC_LEVELS = (5, 6)
+CACHED_LEVELS = (11, 9)
+
+
+def accepted_encoding(header, offered=None):
+    """Pick br or gzip from an Accept-Encoding header, honouring q-values; None if neither.
+
+    ``offered`` narrows the choice, in order of preference (e.g. the
+    precompressed files that exist); by default br if brotli is installed,
+    then gzip.
+    """
+    weights = {}
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            weights[name.strip().lower()] = q
+    if offered is None:
+        offered = (['br'] if brotli is not None else []) + ['gzip']
+    if not offered:
+        return None
+    ranked = [(weights.get(name, weights.get('*', 0.0)), -i, name) for i, name in enumerate(offered)]
+    q, _, name = max(ranked)
+    return name if q > 0 else None
+
+
+def compress(content, encoding, levels=DYNAMIC_LEVELS):
+    if encoding == 'br':
+        return brotli.compress(content, quality=levels[0])
+    return gzip.compress(content, compresslevel=levels[1], mtime=0)
+
+
+class CompressionMiddleware:
+    """Brotli/gzip-compress API responses for clients that accept it.
+
+    Only bodies of at least COMPRESSION_MIN_BYTES with a text or JSON content
+    type under COMPRESSION_PATH_PREFIXES are compressed; streaming responses
+    and already-encoded or binary bodies pass through. Responses marked
+    ``cache_compressed`` (cached catalog lists) are compressed once at the
+    highest level and the bytes reused from the catalog cache until it is
+    bumped.
+    """
+
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
         response = self.get_response(request)
-        response["Access-Control-Allow-Origin"] = "*"
-        response["Access-Control-Allow-Methods"] = "GET, POST, PUT, PATCH, DELETE, OPTIONS"
-        response["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-        return response
\ No newline at end of file
+        if not request.path.startswith(tuple(getattr(settings, 'COMPRESSION_PATH_PREFIXES', ('/api/',)))):
+            return response
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if not response.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES):
+            return response
+        content = response.content
+        if len(content) < getattr(settings, 'COMPRESSION_MIN_BYTES', 1024):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if getattr(response, 'cache_compressed', False):
+            key = f'compressed:{encoding}:{hashlib.sha256(content).hexdigest()}'
+            body = catalog_cache.get_or_set(key, lambda: compress(content, encoding, CACHED_LEVELS))
+        else:
+            body = compress(content, encoding)
+        if len(body) >= len(content):
+            return response
+
+        response.content = body
+        response['Content-Length'] = str(len(body))
+        response['Content-Encoding'] = encoding
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            # The bytes differ from the identity encoding, so a strong validator no longer holds
+            response['ETag'] = 'W/' + etag
+        return response
+
+
+def header_authenticated_api(request):
+    """An API request that carries its credentials in the Authorization header"""
+    return ('HTTP_AUTHORIZATION' in request.META
+            and request.path.startswith(tuple(getattr(settings, 'SESSIONLESS_PATH_PREFIXES', ('/api/',)))))
+
+
+class HeaderAuthBypassMixin:
+    """Step aside for header-authenticated API requests.
+
+    Token and JWT clients never use the session, the CSRF cookie or flash
+    messages; DRF authenticates them from the header and sets request.user.
+    Browser flows (admin, social auth, anonymous API calls) keep the full
+    middleware. Subclassing the Django classes keeps the admin's system
+    checks satisfied. The handler calls process_view and process_exception
+    directly, so those step aside too.
+    """
+
+    def __call__(self, request):
+        if header_authenticated_api(request):
+            self.bypassed(request)
+            return self.get_response(request)
+        return super().__call__(request)
+
+    def bypassed(self, request):
+        """Hook for what the skipped middleware must still provide"""
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        parent = getattr(super(), 'process_view', None)
+        if parent is None or header_authenticated_api(request):
+            return None
+        return parent(request, view_func, view_args, view_kwargs)
+
+    def process_exception(self, request, exception):
+        parent = getattr(super(), 'process_exception', None)
+        if parent is None or header_authenticated_api(request):
+            return None
+        return parent(request, exception)
+
+
+class ApiSessionMiddleware(HeaderAuthBypassMixin, SessionMiddleware):
+    pass
+
+
+class ApiCsrfViewMiddleware(HeaderAuthBypassMixin, CsrfViewMiddleware):
+    pass
+
+
+class ApiAuthenticationMiddleware(HeaderAuthBypassMixin, AuthenticationMiddleware):
+    def bypassed(self, request):
+        # Plain Django views still read request.user; DRF replaces it after authenticating
+        request.user = AnonymousUser()
+
+
+class ApiMessageMiddleware(HeaderAuthBypassMixin, MessageMiddleware):
+    pass
+
+
+class ApiSocialAuthExceptionMiddleware(HeaderAuthBypassMixin, SocialAuthExceptionMiddleware):
+    pass
+
+
+class ReplicaRoutingMiddleware:
+    """Clear the request's read routing afterwards, and pin users who wrote to the primary.
+
+    DRF stores the authenticated user on the Django request, so it is
+    available here once the view has run (see shop/replicas.py).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            replicas.reset()
+        if request.method not in replicas.SAFE_METHODS and response.status_code < 400 and replicas.aliases():
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                replicas.pin(user.pk)
+        return response
@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/stable/ref/settings/
 """
 
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -42,13 +42,12 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework.authtoken',
     'djoser',
-    'corsheaders',
     'social_django',
     'paystack',
 ]
 
 
-# CORS settings
+# CORS settings (mybrutea_backend.middleware.CorsMiddleware)
 CORS_ALLOW_ALL_ORIGINS = False
 CORS_ALLOWED_ORIGIN_REGEXES = [
     r"^http://localhost:\d+$",
@@ -73,6 +72,7 @@ CORS_ALLOW_HEADERS = [
     "user-agent",
     "x-csrftoken",
     "x-requested-with",
+    "idempotency-key",
 ]
 CORS_ALLOW_METHODS = [
     "DELETE",
@@ -83,20 +83,34 @@ CORS_ALLOW_METHODS = [
     "PUT",
 ]
 CORS_ALLOW_CREDENTIALS = True
+# Seconds browsers may reuse a preflight answer
+CORS_PREFLIGHT_MAX_AGE = 86400
 
 MIDDLEWARE = [
-    'corsheaders.middleware.CorsMiddleware',
+    'mybrutea_backend.middleware.MetricsMiddleware',
+    'mybrutea_backend.middleware.CorsMiddleware',
+    'mybrutea_backend.middleware.CompressionMiddleware',
+    'mybrutea_backend.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    # Api* variants skip themselves for header-authenticated /api/ requests
+    'mybrutea_backend.middleware.ApiSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    'mybrutea_backend.middleware.ApiCsrfViewMiddleware',
+    'mybrutea_backend.middleware.ApiAuthenticationMiddleware',
+    'mybrutea_backend.middleware.ApiMessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'social_django.middleware.SocialAuthExceptionMiddleware',
+    'mybrutea_backend.middleware.ApiSocialAuthExceptionMiddleware',
 ]
 
+# Requests under these prefixes with an Authorization header bypass sessions,
+# CSRF, messages and social-auth error handling (see ApiSessionMiddleware)
+SESSIONLESS_PATH_PREFIXES = ('/api/',)
+
+# Sessions only serve browser flows (admin, social auth): keep them in the cache,
+# written through to the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 ROOT_URLCONF = 'mybrutea_backend.urls'
 
 TEMPLATES = [
@@ -126,10 +140,53 @@ WSGI_APPLICATION = 'mybrutea_backend.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': config('SQLITE_PATH', default=str(BASE_DIR / 'db.sqlite3')),
     }
 }
 
+# Read replicas of 'default' (see shop/replicas.py). REPLICA_SQLITE_PATHS is a
+# comma-separated list of replicated copies of the SQLite file; other engines
+# can be added to DATABASES by hand and listed in REPLICA_DATABASES. Catalog
+# and staff listing reads go to a replica; a user who writes reads from the
+# primary for the next REPLICA_PIN_SECONDS.
+REPLICA_DATABASES = []
+for _number, _path in enumerate(config('REPLICA_SQLITE_PATHS', default='', cast=Csv()), 1):
+    DATABASES[f'replica{_number}'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': _path}
+    REPLICA_DATABASES.append(f'replica{_number}')
+REPLICA_PIN_SECONDS = 5
+DATABASE_ROUTERS = ['shop.replicas.ReplicaRouter']
+
+# Adds the test-only 'replica' database and an in-process cache for manage.py test
+TEST_RUNNER = 'mybrutea_backend.test_runner.TestRunner'
+
+
+# Cache shared by all workers. CACHE_URL=redis://host:6379/1 selects Redis
+# (needs the redis package); otherwise entries go to files under CACHE_DIR.
+# 'counters' holds the few keys that must never be evicted (the admission
+# queue counters). The file cache culls a random third of its entries when
+# full, so those keys get a directory of their own that never fills up.
+# On Redis they carry no expiry, so a volatile-* maxmemory-policy keeps them.
+CACHE_URL = config('CACHE_URL', default='')
+CACHE_DIR = config('CACHE_DIR', default=str(BASE_DIR / '.cache'))
+
+if CACHE_URL.startswith(('redis://', 'rediss://')):
+    CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': CACHE_URL},
+        'counters': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': CACHE_URL},
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': CACHE_DIR,
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        'counters': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': str(Path(CACHE_DIR) / 'counters'),
+        },
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/stable/ref/settings/#auth-password-validators
@@ -149,6 +206,17 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# PBKDF2 iteration count. Stored hashes are updated to it on each user's next login.
+PASSWORD_HASH_ITERATIONS = config('PASSWORD_HASH_ITERATIONS', default=1_000_000, cast=int)
+
+PASSWORD_HASHERS = [
+    'shop.hashers.TunablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/stable/topics/i18n/
@@ -172,6 +240,11 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Product image thumbnails (see shop/images.py)
+THUMBNAIL_WIDTHS = (160, 320, 640)
+THUMBNAIL_FORMATS = ('webp', 'avif')
+THUMBNAIL_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/stable/ref/settings/#default-auto-field
 
@@ -184,14 +257,71 @@ CURRENCY_SYMBOL = '₦'
 # REST Framework configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # JWTs carry the claims views need, so most requests skip the user query (shop.jwt_auth)
+        'shop.jwt_auth.ClaimsJWTAuthentication',
+        # Legacy DRF tokens from before login returned JWTs
         'rest_framework.authentication.TokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
     ],
+    'DEFAULT_THROTTLE_CLASSES': [
+        'shop.throttling.TokenBucketThrottle',
+    ],
+    # Reverse proxies in front of the app. Anonymous clients are told apart by
+    # the address that many hops back in X-Forwarded-For; 0 uses REMOTE_ADDR,
+    # since clients can write anything into that header themselves.
+    'NUM_PROXIES': config('NUM_PROXIES', default=0, cast=int),
+    # Bucket capacity and refill per scope; route costs are in shop.throttling
+    'DEFAULT_THROTTLE_RATES': {
+        'anon': '120/min',
+        'user': '300/min',
+        'login': '10/min',
+        'checkout': '30/min',
+    },
+    # Fast renderers and parsers (shop.renderers); the browsable API only while DEBUG
+    'DEFAULT_RENDERER_CLASSES': [
+        'shop.renderers.ORJSONRenderer',
+        'shop.renderers.MessagePackRenderer',
+    ] + (['rest_framework.renderers.BrowsableAPIRenderer'] if DEBUG else []),
+    'DEFAULT_PARSER_CLASSES': [
+        'shop.renderers.ORJSONParser',
+        'shop.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'shop.renderers.AvailableContentNegotiation',
 }
 
+# Idempotency-Key records (shop.idempotency): lifetime, how long a duplicate
+# waits for the first attempt to finish before getting a 409, and how long an
+# attempt may hold the key before a retry takes it over (longer than any view runs)
+IDEMPOTENCY_TTL = 24 * 3600
+IDEMPOTENCY_WAIT = 10
+IDEMPOTENCY_LEASE = 120
+
+# Catalog sync feed (shop.catalog_sync) holds back changes younger than this
+# many seconds, so a transaction still committing cannot be skipped
+CATALOG_SYNC_SETTLE = 2
+
+# Brotli/gzip compression of API responses (mybrutea_backend.middleware.CompressionMiddleware)
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_PATH_PREFIXES = ('/api/',)
+
+# Load tests drive many users from one IP; set THROTTLE_ENABLED=False for them.
+# Buckets live in the default cache, so production wants CACHE_URL (Redis): a
+# full file cache culls random entries, refilling whichever buckets it drops.
+THROTTLE_ENABLED = config('THROTTLE_ENABLED', default=True, cast=bool)
+
+# Checkout waiting room (shop.admission): at most ADMISSION_RATE new shoppers
+# per second enter the checkout routes; an admission lasts ADMISSION_PASS_SECONDS
+# and the rest queue with tickets valid for ADMISSION_TICKET_MAX_AGE seconds.
+# Load tests that drive checkout hard can set ADMISSION_ENABLED=False.
+ADMISSION_ENABLED = config('ADMISSION_ENABLED', default=True, cast=bool)
+ADMISSION_RATE = config('ADMISSION_RATE', default=20, cast=int)
+ADMISSION_PASS_SECONDS = 300
+ADMISSION_TICKET_MAX_AGE = 3600
+
 # JWT Configuration
 from datetime import timedelta
 
@@ -214,8 +344,14 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
+
+    'TOKEN_OBTAIN_SERIALIZER': 'shop.jwt_auth.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'shop.jwt_auth.ClaimsTokenRefreshSerializer',
 }
 
+# Seconds each worker keeps its in-memory copy of revoked JWTs (shop.jwt_auth)
+JWT_REVOCATION_REFRESH = 30
+
 # Djoser Configuration
 DJOSER = {
     'LOGIN_FIELD': 'email',
@@ -265,9 +401,31 @@ STATIC_ROOT = BASE_DIR / 'static'
 # Use WhiteNoise to serve static files with Gunicorn
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# Hashed, precompressed frontend produced by `manage.py build_frontend`,
+# served by WhiteNoise at the site root when present
+FRONTEND_SOURCE_DIR = BASE_DIR.parent / 'frontend'
+FRONTEND_BUILD_DIR = BASE_DIR / 'frontend_build'
+if FRONTEND_BUILD_DIR.is_dir():
+    WHITENOISE_ROOT = FRONTEND_BUILD_DIR
+# Any name carrying a 12-hex content hash (Django manifest, frontend build) is immutable
+WHITENOISE_IMMUTABLE_FILE_TEST = r'\.[0-9a-f]{12}\.[^/]+$'
+
+# Cache lifetime for media files without a content hash in their name
+MEDIA_MAX_AGE = 3600
+
+# Monitoring: bearer token for /api/metrics/ and the X-Profile request header
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
 # Paystack Configuration
 PAYSTACK_SECRET_KEY = config('PAYSTACK_SECRET_KEY', default='sk_test_a6be918bcf48bb742c66a133101a8eee69032999')
 PAYSTACK_PUBLIC_KEY = config('PAYSTACK_PUBLIC_KEY', default='pk_test_8cb6f341a2e78d65c6cbf23b05f253ef0c53f1e3')
+# Point at a local stub for load tests, e.g. http://127.0.0.1:8765 (see `manage.py loadtest`)
+PAYSTACK_API_BASE = config('PAYSTACK_API_BASE', default='https://api.paystack.co')
+# manage.py reconcile_payments: verify payments pending for RECONCILE_AFTER seconds;
+# give up on ones Paystack still has no result for after RECONCILE_GIVE_UP seconds
+RECONCILE_AFTER = 15 * 60
+RECONCILE_GIVE_UP = 24 * 3600
+RECONCILE_TIMEOUT = 10
 
 
 
@@ -0,0 +1,36 @@
+"""Test runner for ``manage.py test`` (settings.TEST_RUNNER).
+
+Adds what only the test suite needs, so settings.py never has to guess
+whether it is running tests:
+
+- a second, empty database ``replica`` for the read-routing tests, which
+  enable it with ``override_settings(REPLICA_DATABASES=['replica'])``;
+- in-process caches, so test runs never read or clear the shared ones.
+"""
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+TEST_DATABASES = {
+    'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+}
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'counters': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'counters'},
+}
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        for alias, config in TEST_DATABASES.items():
+            settings.DATABASES.setdefault(alias, dict(config))
+        # The connection handler reads DATABASES once; let it see the new aliases
+        connections.__dict__.pop('settings', None)
+        self._test_caches = override_settings(CACHES=TEST_CACHES)
+        self._test_caches.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._test_caches.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,7 +1,92 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
+
+from . import stock
 from .models import PickupLocation
 
 from .models import DeliveryAddress
+from .models import Tea, Ingredient, Membership, Order, OrderItem, Subscription, Payment, PaymentIntent, StockMovement
+
+
+class EstimatedCountPaginator(Paginator):
+	"""Use the planner's row estimate instead of COUNT(*) for unfiltered lists of big tables.
+
+	Only PostgreSQL keeps an estimate; other databases, filtered lists and
+	small tables get the exact count.
+	"""
+	threshold = 100000
+
+	@cached_property
+	def count(self):
+		query = getattr(self.object_list, 'query', None)
+		if query is not None and not query.where and connection.vendor == 'postgresql':
+			with connection.cursor() as cursor:
+				cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [self.object_list.model._meta.db_table])
+				row = cursor.fetchone()
+			if row and row[0] > self.threshold:
+				return row[0]
+		return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+	paginator = EstimatedCountPaginator
+	# Skip the second COUNT(*) behind "N results (M total)" on filtered lists
+	show_full_result_count = False
+	list_per_page = 50
+
+
+class StockLedgerAdmin(admin.ModelAdmin):
+	"""Show available stock and record edits to it as ledger adjustments (see shop.stock)"""
+	readonly_fields = ('stock_shards',)
+	actions = ('shard_stock', 'unshard_stock')
+
+	def get_queryset(self, request):
+		return stock.with_available_stock(super().get_queryset(request))
+
+	def get_object(self, request, object_id, from_field=None):
+		obj = super().get_object(request, object_id, from_field)
+		if obj is not None:
+			# The form edits available stock, not the balance as of the last compaction
+			_, field = stock.PRODUCTS[type(obj)]
+			setattr(obj, field, obj.available_stock)
+		return obj
+
+	def get_form(self, request, obj=None, **kwargs):
+		form = super().get_form(request, obj, **kwargs)
+		_, field = stock.PRODUCTS[self.model]
+		if obj is not None and field in form.base_fields:
+			form.base_fields[field].label = 'Available stock'
+			form.base_fields[field].help_text = 'Includes cart reservations. A new value is recorded as an adjustment.'
+		return form
+
+	@admin.display(description='Available stock', ordering='available_stock')
+	def available(self, obj):
+		return obj.available_stock
+
+	def save_model(self, request, obj, form, change):
+		if not change:
+			return super().save_model(request, obj, form, change)
+		_, field = stock.PRODUCTS[type(obj)]
+		if field in form.changed_data:
+			# Against the stock available now: carts may have moved it since the form was loaded
+			current = stock.available(type(obj).objects.get(pk=obj.pk))
+			stock.adjust(obj, getattr(obj, field) - current, reference=f'admin:{request.user.pk}')
+		# Compaction owns the balance column and shard() the slot count; never write the form's copies back
+		skip = {field, 'stock_shards'}
+		obj.save(update_fields=[f.name for f in obj._meta.concrete_fields if not f.primary_key and f.name not in skip])
+
+	@admin.action(description=f'Shard stock over {stock.DEFAULT_SLOTS} slots (hot products)')
+	def shard_stock(self, request, queryset):
+		for product in queryset:
+			stock.shard(product, stock.DEFAULT_SLOTS)
+
+	@admin.action(description='Keep stock in a single row')
+	def unshard_stock(self, request, queryset):
+		for product in queryset.filter(stock_shards__gt=0):
+			stock.shard(product, 0)
+
 
 # Register PickupLocation in admin
 @admin.register(PickupLocation)
@@ -13,4 +98,119 @@ class PickupLocationAdmin(admin.ModelAdmin):
 @admin.register(DeliveryAddress)
 class DeliveryAddressAdmin(admin.ModelAdmin):
 	list_display = ('user', 'address_line1', 'city', 'is_default', 'created_at')
+	list_select_related = ('user',)
+	raw_id_fields = ('user',)
 	search_fields = ('user__username', 'address_line1', 'city')
+
+
+@admin.register(Ingredient)
+class IngredientAdmin(StockLedgerAdmin):
+	list_display = ('name', 'category', 'price', 'available', 'stock_shards')
+	list_select_related = ('category',)
+	list_filter = ('category',)
+	search_fields = ('name',)
+	exclude = ('image_variants',)
+
+
+@admin.register(Tea)
+class TeaAdmin(StockLedgerAdmin):
+	list_display = ('name', 'price', 'available', 'stock_shards')
+	search_fields = ('name',)
+	autocomplete_fields = ('ingredients',)
+	exclude = ('image_variants',)
+
+
+@admin.register(Membership)
+class MembershipAdmin(admin.ModelAdmin):
+	list_display = ('tier', 'name', 'price', 'includes_health_protocol')
+	search_fields = ('name', 'tier')
+
+
+class OrderItemInline(admin.TabularInline):
+	model = OrderItem
+	extra = 0
+	autocomplete_fields = ('tea', 'ingredient')
+
+	def get_queryset(self, request):
+		return super().get_queryset(request).select_related('tea', 'ingredient')
+
+
+@admin.register(Order)
+class OrderAdmin(LargeTableAdmin):
+	list_display = ('id', 'user', 'created_at', 'payment_status', 'delivery_type', 'total_price', 'backordered')
+	list_select_related = ('user',)
+	list_filter = ('payment_status', 'delivery_type', 'backordered')
+	# created_at is indexed
+	date_hierarchy = 'created_at'
+	raw_id_fields = ('user',)
+	search_fields = ('=id', '=payment_reference', 'user__email')
+	readonly_fields = ('created_at',)
+	inlines = [OrderItemInline]
+
+
+@admin.register(OrderItem)
+class OrderItemAdmin(LargeTableAdmin):
+	list_display = ('id', 'order', 'tea', 'ingredient', 'quantity', 'backordered')
+	list_select_related = ('order__user', 'tea', 'ingredient')
+	raw_id_fields = ('order',)
+	autocomplete_fields = ('tea', 'ingredient')
+	search_fields = ('=order__id',)
+
+
+class PaymentInline(admin.TabularInline):
+	model = Payment
+	extra = 0
+	readonly_fields = ('created_at', 'completed_at')
+
+
+@admin.register(Subscription)
+class SubscriptionAdmin(LargeTableAdmin):
+	list_display = ('user', 'membership', 'status', 'payment_status', 'start_date', 'renewal_date')
+	list_select_related = ('user', 'membership')
+	list_filter = ('status', 'payment_status', 'membership')
+	raw_id_fields = ('user',)
+	autocomplete_fields = ('membership',)
+	search_fields = ('user__email', '=payment_reference')
+	inlines = [PaymentInline]
+
+
+@admin.register(Payment)
+class PaymentAdmin(LargeTableAdmin):
+	list_display = ('transaction_ref', 'subscription', 'amount', 'status', 'payment_method', 'completed_at')
+	list_select_related = ('subscription__user', 'subscription__membership')
+	list_filter = ('status', 'payment_method')
+	# completed_at is indexed
+	date_hierarchy = 'completed_at'
+	raw_id_fields = ('subscription',)
+	search_fields = ('=transaction_ref', 'subscription__user__email')
+	readonly_fields = ('created_at',)
+
+
+@admin.register(PaymentIntent)
+class PaymentIntentAdmin(LargeTableAdmin):
+	list_display = ('reference', 'user', 'kind', 'amount', 'status', 'created_at', 'checked_at')
+	list_select_related = ('user',)
+	list_filter = ('status', 'kind')
+	# created_at is indexed
+	date_hierarchy = 'created_at'
+	raw_id_fields = ('user',)
+	search_fields = ('=reference', 'user__email')
+
+
+@admin.register(StockMovement)
+class StockMovementAdmin(LargeTableAdmin):
+	list_display = ('id', 'kind', 'delta', 'tea', 'ingredient', 'reference', 'created_at', 'compacted')
+	list_select_related = ('tea', 'ingredient')
+	list_filter = ('kind', 'compacted')
+	raw_id_fields = ('tea', 'ingredient')
+	search_fields = ('=reference',)
+
+	# The ledger is append-only
+	def has_add_permission(self, request):
+		return False
+
+	def has_change_permission(self, request, obj=None):
+		return False
+
+	def has_delete_permission(self, request, obj=None):
+		return False
@@ -0,0 +1,180 @@
+"""Waiting room for checkout surges.
+
+``@admission_controlled`` guards the checkout routes (add to cart, place
+order, start a payment). Each second at most ADMISSION_RATE shoppers are
+admitted. An admitted user holds a pass for ADMISSION_PASS_SECONDS that
+covers every guarded route, so one purchase is one admission. Everyone
+else joins a FIFO queue. They get a 503 with a signed ticket and a
+Retry-After header:
+
+    {"queued": true, "ticket": "...", "position": 42, "retry_after": 3}
+
+The client polls ``GET /api/checkout/queue/?ticket=...``. That view needs
+no authentication and touches only the cache. Once it answers
+``admitted: true``, the client repeats its request with the ticket in the
+``X-Queue-Ticket`` header. Newcomers are admitted directly only while
+nobody is waiting, so nobody can jump the queue.
+
+The queue is two counters: ``next`` (tickets issued) and ``serving``
+(tickets admitted). They live in the ``counters`` cache, which never evicts
+them, and ``serving`` is clamped to ``next`` should the two ever disagree.
+Everything else here is short-lived and uses the default cache. The first request or poll in each
+second moves ``serving`` forward by whatever that second's budget allows.
+A ticket is admitted once ``serving`` reaches its number. Abandoned
+tickets still use up budget as ``serving`` passes them. Counters use
+``cache.incr``, which is atomic on Redis and locmem but not on the file
+cache, which can over-admit slightly.
+"""
+import functools
+import math
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache, caches
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import metrics
+
+HEADER = 'HTTP_X_QUEUE_TICKET'
+SALT = 'shop.admission'
+NEXT_KEY = 'admission:next'
+SERVING_KEY = 'admission:serving'
+
+DECISIONS = metrics.counter('admission_decisions_total', 'Checkout admission decisions', ['decision'])
+QUEUE_LENGTH = metrics.gauge('admission_queue_length', 'Shoppers waiting for checkout admission')
+
+
+def rate():
+    return getattr(settings, 'ADMISSION_RATE', 20)
+
+
+def ticket_max_age():
+    return getattr(settings, 'ADMISSION_TICKET_MAX_AGE', 3600)
+
+
+def counters():
+    return caches['counters']
+
+
+def _counter(key, timeout=None, store=None):
+    store = store or counters()
+    store.add(key, 0, timeout)
+    return key
+
+
+def _window(second):
+    return _counter(f'admission:window:{second}', timeout=5, store=cache)
+
+
+def queue_state():
+    """(tickets issued, tickets admitted)"""
+    values = counters().get_many([NEXT_KEY, SERVING_KEY])
+    issued, serving = values.get(NEXT_KEY, 0), values.get(SERVING_KEY, 0)
+    if serving > issued:
+        # ``next`` was lost (cache flushed); restart the line at the new end
+        # instead of leaving ``serving`` ahead of every ticket issued from now on
+        counters().set(SERVING_KEY, issued, None)
+        serving = issued
+    return issued, serving
+
+
+def tick(now=None):
+    """Admit waiting tickets from this second's budget; the first call per second does the work"""
+    second = int(now if now is not None else time.time())
+    if not cache.add(f'admission:tick:{second}', True, 5):
+        return
+    issued, serving = queue_state()
+    waiting = min(issued - serving, rate())
+    if waiting > 0:
+        used = cache.incr(_window(second), waiting)
+        granted = max(0, min(waiting, rate() - (used - waiting)))
+        if granted:
+            serving = counters().incr(_counter(SERVING_KEY), granted)
+    QUEUE_LENGTH.set(max(0, issued - serving))
+
+
+def _admit_directly(now=None):
+    issued, serving = queue_state()
+    if issued > serving:
+        return False
+    second = int(now if now is not None else time.time())
+    return cache.incr(_window(second)) <= rate()
+
+
+def issue_ticket(user_id):
+    number = counters().incr(_counter(NEXT_KEY))
+    return number, signing.dumps({'n': number, 'u': user_id}, salt=SALT)
+
+
+def read_ticket(ticket):
+    """{'n': ticket number, 'u': user id}, or None if forged or older than ADMISSION_TICKET_MAX_AGE"""
+    try:
+        return signing.loads(ticket, salt=SALT, max_age=ticket_max_age())
+    except signing.BadSignature:
+        return None
+
+
+def redeem(number):
+    """True the first time an admitted ticket is used; a ticket buys one pass"""
+    return cache.add(f'admission:redeemed:{number}', True, ticket_max_age())
+
+
+def position(number):
+    """Place in line of ticket ``number``: 1 is next, 0 once admitted"""
+    return max(0, number - queue_state()[1])
+
+
+def retry_after(ahead):
+    return max(1, math.ceil(ahead / rate()))
+
+
+def _pass_key(user_id):
+    return f'admission:pass:{user_id}'
+
+
+def grant_pass(user_id):
+    cache.set(_pass_key(user_id), True, getattr(settings, 'ADMISSION_PASS_SECONDS', 300))
+
+
+def has_pass(user_id):
+    return cache.get(_pass_key(user_id), False)
+
+
+def queued_response(ticket, ahead):
+    wait = retry_after(ahead)
+    response = Response({'queued': True, 'ticket': ticket, 'position': ahead, 'retry_after': wait},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(wait)
+    return response
+
+
+def admission_controlled(view):
+    """Put below @permission_classes([IsAuthenticated]) so DRF has authenticated the user"""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not getattr(settings, 'ADMISSION_ENABLED', True):
+            return view(request, *args, **kwargs)
+        user_id = request.user.pk
+        if has_pass(user_id):
+            DECISIONS.inc(decision='pass')
+            return view(request, *args, **kwargs)
+
+        tick()
+        ticket = request.META.get(HEADER)
+        data = read_ticket(ticket) if ticket else None
+        number = data['n'] if data is not None and data['u'] == user_id else None
+        if number is not None and position(number):
+            return queued_response(ticket, position(number))
+        if number is not None and redeem(number):
+            DECISIONS.inc(decision='ticket_admitted')
+        elif _admit_directly():
+            DECISIONS.inc(decision='admitted')
+        else:
+            number, ticket = issue_ticket(user_id)
+            DECISIONS.inc(decision='queued')
+            return queued_response(ticket, position(number))
+        grant_pass(user_id)
+        return view(request, *args, **kwargs)
+    return wrapper
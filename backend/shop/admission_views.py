@@ -0,0 +1,30 @@
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, throttle_classes
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+
+from . import admission
+
+
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@throttle_classes([])
+def queue_status(request):
+    """
+    Where a checkout queue ticket stands: ?ticket=<ticket from the 503>.
+    Poll every retry_after seconds; once admitted is true, repeat the
+    checkout request with the ticket in the X-Queue-Ticket header.
+    """
+    ticket = request.query_params.get('ticket', '')
+    data = admission.read_ticket(ticket) if ticket else None
+    if data is None:
+        return Response({'error': 'ticket is missing, invalid or expired'}, status=400)
+    admission.tick()
+    ahead = admission.position(data['n'])
+    issued, serving = admission.queue_state()
+    return Response({
+        'admitted': ahead == 0,
+        'position': ahead,
+        'retry_after': admission.retry_after(ahead) if ahead else 0,
+        'queue_length': max(0, issued - serving),
+    })
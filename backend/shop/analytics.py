@@ -0,0 +1,274 @@
+"""Daily sales rollups.
+
+``DailyRollup`` holds one row per (dimension, local date, key). Rows cover
+paid orders: totals, units per tea and per ingredient, orders and revenue
+per pickup location and per delivery city. Completed membership payments
+are rolled up per membership. Dashboards read these rows, never the order
+history.
+
+Rollups are maintained incrementally. ``RollupSource`` records what each
+paid order and completed payment currently adds to them. When one changes,
+its new contribution is computed from its own rows, and the difference
+from the recorded one is added to the affected rollup rows with ``F()``
+updates. An event therefore costs the same however busy its day is, and
+applying it twice is harmless.
+
+Order, OrderItem and Payment signals mark the changed objects. Inside a
+request they are applied once in ``request_finished``, after the response
+has been sent. Elsewhere they are applied when the transaction commits.
+Each batch runs in one transaction that locks the sources it reads. A batch
+that collides with a concurrent one on a new row is retried, and a batch
+that still fails stays pending for the next flush. ``manage.py
+rebuild_analytics`` recomputes any date range from scratch.
+"""
+import logging
+import threading
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.core.signals import request_finished, request_started
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import DailyRollup, Order, OrderItem, Payment, RollupSource
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0')
+MAX_ATTEMPTS = 3
+
+
+def day_bounds(start, end):
+    """Aware datetimes covering local dates start..end inclusive"""
+    lo = timezone.make_aware(datetime.combine(start, time.min))
+    hi = timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min))
+    return lo, hi
+
+
+def _add(rows, dimension, key, label, orders=0, units=0, revenue=ZERO, fees=ZERO):
+    row = rows.setdefault((dimension, key), [label, 0, 0, ZERO, ZERO])
+    row[1] += orders
+    row[2] += units
+    row[3] += revenue or ZERO
+    row[4] += fees or ZERO
+
+
+def order_contributions(orders):
+    """
+    {order id: (local date, rows)} for the paid orders in `orders`, where rows
+    maps (dimension, key) to [label, orders, units, revenue, delivery fees]
+    """
+    paid = orders.filter(payment_status='paid').order_by()
+    result = {}
+    for pk, created_at, total, fee, delivery_type, pickup, city in paid.values_list(
+        'id', 'created_at', 'total_price', 'delivery_fee', 'delivery_type', 'pickup_location', 'delivery_city',
+    ):
+        rows = {}
+        _add(rows, 'total', '', '', orders=1, revenue=total, fees=fee)
+        if delivery_type == 'pickup':
+            _add(rows, 'pickup', pickup or '', pickup or '', orders=1, revenue=total, fees=fee)
+        elif delivery_type == 'delivery':
+            _add(rows, 'city', city or '', city or '', orders=1, revenue=total, fees=fee)
+        result[pk] = (timezone.localdate(created_at), rows)
+
+    items = OrderItem.objects.filter(order__in=paid).order_by().values_list(
+        'order_id', 'quantity', 'tea_id', 'tea__name', 'ingredient_id', 'ingredient__name',
+    )
+    for order_id, quantity, tea_id, tea_name, ingredient_id, ingredient_name in items:
+        rows = result[order_id][1]
+        rows[('total', '')][2] += quantity
+        for dimension, pk, name in (('tea', tea_id, tea_name), ('ingredient', ingredient_id, ingredient_name)):
+            if pk is not None:
+                _add(rows, dimension, str(pk), name, units=quantity)
+                rows[(dimension, str(pk))][1] = 1  # Orders containing the product, not lines
+    return result
+
+
+def payment_contributions(payments):
+    """{payment id: (local date, rows)} for the completed payments in `payments`"""
+    completed = payments.filter(status='completed', completed_at__isnull=False).order_by()
+    result = {}
+    for pk, completed_at, amount, membership_id, name in completed.values_list(
+        'id', 'completed_at', 'amount', 'subscription__membership_id', 'subscription__membership__name',
+    ):
+        rows = {}
+        _add(rows, 'membership', str(membership_id), name, orders=1, revenue=amount)
+        result[pk] = (timezone.localdate(completed_at), rows)
+    return result
+
+
+def _encode(rows):
+    return [
+        [dimension, key, label, orders, units, str(revenue), str(fees)]
+        for (dimension, key), (label, orders, units, revenue, fees) in sorted(rows.items())
+    ]
+
+
+def _decode(source):
+    rows = {}
+    for dimension, key, label, orders, units, revenue, fees in source.rows:
+        rows[(dimension, key)] = [label, orders, units, Decimal(revenue), Decimal(fees)]
+    return source.date, rows
+
+
+def _merge(totals, day, rows, sign=1):
+    for (dimension, key), (label, orders, units, revenue, fees) in rows.items():
+        row = totals.setdefault((dimension, day, key), [label, 0, 0, ZERO, ZERO])
+        row[0] = label
+        row[1] += sign * orders
+        row[2] += sign * units
+        row[3] += sign * revenue
+        row[4] += sign * fees
+
+
+def rebuild(start, end):
+    """Recompute rollup rows and sources for local dates start..end; return the number of rows written"""
+    lo, hi = day_bounds(start, end)
+    found = {
+        'order': order_contributions(Order.objects.filter(created_at__gte=lo, created_at__lt=hi)),
+        'payment': payment_contributions(Payment.objects.filter(completed_at__gte=lo, completed_at__lt=hi)),
+    }
+    totals, sources = {}, []
+    for kind, contributions in found.items():
+        for object_id, (day, rows) in contributions.items():
+            _merge(totals, day, rows)
+            sources.append(RollupSource(kind=kind, object_id=object_id, date=day, rows=_encode(rows)))
+    rows = [
+        DailyRollup(date=day, dimension=dimension, key=key, label=label,
+                    orders=orders, units=units, revenue=revenue, delivery_fees=fees)
+        for (dimension, day, key), (label, orders, units, revenue, fees) in totals.items()
+    ]
+
+    with transaction.atomic():
+        DailyRollup.objects.filter(date__gte=start, date__lte=end).delete()
+        RollupSource.objects.filter(date__gte=start, date__lte=end).delete()
+        DailyRollup.objects.bulk_create(rows, batch_size=1000)
+        RollupSource.objects.bulk_create(
+            sources, batch_size=1000,
+            update_conflicts=True, unique_fields=['kind', 'object_id'], update_fields=['date', 'rows'],
+        )
+    return len(rows)
+
+
+def _apply(deltas):
+    """Add {(dimension, date, key): [label, orders, units, revenue, delivery fees]} to DailyRollup"""
+    # Sorted so concurrent batches lock rows in the same order
+    for (dimension, day, key), (label, orders, units, revenue, fees) in sorted(deltas.items()):
+        if not (orders or units or revenue or fees):
+            continue
+        rollup = DailyRollup.objects.filter(dimension=dimension, date=day, key=key)
+        updated = rollup.update(
+            label=label, orders=F('orders') + orders, units=F('units') + units,
+            revenue=F('revenue') + revenue, delivery_fees=F('delivery_fees') + fees,
+        )
+        if not updated:
+            if orders < 0 or units < 0:
+                logger.warning('Rollup %s %s %r is missing; run manage.py rebuild_analytics', dimension, day, key)
+                continue
+            DailyRollup.objects.create(date=day, dimension=dimension, key=key, label=label,
+                                       orders=orders, units=units, revenue=revenue, delivery_fees=fees)
+        elif orders < 0 or units < 0:
+            # Nothing contributes to the row any more
+            rollup.filter(orders=0, units=0).delete()
+
+
+def _apply_changes(order_ids, payment_ids):
+    deltas = {}
+    changes = (
+        ('order', order_ids, lambda ids: order_contributions(Order.objects.filter(id__in=ids))),
+        ('payment', payment_ids, lambda ids: payment_contributions(Payment.objects.filter(id__in=ids))),
+    )
+    for kind, ids, contributions in changes:
+        if not ids:
+            continue
+        sources = RollupSource.objects.select_for_update().filter(kind=kind, object_id__in=ids)
+        recorded = {source.object_id: source for source in sources}
+        current = contributions(ids)
+        for object_id in sorted(ids):
+            source, now = recorded.get(object_id), current.get(object_id)
+            if source is not None:
+                if now is not None and (source.date, source.rows) == (now[0], _encode(now[1])):
+                    continue
+                _merge(deltas, *_decode(source), sign=-1)
+            if now is None:
+                if source is not None:
+                    source.delete()
+                continue
+            day, rows = now
+            _merge(deltas, day, rows)
+            if source is None:
+                RollupSource.objects.create(kind=kind, object_id=object_id, date=day, rows=_encode(rows))
+            else:
+                source.date, source.rows = day, _encode(rows)
+                source.save(update_fields=['date', 'rows'])
+    _apply(deltas)
+
+
+def apply_changes(order_ids=(), payment_ids=()):
+    """Bring the rollups up to date with these orders and payments"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                _apply_changes(set(order_ids), set(payment_ids))
+            return
+        except IntegrityError:
+            # A concurrent batch created a source or rollup row first; rereading sees it
+            if attempt == MAX_ATTEMPTS:
+                raise
+
+
+class _Pending(threading.local):
+    def __init__(self):
+        self.order_ids = set()
+        self.payment_ids = set()
+        self.in_request = False
+
+
+_pending = _Pending()
+
+
+def mark_order(order_id):
+    """Schedule the rollup update for an order that was saved or deleted"""
+    if order_id is not None:
+        _pending.order_ids.add(order_id)
+        _schedule()
+
+
+def mark_payment(payment_id):
+    """Schedule the rollup update for a payment that was saved or deleted"""
+    if payment_id is not None:
+        _pending.payment_ids.add(payment_id)
+        _schedule()
+
+
+def _schedule():
+    if not _pending.in_request:
+        transaction.on_commit(flush)
+
+
+def flush():
+    order_ids, payment_ids = _pending.order_ids, _pending.payment_ids
+    _pending.order_ids, _pending.payment_ids = set(), set()
+    if not order_ids and not payment_ids:
+        return
+    try:
+        apply_changes(order_ids, payment_ids)
+    except DatabaseError:
+        # Sources make a second attempt safe: keep the batch for the next flush
+        _pending.order_ids |= order_ids
+        _pending.payment_ids |= payment_ids
+        logger.exception('Analytics rollup failed for orders %s and payments %s; will retry',
+                         sorted(order_ids), sorted(payment_ids))
+
+
+@receiver(request_started)
+def _start_request(**kwargs):
+    _pending.in_request = True
+
+
+@receiver(request_finished)
+def _finish_request(**kwargs):
+    _pending.in_request = False
+    flush()
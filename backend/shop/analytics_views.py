@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .models import DailyRollup
+from .replicas import replica_reads
+
+DIMENSIONS = {choice for choice, _ in DailyRollup.DIMENSION_CHOICES} - {'total'}
+DEFAULT_DAYS = 30
+MAX_LIMIT = 200
+
+
+def _date_param(request, name, default):
+    value = request.query_params.get(name)
+    if not value:
+        return default
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+@replica_reads
+def sales_report(request, dimension):
+    """
+    Sales dashboard data from the daily rollups.
+    /analytics/daily/ returns one row per day; /analytics/<tea|ingredient|pickup|city|membership>/
+    returns the top keys over the range. Query params: start, end (YYYY-MM-DD), limit
+    """
+    if dimension != 'daily' and dimension not in DIMENSIONS:
+        return Response({'error': f"Unknown report '{dimension}'"}, status=404)
+
+    end = _date_param(request, 'end', timezone.localdate())
+    start = _date_param(request, 'start', end - timedelta(days=DEFAULT_DAYS - 1) if end else None)
+    if start is None or end is None or start > end:
+        return Response({'error': 'start and end must be dates (YYYY-MM-DD), start <= end'}, status=400)
+
+    rows = DailyRollup.objects.filter(date__gte=start, date__lte=end)
+    if dimension == 'daily':
+        data = [
+            {'date': day, 'orders': orders, 'units': units, 'revenue': str(revenue), 'delivery_fees': str(fees)}
+            for day, orders, units, revenue, fees in rows.filter(dimension='total').order_by('date').values_list(
+                'date', 'orders', 'units', 'revenue', 'delivery_fees')
+        ]
+    else:
+        try:
+            limit = min(int(request.query_params.get('limit', 20)), MAX_LIMIT)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return Response({'error': 'limit must be a positive integer'}, status=400)
+        grouped = rows.filter(dimension=dimension).values('key', 'label').annotate(
+            orders=Sum('orders'), units=Sum('units'), revenue=Sum('revenue'),
+        ).order_by('-revenue', '-units', 'key')[:limit]
+        data = [dict(row, revenue=str(row['revenue'])) for row in grouped]
+
+    return Response({'dimension': dimension, 'start': start, 'end': end, 'rows': data})
@@ -0,0 +1,102 @@
+"""Caching rules and the build step for frontend and media assets.
+
+Any file whose name carries a 12-character hex content hash
+(``main.3f2a9c0d1b7e.js``, ``rose.3f2a9c0d1b7e.160w.webp``, Django's own
+manifest names) never changes, so it is served with an immutable,
+year-long Cache-Control header (see WHITENOISE_IMMUTABLE_FILE_TEST for the
+static/frontend side). Everything else gets a short max-age.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from django.conf import settings
+from whitenoise.compress import Compressor
+
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Files under these directories of the frontend get content-hashed names
+HASHED_ASSET_DIRS = ('css', 'js', 'images')
+
+
+def is_immutable(name):
+    return bool(HASHED_NAME_RE.search(os.path.basename(name)))
+
+
+def cache_control_for(name):
+    if is_immutable(name):
+        return IMMUTABLE_CACHE_CONTROL
+    return f"public, max-age={getattr(settings, 'MEDIA_MAX_AGE', 3600)}"
+
+
+def _hashed_name(relpath, data):
+    stem, ext = os.path.splitext(relpath)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def build_frontend(source_dir, output_dir):
+    """Copy the frontend into `output_dir` with hashed asset names.
+
+    References to ``css/``, ``js/`` and ``images/`` files are rewritten in
+    every HTML/CSS/JS file, a ``manifest.json`` maps original to hashed
+    names, and gzip/brotli siblings are written for text files so WhiteNoise
+    can serve them precompressed. Returns the manifest.
+    """
+    source_dir, output_dir = str(source_dir), str(output_dir)
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+
+    files = []
+    for root, dirs, names in os.walk(source_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and os.path.join(root, d) != output_dir]
+        for name in names:
+            if not name.startswith('.') and not name.endswith('.md'):
+                files.append(os.path.relpath(os.path.join(root, name), source_dir).replace(os.sep, '/'))
+
+    # Images first so CSS that references them hashes its rewritten content
+    manifest = {}
+    for relpath in sorted(files, key=lambda p: (not p.startswith('images/'), p)):
+        if relpath.split('/', 1)[0] not in HASHED_ASSET_DIRS:
+            continue
+        with open(os.path.join(source_dir, relpath), 'rb') as fh:
+            data = fh.read()
+        if relpath.endswith(('.css', '.js')):
+            data = _rewrite(data.decode('utf-8'), manifest).encode('utf-8')
+        manifest[relpath] = _hashed_name(relpath, data)
+        _write(output_dir, manifest[relpath], data)
+
+    for relpath in files:
+        if relpath in manifest:
+            continue
+        with open(os.path.join(source_dir, relpath), 'rb') as fh:
+            data = fh.read()
+        if relpath.endswith('.html'):
+            data = _rewrite(data.decode('utf-8'), manifest).encode('utf-8')
+        _write(output_dir, relpath, data)
+
+    _write(output_dir, 'manifest.json', json.dumps(manifest, indent=2).encode('utf-8'))
+
+    compressor = Compressor(quiet=True)
+    for root, _, names in os.walk(output_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if compressor.should_compress(name):
+                list(compressor.compress(path))
+    return manifest
+
+
+def _rewrite(text, manifest):
+    if not manifest:
+        return text
+    pattern = re.compile(r'(?<=["\'(/])(%s)(?=["\')?#])' % '|'.join(re.escape(k) for k in sorted(manifest, key=len, reverse=True)))
+    return pattern.sub(lambda m: manifest[m.group(1)], text)
+
+
+def _write(output_dir, relpath, data):
+    path = os.path.join(output_dir, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(data)
@@ -0,0 +1,71 @@
+"""Email login helpers.
+
+Users log in with their email address, so auth_user gets a unique index on
+LOWER(email) (blank emails excluded). The index is created after migrate
+because auth_user belongs to django.contrib.auth. `authenticate_email`
+fetches the user and their DRF token in one indexed query. It skips
+django.contrib.auth.authenticate(), so it sends user_login_failed itself;
+the login view sends user_logged_in.
+"""
+import logging
+
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_login_failed
+from django.db import connections
+from django.db.models import Count, Q, UniqueConstraint
+from django.db.models.functions import Lower
+
+logger = logging.getLogger(__name__)
+
+EMAIL_CONSTRAINT = UniqueConstraint(Lower('email'), name='auth_user_email_ci_uniq', condition=~Q(email=''))
+
+
+def ensure_email_index(using='default', **kwargs):
+    """post_migrate handler: add the case-insensitive unique email index if it is missing"""
+    connection = connections[using]
+    table = User._meta.db_table
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return
+        if EMAIL_CONSTRAINT.name in connection.introspection.get_constraints(cursor, table):
+            return
+
+    duplicates = list(
+        User.objects.using(using).exclude(email='').annotate(email_lower=Lower('email'))
+        .values('email_lower').annotate(n=Count('id')).filter(n__gt=1).values_list('email_lower', flat=True)[:20]
+    )
+    if duplicates:
+        logger.warning('Not creating %s: emails used by more than one account: %s',
+                       EMAIL_CONSTRAINT.name, ', '.join(duplicates))
+        return
+
+    with connection.schema_editor() as editor:
+        editor.add_constraint(User, EMAIL_CONSTRAINT)
+
+
+def email_taken(email):
+    return User.objects.annotate(email_lower=Lower('email')).filter(email_lower=email.lower()).exists()
+
+
+def authenticate_email(email, password, request=None):
+    """Return the active user for email/password, with ``auth_token`` preloaded when it exists.
+
+    Uses the LOWER(email) index for the lookup. check_password rehashes
+    the stored password if the hasher settings have changed.
+    """
+    user = (
+        User.objects.annotate(email_lower=Lower('email'))
+        .select_related('auth_token')
+        .filter(email_lower=email.lower())
+        .order_by('id')
+        .first()
+    )
+    if user is None:
+        # Hash anyway so unknown emails take as long as wrong passwords
+        User().set_password(password)
+        user = None
+    elif not user.check_password(password) or not user.is_active:
+        user = None
+    if user is None:
+        user_login_failed.send(sender=__name__, credentials={'email': email}, request=request)
+    return user
@@ -0,0 +1,338 @@
+"""Per-endpoint query-count and latency benchmarks.
+
+Every route in ``shop/urls.py`` (plus the djoser/JWT routes) is described
+by an `Endpoint`. `run` replays each one against seeded data (see
+`shop.factories`) and records query count, latency and response size;
+`compare` checks the results against a JSON baseline. The test suite uses
+this for query budgets and ``manage.py benchmark_api`` for latency in CI.
+"""
+import gc
+import hashlib
+import hmac
+import json
+import math
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver
+from rest_framework.authtoken.models import Token
+
+from . import admission, analytics
+from .cache import clear_l1
+from .jwt_auth import refresh_token_for
+from .models import CartItem, Subscription
+
+BASELINE_PATH = Path(__file__).resolve().parent / 'benchmark_baseline.json'
+
+# A latency regression must exceed both the relative threshold and this many ms
+MIN_LATENCY_REGRESSION_MS = 5.0
+
+
+class Endpoint:
+    def __init__(self, name, method, path, auth='anon', data=None, setup=None, headers=None):
+        self.name = name            # URL name, used to check route coverage
+        self.method = method
+        self.path = path            # str.format template filled from the seeded context
+        self.auth = auth            # 'anon', 'user' or 'staff'
+        self.data = data            # dict (formatted) or callable(ctx) -> dict
+        self.setup = setup          # callable(ctx) run before every call, may add to ctx
+        self.headers = headers or {}
+
+    @property
+    def key(self):
+        return f'{self.method} {self.name}'
+
+
+def _cart_item(ctx):
+    item = CartItem.objects.create(cart=ctx['user'].shop_cart, tea=ctx['tea'], quantity=1)
+    ctx['cart_item_id'] = item.id
+
+
+def _logout_tokens(ctx):
+    # Logout revokes the JWT it is sent with, so it gets its own
+    Token.objects.get_or_create(user=ctx['user'])
+    ctx['logout_access'] = str(refresh_token_for(ctx['user']).access_token)
+
+
+def _queue_ticket(ctx):
+    ctx['queue_ticket'] = admission.issue_ticket(ctx['user'].pk)[1]
+
+
+def _paused_subscription(ctx):
+    Subscription.objects.filter(pk=ctx['subscription'].pk).update(status='paused')
+
+
+def _counter(ctx):
+    ctx['n'] = ctx.get('n', 0) + 1
+
+
+def _cart_item_and_counter(ctx):
+    _cart_item(ctx)
+    _counter(ctx)
+
+
+def _webhook_body(ctx):
+    return {
+        'event': 'charge.success',
+        'data': {'reference': f"ORDER-{ctx['user'].id}-BENCH", 'amount': 500000,
+                 'metadata': {'type': 'order', 'user_id': ctx['user'].id, 'order_data': {}}},
+    }
+
+
+PREFLIGHT_HEADERS = {
+    'HTTP_ORIGIN': 'http://localhost:3000',
+    'HTTP_ACCESS_CONTROL_REQUEST_METHOD': 'POST',
+    'HTTP_ACCESS_CONTROL_REQUEST_HEADERS': 'authorization, content-type',
+}
+
+ENDPOINTS = [
+    # Catalog
+    Endpoint('api-root', 'GET', '/api/'),
+    Endpoint('tea-list', 'GET', '/api/teas/'),
+    Endpoint('tea-detail', 'GET', '/api/teas/{tea.id}/'),
+    Endpoint('ingredient-list', 'GET', '/api/ingredients/'),
+    Endpoint('ingredient-detail', 'GET', '/api/ingredients/{ingredient.id}/'),
+    Endpoint('ingredientcategory-list', 'GET', '/api/ingredient-categories/'),
+    Endpoint('ingredientcategory-detail', 'GET', '/api/ingredient-categories/{category.id}/'),
+    Endpoint('membership-list', 'GET', '/api/memberships/'),
+    Endpoint('membership-detail', 'GET', '/api/memberships/{membership.id}/'),
+    Endpoint('pickuplocation-list', 'GET', '/api/pickup-locations/'),
+    Endpoint('pickuplocation-detail', 'GET', '/api/pickup-locations/{pickup.id}/'),
+    Endpoint('catalog_sync', 'GET', '/api/catalog/sync/'),
+    # Account data
+    Endpoint('cart-list', 'GET', '/api/carts/', auth='user'),
+    Endpoint('cart-detail', 'GET', '/api/carts/{user.shop_cart.id}/', auth='user'),
+    Endpoint('order-list', 'GET', '/api/orders/', auth='user'),
+    Endpoint('order-list', 'GET', '/api/orders/', auth='staff'),
+    Endpoint('order-detail', 'GET', '/api/orders/{order.id}/', auth='user'),
+    Endpoint('export_orders', 'GET', '/api/orders/export/csv/', auth='staff'),
+    Endpoint('sales_report', 'GET', '/api/analytics/tea/?start=2000-01-01', auth='staff'),
+    Endpoint('subscription-list', 'GET', '/api/subscriptions/', auth='user'),
+    Endpoint('subscription-detail', 'GET', '/api/subscriptions/{subscription.id}/', auth='user'),
+    Endpoint('subscription-pause', 'POST', '/api/subscriptions/{subscription.id}/pause/', auth='user'),
+    Endpoint('subscription-resume', 'POST', '/api/subscriptions/{subscription.id}/resume/', auth='user',
+             setup=_paused_subscription),
+    Endpoint('subscription-cancel', 'POST', '/api/subscriptions/{subscription.id}/cancel/', auth='user'),
+    Endpoint('payment-list', 'GET', '/api/payments/', auth='user'),
+    Endpoint('payment-detail', 'GET', '/api/payments/{payment.id}/', auth='user'),
+    Endpoint('payment-create-payment', 'POST', '/api/payments/create_payment/', auth='user',
+             data={'subscription_id': '{subscription.id}'}),
+    Endpoint('profile-list', 'GET', '/api/profiles/', auth='user'),
+    Endpoint('profile-detail', 'GET', '/api/profiles/{profile.id}/', auth='user'),
+    Endpoint('profile-my-profile', 'GET', '/api/profiles/my_profile/', auth='user'),
+    Endpoint('delivery_addresses', 'GET', '/api/delivery-addresses/', auth='user'),
+    # Authentication
+    Endpoint('register', 'POST', '/api/auth/register/', setup=_counter,
+             data=lambda ctx: {'username': f"bench{ctx['n']}", 'email': f"bench{ctx['n']}@example.com",
+                               'password': 'Str0ng-pass!', 'password2': 'Str0ng-pass!'}),
+    Endpoint('login', 'POST', '/api/auth/login/', data={'email': '{user.email}', 'password': '{password}'}),
+    Endpoint('logout', 'POST', '/api/auth/logout/', setup=_logout_tokens,
+             headers={'HTTP_AUTHORIZATION': 'Bearer {logout_access}'}),
+    Endpoint('user_profile', 'GET', '/api/auth/profile/', auth='user'),
+    Endpoint('get_user_detailed', 'GET', '/api/auth/user/', auth='user'),
+    Endpoint('google_oauth_callback', 'POST', '/api/auth/google/', data={'access_token': 'bench'}),
+    Endpoint('google_oauth_login', 'POST', '/api/auth/google/login/', data={'id_token': 'bench'}),
+    # Cart and checkout
+    Endpoint('get_user_cart', 'GET', '/api/cart/', auth='user'),
+    Endpoint('add_to_cart', 'POST', '/api/cart/add/', auth='user', data={'tea_id': '{tea.id}', 'quantity': 1}),
+    Endpoint('update_cart_item', 'POST', '/api/cart/update/', auth='user', setup=_cart_item,
+             data=lambda ctx: {'cart_item_id': ctx['cart_item_id'], 'quantity': 2}),
+    Endpoint('remove_from_cart', 'POST', '/api/cart/remove/', auth='user', setup=_cart_item,
+             data=lambda ctx: {'cart_item_id': ctx['cart_item_id']}),
+    Endpoint('place_order', 'POST', '/api/checkout/place-order/', auth='user', setup=_cart_item,
+             data={'delivery_type': 'pickup', 'pickup_id': '{pickup.id}'}),
+    Endpoint('clear_cart', 'POST', '/api/cart/clear/', auth='user', setup=_cart_item),
+    Endpoint('checkout_queue', 'GET', '/api/checkout/queue/?ticket={queue_ticket}', setup=_queue_ticket),
+    # Payments (Paystack is stubbed, see offline())
+    Endpoint('initiate_payment', 'POST', '/api/payment/initiate/', auth='user', setup=_cart_item,
+             data={'delivery_type': 'pickup', 'pickup_id': '{pickup.id}'}),
+    Endpoint('verify_payment', 'GET', '/api/payment/verify/?reference=BENCH-{n}', auth='user',
+             setup=_cart_item_and_counter),
+    Endpoint('paystack_webhook', 'POST', '/api/payment/webhook/', data=_webhook_body),
+    Endpoint('initiate_membership_payment', 'POST', '/api/payment/membership/initiate/', auth='user',
+             data={'membership_id': '{membership.id}'}),
+    Endpoint('verify_membership_payment', 'GET', '/api/payment/membership/verify/?reference=BENCH', auth='user'),
+    Endpoint('metrics', 'GET', '/api/metrics/', headers={'HTTP_AUTHORIZATION': 'Bearer bench'}),
+    # CORS preflights, answered by mybrutea_backend.middleware.CorsMiddleware
+    Endpoint('tea-list', 'OPTIONS', '/api/teas/', headers=PREFLIGHT_HEADERS),
+    Endpoint('add_to_cart', 'OPTIONS', '/api/cart/add/', headers=PREFLIGHT_HEADERS),
+    # djoser and simplejwt
+    Endpoint('user-list', 'GET', '/api/auth/users/', auth='user'),
+    Endpoint('user-me', 'GET', '/api/auth/users/me/', auth='user'),
+    Endpoint('user-detail', 'GET', '/api/auth/users/{user.id}/', auth='user'),
+    Endpoint('jwt-create', 'POST', '/api/auth/jwt/jwt/create/', data={'username': '{user.username}', 'password': '{password}'}),
+    Endpoint('jwt-refresh', 'POST', '/api/auth/jwt/jwt/refresh/', data={'refresh': '{refresh}'}),
+    Endpoint('jwt-verify', 'POST', '/api/auth/jwt/jwt/verify/', data={'token': '{access}'}),
+    Endpoint('token_obtain_pair', 'POST', '/api/token/', data={'username': '{user.username}', 'password': '{password}'}),
+    Endpoint('token_refresh', 'POST', '/api/token/refresh/', data={'refresh': '{refresh}'}),
+]
+
+
+def uncovered_routes():
+    """Named routes in shop/urls.py that no Endpoint exercises"""
+    names = {k for k in get_resolver('shop.urls').reverse_dict.keys() if isinstance(k, str)}
+    return sorted(names - {e.name for e in ENDPOINTS})
+
+
+def _paystack_stub(ctx):
+    def respond(*args, **kwargs):
+        response = mock.Mock(status_code=200, text='{}')
+        response.json.return_value = {
+            'status': True,
+            'data': {
+                'status': 'success', 'amount': 500000, 'authorization_url': 'https://paystack.test/pay',
+                'access_code': 'bench', 'reference': 'BENCH',
+                'metadata': {
+                    'membership_id': ctx['membership'].id,
+                    'order_data': {'delivery_type': 'pickup', 'pickup_id': ctx['pickup'].id},
+                },
+            },
+        }
+        response.raise_for_status.return_value = None
+        return response
+    return respond
+
+
+def offline(ctx):
+    """Patch outbound Paystack/Google calls so benchmarks never touch the network.
+
+    Throttling is switched off too, since every call comes from one client,
+    and caches are swapped for private in-memory ones so cached catalog
+    data from another database never leaks into the results.
+    """
+    stack = ExitStack()
+    stack.enter_context(mock.patch('shop.payment_views.requests.post', side_effect=_paystack_stub(ctx)))
+    stack.enter_context(mock.patch('shop.payment_views.requests.get', side_effect=_paystack_stub(ctx)))
+    google_user = {'email': ctx['user'].email, 'given_name': 'Bench', 'family_name': 'User', 'sub': 'bench', 'id': 'bench'}
+    stack.enter_context(mock.patch('shop.google_auth.GoogleTokenVerifier.user_info', return_value=google_user))
+    stack.enter_context(mock.patch('shop.google_auth.GoogleTokenVerifier.verify', return_value=google_user))
+    stack.enter_context(override_settings(
+        METRICS_TOKEN='bench', THROTTLE_ENABLED=False,
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmarks'},
+            'counters': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmarks-counters'},
+        },
+    ))
+    return stack
+
+
+def _fill(value, ctx):
+    if isinstance(value, str):
+        return value.format(**ctx)
+    if isinstance(value, dict):
+        return {k: _fill(v, ctx) for k, v in value.items()}
+    return value
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def run(ctx, repeat=5, endpoints=None):
+    """Call every endpoint `repeat` times; return {endpoint key: stats}"""
+    ctx = dict(ctx)
+    refresh = refresh_token_for(ctx['user'])
+    ctx.update(refresh=str(refresh), access=str(refresh.access_token))
+    auth_headers = {
+        'anon': {},
+        'user': {'HTTP_AUTHORIZATION': f"Bearer {refresh.access_token}"},
+        'staff': {'HTTP_AUTHORIZATION': f"Bearer {refresh_token_for(ctx['staff']).access_token}"},
+    }
+    client = Client()
+    results = {}
+
+    # Revoked JWTs reload on a timer; keep that query out of whichever endpoint it lands on
+    with offline(ctx), override_settings(JWT_REVOCATION_REFRESH=24 * 3600):
+        for endpoint in endpoints or ENDPOINTS:
+            timings, queries = [], 0
+            # The first call warms URL resolution and serializer caches and is not recorded
+            for i in range(repeat + 1):
+                if endpoint.setup:
+                    endpoint.setup(ctx)
+                # Rollup work marked outside a request (setup, or a test whose transaction
+                # never commits) would otherwise be flushed by the endpoint
+                analytics.flush()
+                data = endpoint.data(ctx) if callable(endpoint.data) else _fill(endpoint.data, ctx)
+                body = json.dumps(data or {})
+                headers = dict(auth_headers[endpoint.auth], **_fill(endpoint.headers, ctx))
+                if endpoint.name == 'paystack_webhook':
+                    secret = settings.PAYSTACK_SECRET_KEY.encode('utf-8')
+                    headers['HTTP_X_PAYSTACK_SIGNATURE'] = hmac.new(secret, body.encode('utf-8'), hashlib.sha512).hexdigest()
+
+                # Like timeit, keep garbage collection pauses out of the measurement
+                gc.collect()
+                gc.disable()
+                # Measure the uncached path; cache hits would hide query regressions
+                cache.clear()
+                clear_l1()
+                # queries_log is a bounded deque; once full, CaptureQueriesContext would count 0
+                connection.queries_log.clear()
+                try:
+                    with CaptureQueriesContext(connection) as captured:
+                        start = time.perf_counter()
+                        if endpoint.method == 'GET':
+                            response = client.get(_fill(endpoint.path, ctx), **headers)
+                        else:
+                            response = client.generic(endpoint.method, _fill(endpoint.path, ctx), body,
+                                                      content_type='application/json', **headers)
+                        # Streaming responses run their queries while being consumed
+                        content = b''.join(response.streaming_content) if response.streaming else response.content
+                        elapsed = (time.perf_counter() - start) * 1000
+                finally:
+                    gc.enable()
+                if i:
+                    timings.append(elapsed)
+                    queries = max(queries, len(captured))
+
+            key = endpoint.key if endpoint.auth != 'staff' else f'{endpoint.key} (staff)'
+            results[key] = {
+                'status': response.status_code,
+                'queries': queries,
+                'p50_ms': round(percentile(timings, 50), 2),
+                'p95_ms': round(percentile(timings, 95), 2),
+                'bytes': len(content),
+            }
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not Path(path).exists():
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def save_baseline(volume, results, path=BASELINE_PATH):
+    baseline = load_baseline(path)
+    baseline[volume] = results
+    with open(path, 'w') as fh:
+        json.dump(baseline, fh, indent=2, sort_keys=True)
+        fh.write('\n')
+
+
+def compare(results, baseline, latency_threshold=None):
+    """Return human-readable regressions of `results` against `baseline`.
+
+    Any increase in query count is a regression. Latency is only checked
+    when `latency_threshold` is given (e.g. 0.25 for +25% on p95).
+    """
+    problems = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        if result['queries'] > expected['queries']:
+            problems.append(f"{key}: {result['queries']} queries (baseline {expected['queries']})")
+        if latency_threshold is not None:
+            limit = expected['p95_ms'] * (1 + latency_threshold)
+            if result['p95_ms'] > limit and result['p95_ms'] - expected['p95_ms'] > MIN_LATENCY_REGRESSION_MS:
+                problems.append(f"{key}: p95 {result['p95_ms']}ms (baseline {expected['p95_ms']}ms)")
+    return problems
@@ -0,0 +1,204 @@
+"""Two-tier cache: an in-process LRU (L1) in front of a shared Django cache (L2).
+
+L1 answers repeat reads without a network hop. L2 (settings.CACHES, file
+based or Redis) is shared by every worker. Values are addressed as
+``<prefix>:v<version>:<key>``. ``bump()`` increments the prefix version,
+which invalidates every key under it at once. Other workers notice a bump
+when their cached copy of the version expires (``version_ttl``).
+
+``get_or_set`` recomputes a missing value once. Threads in the same
+process wait on a lock. Other processes wait on an L2 lock key for up to
+``lock_timeout`` and then compute anyway. Hits and misses per prefix are
+exported as ``cache_requests_total``.
+
+    from shop.cache import catalog_cache
+
+    data = catalog_cache.get_or_set(key, lambda: serializer.data)
+    catalog_cache.bump()  # after the catalog changes
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+REQUESTS = metrics.counter('cache_requests_total', 'Tiered cache lookups', ['prefix', 'result'])
+
+_MISSING = object()
+_instances = []
+
+
+class LRUCache:
+    """Thread-safe LRU with per-entry expiry"""
+
+    def __init__(self, maxsize=1024, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= self.clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (self.clock() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache:
+    def __init__(self, prefix, ttl=300, l1_ttl=30, l1_size=1024, alias='default',
+                 version_ttl=5, lock_timeout=10):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.l1_ttl = min(l1_ttl, ttl)
+        self.alias = alias
+        self.version_ttl = version_ttl
+        self.lock_timeout = lock_timeout
+        self.l1 = LRUCache(l1_size)
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        _instances.append(self)
+
+    @property
+    def l2(self):
+        return caches[self.alias]
+
+    @property
+    def _version_key(self):
+        return f'{self.prefix}:version'
+
+    def version(self):
+        version = self.l1.get(self._version_key)
+        if version is None:
+            version = self.l2.get(self._version_key)
+            if version is None:
+                version = 1
+                self.l2.add(self._version_key, version, timeout=None)
+            self.l1.set(self._version_key, version, self.version_ttl)
+        return version
+
+    def bump(self):
+        """Invalidate every key under this prefix"""
+        try:
+            version = self.l2.incr(self._version_key)
+        except ValueError:
+            version = 2
+            self.l2.set(self._version_key, version, timeout=None)
+        self.l1.clear()
+        self.l1.set(self._version_key, version, self.version_ttl)
+        return version
+
+    def make_key(self, key):
+        return f'{self.prefix}:v{self.version()}:{key}'
+
+    def get(self, key, default=None):
+        full_key = self.make_key(key)
+        value = self.l1.get(full_key, _MISSING)
+        if value is not _MISSING:
+            REQUESTS.inc(prefix=self.prefix, result='l1_hit')
+            return value
+        value = self.l2.get(full_key, _MISSING)
+        if value is not _MISSING:
+            REQUESTS.inc(prefix=self.prefix, result='l2_hit')
+            self.l1.set(full_key, value, self.l1_ttl)
+            return value
+        REQUESTS.inc(prefix=self.prefix, result='miss')
+        return default
+
+    def set(self, key, value, ttl=None):
+        full_key = self.make_key(key)
+        ttl = self.ttl if ttl is None else ttl
+        self.l2.set(full_key, value, timeout=ttl)
+        self.l1.set(full_key, value, min(self.l1_ttl, ttl))
+
+    def delete(self, key):
+        full_key = self.make_key(key)
+        self.l1.delete(full_key)
+        self.l2.delete(full_key)
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Return the cached value, computing it at most once across concurrent callers"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._flights_lock:
+            flight = self._flights.setdefault(key, threading.Lock())
+        with flight:
+            # The thread that held the lock may have filled it
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            try:
+                return self._compute_once(key, compute, ttl)
+            finally:
+                with self._flights_lock:
+                    self._flights.pop(key, None)
+
+    def _compute_once(self, key, compute, ttl):
+        full_key = self.make_key(key)
+        lock_key = f'{full_key}:lock'
+        locked = self.l2.add(lock_key, 1, timeout=self.lock_timeout)
+        if not locked:
+            # Another process is computing; wait for its result
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = self.l2.get(full_key, _MISSING)
+                if value is not _MISSING:
+                    self.l1.set(full_key, value, self.l1_ttl)
+                    return value
+        try:
+            value = compute()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            if locked:
+                self.l2.delete(lock_key)
+
+    def stats(self):
+        return {result: REQUESTS.value(prefix=self.prefix, result=result)
+                for result in ('l1_hit', 'l2_hit', 'miss')}
+
+
+def clear_l1():
+    """Empty the in-process tier of every TieredCache"""
+    for instance in _instances:
+        instance.l1.clear()
+
+
+@receiver(setting_changed)
+def _reset_l1(setting, **kwargs):
+    # Tests swap CACHES; L1 copies of the old backend's data must go too
+    if setting == 'CACHES':
+        clear_l1()
+
+
+catalog_cache = TieredCache('catalog', ttl=600, l1_ttl=10)
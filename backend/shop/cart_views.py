@@ -11,18 +11,29 @@ from .serializers import OrderSerializer, DeliveryAddressSerializer, PickupLocat
 from django.shortcuts import get_object_or_404
 from decimal import Decimal
 
+from . import shaping, stock
+from .admission import admission_controlled
+from .idempotency import idempotent
+
+
+def _cart_data(cart):
+    """Serialized cart, loading its items and their products in a fixed number of queries"""
+    cart = shaping.shape_queryset(Cart.objects.filter(pk=cart.pk), CartSerializer()).get()
+    return CartSerializer(cart).data
+
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_user_cart(request):
     """Get or create cart for the current user"""
     cart, created = Cart.objects.get_or_create(user=request.user)
-    serializer = CartSerializer(cart)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return Response(_cart_data(cart), status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@admission_controlled
+@idempotent
 def add_to_cart(request):
     """Add a tea or ingredient to the user's cart
 
@@ -44,20 +55,7 @@ def add_to_cart(request):
         except Tea.DoesNotExist:
             return Response({'error': 'Tea not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Check stock
-        if tea.quantity_in_stock < quantity:
-            return Response({'error': f'Not enough stock. Available: {tea.quantity_in_stock}'}, status=status.HTTP_400_BAD_REQUEST)
-
-        cart_item, created = CartItem.objects.get_or_create(cart=cart, tea=tea, defaults={'quantity': quantity})
-        if not created:
-            cart_item.quantity += quantity
-            if cart_item.quantity > tea.quantity_in_stock:
-                return Response({'error': f'Not enough stock. Available: {tea.quantity_in_stock}'}, status=status.HTTP_400_BAD_REQUEST)
-            cart_item.save()
-
-        # Reduce tea stock
-        tea.quantity_in_stock -= quantity
-        tea.save()
+        product, lookup = tea, {'tea': tea}
 
     else:
         # Handle ingredient
@@ -66,144 +64,113 @@ def add_to_cart(request):
         except Ingredient.DoesNotExist:
             return Response({'error': 'Ingredient not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        if ingredient.stock < quantity:
-            return Response({'error': f'Not enough stock. Available: {ingredient.stock}'}, status=status.HTTP_400_BAD_REQUEST)
+        product, lookup = ingredient, {'ingredient': ingredient}
 
-        cart_item, created = CartItem.objects.get_or_create(cart=cart, ingredient=ingredient, defaults={'quantity': quantity})
-        if not created:
-            cart_item.quantity += quantity
-            if cart_item.quantity > ingredient.stock:
-                return Response({'error': f'Not enough stock. Available: {ingredient.stock}'}, status=status.HTTP_400_BAD_REQUEST)
-            cart_item.save()
+    try:
+        with transaction.atomic():
+            # Reserve in the stock ledger, then hold the quantity in the cart
+            stock.reserve(product, quantity, reference=f'cart:{cart.id}')
+            cart_item, created = CartItem.objects.get_or_create(cart=cart, **lookup, defaults={'quantity': quantity})
+            if not created:
+                cart_item.quantity += quantity
+                cart_item.save()
+    except stock.InsufficientStock as exc:
+        return Response({'error': f'Not enough stock. Available: {exc.available}'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Reduce ingredient stock
-        ingredient.stock -= quantity
-        ingredient.save()
-
-    serializer = CartSerializer(cart)
-    return Response(serializer.data, status=status.HTTP_201_CREATED)
+    return Response(_cart_data(cart), status=status.HTTP_201_CREATED)
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def update_cart_item(request):
     """Update quantity of a tea in the cart"""
     cart_item_id = request.data.get('cart_item_id')
     new_quantity = request.data.get('quantity')
     
     try:
-        cart_item = CartItem.objects.get(id=cart_item_id)
+        cart_item = CartItem.objects.select_related('cart', 'tea', 'ingredient').get(id=cart_item_id)
     except CartItem.DoesNotExist:
         return Response({'error': 'Cart item not found'}, status=status.HTTP_404_NOT_FOUND)
     
     # Verify ownership
-    if cart_item.cart.user != request.user:
+    if cart_item.cart.user_id != request.user.pk:
         return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
     
     old_quantity = cart_item.quantity
-    tea = cart_item.tea
-    ingredient = getattr(cart_item, 'ingredient', None)
+    product = cart_item.ingredient or cart_item.tea
+    reference = f'cart:{cart_item.cart_id}'
     
-    with transaction.atomic():
-        if new_quantity <= 0:
-            # Remove item and restore stock
-            if ingredient:
-                ingredient.stock += old_quantity
-                ingredient.save()
-            else:
-                tea.quantity_in_stock += old_quantity
-                tea.save()
-            cart_item.delete()
-        else:
-            # Calculate stock adjustment
-            quantity_diff = new_quantity - old_quantity
-            if ingredient:
-                if quantity_diff > 0:
-                    if ingredient.stock < quantity_diff:
-                        return Response({'error': f'Not enough stock. Available: {ingredient.stock}'}, status=status.HTTP_400_BAD_REQUEST)
-                    ingredient.stock -= quantity_diff
-                else:
-                    ingredient.stock += abs(quantity_diff)
-                ingredient.save()
+    try:
+        with transaction.atomic():
+            if new_quantity <= 0:
+                # Remove item and release its stock
+                stock.release(product, old_quantity, reference)
+                cart_item.delete()
             else:
+                # Reserve or release the difference
+                quantity_diff = new_quantity - old_quantity
                 if quantity_diff > 0:
-                    if tea.quantity_in_stock < quantity_diff:
-                        return Response({'error': f'Not enough stock. Available: {tea.quantity_in_stock}'}, status=status.HTTP_400_BAD_REQUEST)
-                    tea.quantity_in_stock -= quantity_diff
-                else:
-                    tea.quantity_in_stock += abs(quantity_diff)
-                tea.save()
-
-            cart_item.quantity = new_quantity
-            cart_item.save()
+                    stock.reserve(product, quantity_diff, reference)
+                elif quantity_diff < 0:
+                    stock.release(product, -quantity_diff, reference)
+
+                cart_item.quantity = new_quantity
+                cart_item.save()
+    except stock.InsufficientStock as exc:
+        return Response({'error': f'Not enough stock. Available: {exc.available}'}, status=status.HTTP_400_BAD_REQUEST)
     
-    cart = cart_item.cart
-    serializer = CartSerializer(cart)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return Response(_cart_data(cart_item.cart), status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def remove_from_cart(request):
     """Remove a tea from the cart"""
     cart_item_id = request.data.get('cart_item_id')
     
     try:
-        cart_item = CartItem.objects.get(id=cart_item_id)
+        cart_item = CartItem.objects.select_related('cart', 'tea', 'ingredient').get(id=cart_item_id)
     except CartItem.DoesNotExist:
         return Response({'error': 'Cart item not found'}, status=status.HTTP_404_NOT_FOUND)
     
     # Verify ownership
-    if cart_item.cart.user != request.user:
+    if cart_item.cart.user_id != request.user.pk:
         return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
     
-    quantity = cart_item.quantity
-    ingredient = getattr(cart_item, 'ingredient', None)
-    tea = getattr(cart_item, 'tea', None)
-    
     with transaction.atomic():
-        # Restore stock
-        if ingredient:
-            ingredient.stock += quantity
-            ingredient.save()
-        elif tea:
-            tea.quantity_in_stock += quantity
-            tea.save()
+        # Release the reserved stock
+        stock.release_items([cart_item], reference=f'cart:{cart_item.cart_id}')
         
         cart = cart_item.cart
         cart_item.delete()
     
-    serializer = CartSerializer(cart)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    return Response(_cart_data(cart), status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def clear_cart(request):
     """Clear all items from the user's cart"""
     try:
         cart = Cart.objects.get(user=request.user)
         
         with transaction.atomic():
-            for cart_item in cart.items.all():
-                # Restore stock for tea or ingredient
-                if cart_item.ingredient:
-                    cart_item.ingredient.stock += cart_item.quantity
-                    cart_item.ingredient.save()
-                elif cart_item.tea:
-                    cart_item.tea.quantity_in_stock += cart_item.quantity
-                    cart_item.tea.save()
-            
+            # Release the reserved stock of every item
+            stock.release_items(cart.items.select_related('tea', 'ingredient'), reference=f'cart:{cart.id}')
             cart.items.all().delete()
         
-        serializer = CartSerializer(cart)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return Response(_cart_data(cart), status=status.HTTP_200_OK)
     except Cart.DoesNotExist:
         return Response({'error': 'Cart not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@admission_controlled
+@idempotent
 def place_order(request):
     """Create an Order from the user's cart and attach delivery or pickup info.
 
@@ -227,8 +194,9 @@ def place_order(request):
     delivery_address_id = data.get('delivery_address_id')
 
     # Calculate subtotal (note: stock already adjusted during cart operations)
+    items = list(cart.items.select_related('tea', 'ingredient'))
     subtotal = Decimal('0.00')
-    for ci in cart.items.all():
+    for ci in items:
         if ci.ingredient:
             subtotal += (ci.ingredient.price * ci.quantity)
         elif ci.tea:
@@ -267,29 +235,32 @@ def place_order(request):
 
     total_price = subtotal + (delivery_fee or Decimal('0.00'))
 
-    # Create order without modifying tea stock (stock already adjusted when adding to cart)
-    order = Order.objects.create(
-        user=user,
-        total_price=total_price,
-        delivery_type=delivery_type,
-        pickup_location=pickup_name if pickup_name else (addr.address_line1 if delivery_type == 'delivery' else ''),
-        delivery_address_line1=(addr.address_line1 if delivery_type == 'delivery' else None),
-        delivery_address_line2=(addr.address_line2 if delivery_type == 'delivery' else None),
-        delivery_city=(addr.city if delivery_type == 'delivery' else None),
-        delivery_state=(addr.state if delivery_type == 'delivery' else None),
-        delivery_zip_code=(addr.zip_code if delivery_type == 'delivery' else None),
-        delivery_fee=delivery_fee
-    )
-
-    # Move cart items into order items
-    for ci in cart.items.all():
-        if ci.ingredient:
-            OrderItem.objects.create(order=order, ingredient=ci.ingredient, quantity=ci.quantity)
-        else:
-            OrderItem.objects.create(order=order, tea=ci.tea, quantity=ci.quantity)
+    # The order, its sales and the emptied cart commit together or not at all
+    with transaction.atomic():
+        # Create order without modifying tea stock (stock already adjusted when adding to cart)
+        order = Order.objects.create(
+            user=user,
+            total_price=total_price,
+            delivery_type=delivery_type,
+            pickup_location=pickup_name if pickup_name else (addr.address_line1 if delivery_type == 'delivery' else ''),
+            delivery_address_line1=(addr.address_line1 if delivery_type == 'delivery' else None),
+            delivery_address_line2=(addr.address_line2 if delivery_type == 'delivery' else None),
+            delivery_city=(addr.city if delivery_type == 'delivery' else None),
+            delivery_state=(addr.state if delivery_type == 'delivery' else None),
+            delivery_zip_code=(addr.zip_code if delivery_type == 'delivery' else None),
+            delivery_fee=delivery_fee
+        )
+
+        # Move cart items into order items
+        for ci in items:
+            if ci.ingredient:
+                OrderItem.objects.create(order=order, ingredient=ci.ingredient, quantity=ci.quantity)
+            else:
+                OrderItem.objects.create(order=order, tea=ci.tea, quantity=ci.quantity)
 
-    # Clear the cart (do not restore stock)
-    cart.items.all().delete()
+        # The reservations become sales; clear the cart
+        stock.sell_items(items, reference=f'order:{order.id}')
+        cart.items.all().delete()
 
     serializer = OrderSerializer(order)
     return Response(serializer.data, status=status.HTTP_201_CREATED)
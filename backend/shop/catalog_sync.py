@@ -0,0 +1,70 @@
+"""Change feed behind ``/api/catalog/sync/`` for clients that cache the catalog.
+
+Every create, update or delete of a tea, ingredient, ingredient category or
+membership calls ``touch()``, as does a product running out of stock or
+coming back (see shop.stock; other stock counts are not pushed). That replaces the object's CatalogChange row with a new one,
+so the table holds one row per object (tombstones for deletions) and its
+id is a change sequence.
+
+Tea payloads embed their ingredients, so editing an ingredient touches
+its teas as well. Ingredient stock changes touch only the ingredient;
+clients read ingredient stock from the ingredients section.
+
+A client sends the last token it got. It receives the current state of
+everything whose row is newer, plus the ids deleted since. Without a
+token, or with one the server does not recognise, it gets the full catalog
+(``full: true``) and replaces its cache.
+
+Change ids are allocated on insert but become visible on commit, so a
+slow transaction can commit an id lower than one a client already
+synced past. The feed therefore stops before any change younger than
+CATALOG_SYNC_SETTLE seconds; the client picks it up on its next sync.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import CatalogChange, Ingredient, IngredientCategory, Membership, Tea
+
+KINDS = {
+    Tea: 'tea',
+    Ingredient: 'ingredient',
+    IngredientCategory: 'category',
+    Membership: 'membership',
+}
+
+
+def touch(model, ids, deleted=False):
+    """Record that objects of ``model`` changed (or were deleted)"""
+    kind, ids = KINDS[model], sorted(set(ids))
+    if not ids:
+        return
+    CatalogChange.objects.filter(kind=kind, object_id__in=ids).delete()
+    CatalogChange.objects.bulk_create([CatalogChange(kind=kind, object_id=pk, deleted=deleted) for pk in ids])
+
+
+def settle_cutoff():
+    return timezone.now() - timedelta(seconds=getattr(settings, 'CATALOG_SYNC_SETTLE', 2))
+
+
+def settled_token():
+    """Newest change id that no still-settling change can be committed below"""
+    unsettled = CatalogChange.objects.filter(created_at__gt=settle_cutoff()).aggregate(first=Min('id'))['first']
+    if unsettled is not None:
+        return unsettled - 1
+    return latest_id()
+
+
+def latest_id():
+    return CatalogChange.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def changes_between(since, token):
+    """Return ({kind: changed ids}, {kind: deleted ids}) for changes in (since, token]"""
+    changed, deleted = {}, {}
+    rows = CatalogChange.objects.filter(id__gt=since, id__lte=token).values_list('kind', 'object_id', 'deleted')
+    for kind, object_id, is_deleted in rows:
+        (deleted if is_deleted else changed).setdefault(kind, []).append(object_id)
+    return changed, deleted
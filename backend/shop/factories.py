@@ -0,0 +1,193 @@
+"""Bulk data factories for benchmarks and load tests.
+
+Everything is created with bulk_create and a seeded RNG so two runs with the
+same volume produce the same rows. Volumes:
+
+- ``small``: enough rows to exercise every code path, used by the test suite
+- ``large``: production-like history (100k orders) for the benchmark command
+"""
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from . import analytics, stock
+from .models import (
+    Cart, CartItem, DeliveryAddress, Ingredient, IngredientCategory, Membership, Order, OrderItem,
+    Payment, PickupLocation, Profile, Subscription, Tea,
+)
+
+VOLUMES = {
+    'small': {'categories': 3, 'ingredients': 12, 'teas': 8, 'users': 10, 'orders': 40, 'cart_items': 3},
+    'large': {'categories': 12, 'ingredients': 300, 'teas': 120, 'users': 5000, 'orders': 100000, 'cart_items': 4},
+}
+
+PASSWORD = 'bench-pass-123'
+CITIES = ['Lagos', 'Abuja', 'Ibadan', 'Port Harcourt', 'Kano', 'Enugu']
+
+
+def seed(volume='small', seed=42):
+    """Create a full data set and return the objects benchmarks need to address"""
+    sizes = VOLUMES[volume]
+    rng = random.Random(seed)
+
+    memberships = seed_memberships()
+    pickups = seed_pickup_locations()
+    ingredients = seed_ingredients(rng, sizes['categories'], sizes['ingredients'])
+    teas = seed_teas(rng, ingredients, sizes['teas'])
+    # bulk_create skips the signal that opens each product's stock ledger
+    stock.open_balances(ingredients + teas)
+    users, staff = seed_users(sizes['users'])
+    seed_carts(rng, users, teas, ingredients, sizes['cart_items'])
+    seed_orders(rng, users, teas, ingredients, pickups, sizes['orders'])
+    subscriptions = seed_subscriptions(rng, users, memberships)
+    # bulk_create skips the signals that maintain rollups
+    today = timezone.localdate()
+    analytics.rebuild(today - timedelta(days=366), today)
+
+    return {
+        'user': users[0],
+        'staff': staff,
+        'password': PASSWORD,
+        'tea': teas[0],
+        'ingredient': ingredients[0],
+        'membership': memberships[-1],
+        'pickup': pickups[0],
+        'subscription': subscriptions[0],
+        'order': Order.objects.filter(user=users[0]).first(),
+        'payment': Payment.objects.filter(subscription__user=users[0]).first(),
+        'profile': Profile.objects.get(user=users[0]),
+        'category': ingredients[0].category,
+    }
+
+
+def seed_memberships():
+    tiers = [
+        ('CASUAL', 'Casual', Decimal('0.00')),
+        ('CLASSIC', 'Classic', Decimal('5000.00')),
+        ('PREMIUM', 'Premium', Decimal('15000.00')),
+    ]
+    return Membership.objects.bulk_create([
+        Membership(tier=tier, name=name, description=f'{name} membership', price=price,
+                   features=['Feature A', 'Feature B'], includes_health_protocol=tier == 'PREMIUM')
+        for tier, name, price in tiers
+    ])
+
+
+def seed_pickup_locations():
+    return PickupLocation.objects.bulk_create([
+        PickupLocation(name=f'{city} Hub', address=f'1 Market Road, {city}', city=city,
+                       branch='Main', delivery_fee=Decimal('500.00'))
+        for city in CITIES
+    ])
+
+
+def seed_ingredients(rng, categories, count):
+    cats = IngredientCategory.objects.bulk_create([
+        IngredientCategory(name=f'Category {i}', description='Herbs and spices') for i in range(categories)
+    ])
+    return Ingredient.objects.bulk_create([
+        Ingredient(name=f'Ingredient {i}', description='A fragrant botanical', category=cats[i % categories],
+                   price=Decimal(rng.randint(100, 2000)), stock=rng.randint(500, 5000))
+        for i in range(count)
+    ])
+
+
+def seed_teas(rng, ingredients, count):
+    teas = Tea.objects.bulk_create([
+        Tea(name=f'Blend {i}', description='A house blend', price=Decimal(rng.randint(1500, 9000)),
+            quantity_in_stock=rng.randint(500, 5000))
+        for i in range(count)
+    ])
+    through = Tea.ingredients.through
+    through.objects.bulk_create([
+        through(tea_id=tea.id, ingredient_id=ingredient.id)
+        for tea in teas
+        for ingredient in rng.sample(ingredients, min(4, len(ingredients)))
+    ])
+    return teas
+
+
+def seed_users(count):
+    # Hash once; every benchmark user shares the same password
+    password = make_password(PASSWORD)
+    users = User.objects.bulk_create([
+        User(username=f'user{i}', email=f'user{i}@example.com', password=password,
+             first_name='Bench', last_name=str(i))
+        for i in range(count)
+    ])
+    staff = User.objects.create(username='staff', email='staff@example.com', password=password,
+                                is_staff=True, is_superuser=True)
+    Profile.objects.bulk_create([Profile(user=user) for user in users + [staff]])
+    DeliveryAddress.objects.bulk_create([
+        DeliveryAddress(user=user, address_line1=f'{i} Allen Avenue', city=CITIES[i % len(CITIES)],
+                        state='Lagos', is_default=True)
+        for i, user in enumerate(users)
+    ])
+    return users, staff
+
+
+def seed_carts(rng, users, teas, ingredients, items_per_cart):
+    carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+    items = []
+    for cart in carts:
+        for tea in rng.sample(teas, min(items_per_cart, len(teas))):
+            items.append(CartItem(cart=cart, tea=tea, quantity=rng.randint(1, 3)))
+        items.append(CartItem(cart=cart, ingredient=rng.choice(ingredients), quantity=1))
+    CartItem.objects.bulk_create(items, batch_size=2000)
+    stock.record_items(items, 'reserve', reference='seed')
+
+
+def seed_orders(rng, users, teas, ingredients, pickups, count, batch_size=5000):
+    now = timezone.now()
+    for offset in range(0, count, batch_size):
+        orders = []
+        for i in range(offset, min(offset + batch_size, count)):
+            user = users[i % len(users)]
+            pickup = rng.random() < 0.6
+            city = rng.choice(CITIES)
+            orders.append(Order(
+                user=user,
+                total_price=Decimal(rng.randint(2000, 40000)),
+                delivery_type='pickup' if pickup else 'delivery',
+                pickup_location=f'{rng.choice(pickups).name} - Main' if pickup else f'{i} Allen Avenue',
+                delivery_address_line1=None if pickup else f'{i} Allen Avenue',
+                delivery_city=None if pickup else city,
+                delivery_fee=Decimal('500.00'),
+                payment_reference=f'ORDER-{user.id}-{i:012d}',
+                payment_status=rng.choice(['paid', 'paid', 'paid', 'pending', 'failed']),
+            ))
+        orders = Order.objects.bulk_create(orders)
+
+        # created_at is auto_now_add, so spread order history over the past year afterwards
+        for order in orders:
+            order.created_at = now - timedelta(days=rng.randint(0, 365), minutes=rng.randint(0, 1440))
+        Order.objects.bulk_update(orders, ['created_at'], batch_size=1000)
+
+        items = []
+        for order in orders:
+            for _ in range(rng.randint(1, 3)):
+                if rng.random() < 0.7:
+                    items.append(OrderItem(order=order, tea=rng.choice(teas), quantity=rng.randint(1, 3)))
+                else:
+                    items.append(OrderItem(order=order, ingredient=rng.choice(ingredients), quantity=1))
+        OrderItem.objects.bulk_create(items, batch_size=batch_size)
+
+
+def seed_subscriptions(rng, users, memberships):
+    now = timezone.now()
+    subscriptions = Subscription.objects.bulk_create([
+        Subscription(user=user, membership=rng.choice(memberships), status='active',
+                     renewal_date=now + timedelta(days=30), payment_reference=f'MEMBERSHIP-{user.id}',
+                     payment_status='paid', amount_paid=Decimal('5000.00'))
+        for user in users
+    ])
+    Payment.objects.bulk_create([
+        Payment(subscription=sub, amount=sub.amount_paid, status='completed', payment_method='paystack',
+                transaction_ref=f'TXN-{sub.user_id}-{sub.id}', completed_at=now)
+        for sub in subscriptions
+    ])
+    return subscriptions
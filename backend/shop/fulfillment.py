@@ -0,0 +1,223 @@
+"""Turning a successful Paystack charge into an order or an active subscription.
+
+``verify_payment``, ``verify_membership_payment``, the webhook and
+``manage.py reconcile_payments`` all go through here, and each reference
+is materialized once: whichever arrives second gets the order or
+subscription that already carries the reference. Orders are built from
+the cart lines saved on the reference's PaymentIntent when the payment
+was initialized, so a cart edited afterwards (or emptied by a lost
+webhook's retry) does not change what was bought. Matching cart lines
+have their reservations turned into sales and leave the cart. Payments
+initialized without a snapshot fall back to the current cart. A paid
+order is always created: units that stock can no longer cover are
+recorded as backordered on the order instead of driving stock negative.
+
+Verification (``strict=True``) reports a bad pickup location or delivery
+address as a ``FulfillmentError``. The webhook and the reconciler have no
+one to report to, so they record the order without it.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import stock
+from .models import Cart, CartItem, DeliveryAddress, Ingredient, Membership, Order, OrderItem, PaymentIntent, PickupLocation, Subscription, Tea
+from .serializers import DeliveryAddressSerializer
+
+SUBSCRIPTION_PERIOD = timedelta(days=30)
+
+
+class FulfillmentError(Exception):
+    def __init__(self, message, status=400, details=None):
+        super().__init__(message)
+        self.message, self.status, self.details = message, status, details
+
+
+def _pickup_name(order_data, strict):
+    try:
+        pickup = PickupLocation.objects.get(id=order_data['pickup_id'])
+    except PickupLocation.DoesNotExist:
+        if strict:
+            raise FulfillmentError('Pickup location not found', status=404)
+        return ''
+    return f'{pickup.name} - {pickup.branch}'
+
+
+def _delivery_address(user, order_data, strict):
+    address_id = order_data.get('delivery_address_id')
+    if address_id:
+        address = DeliveryAddress.objects.filter(id=address_id, user=user).first()
+        if address is None and strict:
+            raise FulfillmentError('Delivery address not found', status=404)
+        return address
+    serializer = DeliveryAddressSerializer(data={
+        field: order_data.get(field) for field in ('address_line1', 'address_line2', 'city', 'state', 'zip_code')
+    })
+    if serializer.is_valid():
+        return serializer.save(user=user)
+    if strict:
+        raise FulfillmentError('Invalid delivery address', details=serializer.errors)
+    return None
+
+
+def _paid_lines(intent):
+    """(tea, ingredient, quantity) for the cart lines saved on ``intent``"""
+    teas = Tea.objects.in_bulk([line['tea'] for line in intent.items if line.get('tea')])
+    ingredients = Ingredient.objects.in_bulk([line['ingredient'] for line in intent.items if line.get('ingredient')])
+    lines = []
+    for line in intent.items:
+        ingredient = ingredients.get(line.get('ingredient'))
+        tea = None if ingredient else teas.get(line.get('tea'))
+        if tea is None and ingredient is None:
+            raise FulfillmentError('A paid product no longer exists')
+        lines.append((tea, ingredient, line['quantity']))
+    return lines
+
+
+def _product_key(tea, ingredient):
+    return ('ingredient', ingredient.pk) if ingredient else ('tea', tea.pk)
+
+
+def _take_from_cart(cart_items, lines):
+    """Remove the paid ``lines`` from the cart; return the reservations they used, as unsaved CartItems"""
+    held = {}
+    for item in cart_items:
+        held.setdefault(_product_key(item.tea, item.ingredient), []).append(item)
+    reserved, changed = [], set()
+    for tea, ingredient, quantity in lines:
+        for item in held.get(_product_key(tea, ingredient), ()):
+            taken = min(quantity, item.quantity)
+            if not taken:
+                continue
+            reserved.append(CartItem(tea=tea, ingredient=ingredient, quantity=taken))
+            item.quantity -= taken
+            quantity -= taken
+            changed.add(item.pk)
+    CartItem.objects.filter(pk__in=[item.pk for item in cart_items if item.pk in changed and not item.quantity]).delete()
+    for item in cart_items:
+        if item.pk in changed and item.quantity:
+            CartItem.objects.filter(pk=item.pk).update(quantity=item.quantity)
+    return reserved
+
+
+def _backorder(order, items, short):
+    """Record on the order which paid units stock could not cover"""
+    for item in items:
+        product = item.ingredient or item.tea
+        missing = min(item.quantity, short.get((type(product), product.pk), 0))
+        if missing:
+            short[(type(product), product.pk)] -= missing
+            OrderItem.objects.filter(pk=item.pk).update(backordered=missing)
+    Order.objects.filter(pk=order.pk).update(backordered=True)
+    order.backordered = True
+
+
+def create_order(user, reference, order_data, strict=True):
+    """Order for the paid charge ``reference``; returns (order, created)"""
+    existing = Order.objects.filter(payment_reference=reference).first()
+    if existing is not None:
+        mark_intent(reference, 'fulfilled')
+        return existing, False
+
+    cart = Cart.objects.filter(user=user).first()
+    cart_items = list(cart.items.select_related('tea', 'ingredient')) if cart else []
+    intent = PaymentIntent.objects.filter(reference=reference, kind='order').first()
+    if intent is not None and intent.items:
+        lines, total_price = _paid_lines(intent), intent.amount
+    else:
+        if cart is None:
+            raise FulfillmentError('Cart not found', status=404)
+        lines = [(item.tea, item.ingredient, item.quantity) for item in cart_items]
+        total_price = Decimal(str(order_data.get('total_price', '0')))
+    if not lines:
+        raise FulfillmentError('Cart is empty')
+
+    delivery_type = order_data.get('delivery_type', 'pickup')
+    pickup_name, address = None, None
+    if delivery_type == 'pickup' and order_data.get('pickup_id'):
+        pickup_name = _pickup_name(order_data, strict)
+    elif delivery_type == 'delivery':
+        address = _delivery_address(user, order_data, strict)
+
+    try:
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=user,
+                total_price=total_price,
+                delivery_type=delivery_type,
+                pickup_location=pickup_name or (address.address_line1 if address else ''),
+                delivery_address_line1=address.address_line1 if address else None,
+                delivery_address_line2=address.address_line2 if address else None,
+                delivery_city=address.city if address else None,
+                delivery_state=address.state if address else None,
+                delivery_zip_code=address.zip_code if address else None,
+                delivery_fee=Decimal(str(order_data.get('delivery_fee', '0'))),
+                payment_reference=reference,
+                payment_status='paid',
+            )
+            sold = []
+            for tea, ingredient, quantity in lines:
+                if ingredient:
+                    sold.append(OrderItem.objects.create(order=order, ingredient=ingredient, quantity=quantity))
+                else:
+                    sold.append(OrderItem.objects.create(order=order, tea=tea, quantity=quantity))
+            # The reservations become sales, and the paid lines leave the cart
+            short = stock.sell_paid(sold, _take_from_cart(cart_items, lines), reference=f'order:{order.id}')
+            if short:
+                _backorder(order, sold, short)
+    except IntegrityError:
+        # Another worker fulfilled the same reference first
+        return Order.objects.get(payment_reference=reference), False
+    mark_intent(reference, 'fulfilled')
+    return order, True
+
+
+def activate_subscription(user, membership, reference, amount_paid):
+    """Activate ``membership`` for the user, paid by ``reference``; returns (subscription, created)"""
+    existing = Subscription.objects.filter(payment_reference=reference).first()
+    if existing is not None:
+        mark_intent(reference, 'fulfilled')
+        return existing, False
+
+    paid = {
+        'payment_reference': reference,
+        'payment_status': 'paid',
+        'amount_paid': amount_paid,
+        'renewal_date': timezone.now() + SUBSCRIPTION_PERIOD,
+        'status': 'active',
+    }
+    subscription, created = Subscription.objects.get_or_create(user=user, membership=membership, defaults=paid)
+    if not created:
+        for field, value in paid.items():
+            setattr(subscription, field, value)
+        subscription.save()
+    mark_intent(reference, 'fulfilled')
+    return subscription, created
+
+
+def fulfill_charge(charge, user):
+    """Materialize a successful charge (the ``data`` of a verify call or webhook) for ``user``.
+
+    The metadata set when the payment was initialized says what was bought.
+    Returns the order or subscription, or None if the metadata names nothing.
+    """
+    reference = charge.get('reference')
+    metadata = charge.get('metadata') or {}
+    kind = metadata.get('type') or metadata.get('payment_type')
+
+    if kind == 'membership' or metadata.get('membership_id'):
+        membership = Membership.objects.filter(id=metadata.get('membership_id') or metadata.get('membership')).first()
+        if membership is None:
+            return None
+        amount_paid = Decimal(str(charge.get('amount', 0) / 100))  # kobo -> naira
+        return activate_subscription(user, membership, reference, amount_paid)[0]
+    if kind == 'order' or metadata.get('order_data'):
+        return create_order(user, reference, metadata.get('order_data') or {}, strict=False)[0]
+    return None
+
+
+def mark_intent(reference, status, note=''):
+    PaymentIntent.objects.filter(reference=reference, status__in=PaymentIntent.OPEN_STATUSES).update(
+        status=status, note=note[:255], checked_at=timezone.now())
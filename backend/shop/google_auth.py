@@ -0,0 +1,127 @@
+"""Google ID-token verification with cached signing certificates.
+
+`google.oauth2.id_token.verify_oauth2_token` downloads Google's certs on
+every call. `GoogleTokenVerifier` keeps them until the expiry Google sends
+in Cache-Control, refreshes them once for all waiting threads, and reuses
+one pooled HTTP session for certs and userinfo calls.
+"""
+import re
+import threading
+import time
+
+import requests
+from django.conf import settings
+from google.auth import jwt
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+GOOGLE_USERINFO_URL = 'https://www.googleapis.com/oauth2/v3/userinfo'
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+VERIFY_SECONDS = metrics.histogram(
+    'google_id_token_verify_seconds', 'Google ID-token verification latency', ['outcome'])
+CERT_FETCHES = metrics.counter(
+    'google_certs_fetch_total', 'Downloads of Google signing certificates', ['outcome'])
+
+
+def pooled_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class GoogleTokenVerifier:
+    # Used when Google sends no usable Cache-Control header
+    default_ttl = 3600
+    # Unknown key ids trigger a refresh, but no more often than this
+    min_refresh_interval = 60
+    timeout = 5
+
+    def __init__(self, audience, session=None, certs_url=GOOGLE_CERTS_URL, clock=time.time):
+        self.audience = audience
+        self.session = session or pooled_session()
+        self.certs_url = certs_url
+        self.clock = clock
+        self._certs = None
+        self._expires_at = 0
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+
+    def certs(self, force=False):
+        """Return {key id: PEM certificate}, downloading only when expired"""
+        if not force and self._certs is not None and self.clock() < self._expires_at:
+            return self._certs
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            now = self.clock()
+            if self._certs is not None:
+                if force and now - self._fetched_at < self.min_refresh_interval:
+                    return self._certs
+                if not force and now < self._expires_at:
+                    return self._certs
+            self._certs, self._expires_at = self._fetch_certs(now)
+            self._fetched_at = now
+            return self._certs
+
+    def _fetch_certs(self, now):
+        try:
+            response = self.session.get(self.certs_url, timeout=self.timeout)
+            if response.status_code != 200:
+                raise ValueError(f'Could not fetch Google certificates (HTTP {response.status_code})')
+            certs = response.json()
+        except Exception:
+            CERT_FETCHES.inc(outcome='error')
+            raise
+        CERT_FETCHES.inc(outcome='ok')
+
+        match = MAX_AGE_RE.search(response.headers.get('Cache-Control', ''))
+        ttl = int(match.group(1)) if match else self.default_ttl
+        ttl -= int(response.headers.get('Age', 0) or 0)
+        return certs, now + max(ttl, 0)
+
+    def verify(self, token):
+        """Return the claims of a valid Google ID token; raise ValueError otherwise"""
+        start = time.perf_counter()
+        outcome = 'invalid'
+        try:
+            try:
+                claims = jwt.decode(token, certs=self.certs(), audience=self.audience, clock_skew_in_seconds=10)
+            except ValueError as e:
+                if 'Certificate for key id' not in str(e):
+                    raise
+                # Google rotated its keys before our cached copy expired
+                claims = jwt.decode(token, certs=self.certs(force=True), audience=self.audience,
+                                    clock_skew_in_seconds=10)
+            if claims.get('iss') not in GOOGLE_ISSUERS:
+                raise ValueError(f"Wrong issuer: {claims.get('iss')}")
+            outcome = 'valid'
+            return claims
+        finally:
+            VERIFY_SECONDS.observe(time.perf_counter() - start, outcome=outcome)
+
+    def user_info(self, access_token):
+        """Fetch the profile for an OAuth access token over the pooled session"""
+        response = self.session.get(GOOGLE_USERINFO_URL, timeout=self.timeout,
+                                    headers={'Authorization': f'Bearer {access_token}'})
+        if response.status_code != 200:
+            raise ValueError(f'Google rejected the access token (HTTP {response.status_code})')
+        return response.json()
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                _verifier = GoogleTokenVerifier(settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY)
+    return _verifier
@@ -0,0 +1,161 @@
+"""Idempotency-Key support for mutating endpoints.
+
+A client that may retry a request sends the same ``Idempotency-Key``
+header on every attempt. The first attempt runs the view and stores its
+response. Later attempts with the same key and an identical request get
+the stored response back (marked ``Idempotent-Replayed: true``) without
+running the view again. Reusing a key for a different request is a 422.
+
+If a duplicate arrives while the first attempt is still running, it
+waits up to IDEMPOTENCY_WAIT seconds for the result, then answers 409.
+An attempt holds the key for IDEMPOTENCY_LEASE seconds. If it is still
+unfinished after that, e.g. because its worker was killed, a retry takes
+the key over and runs the view. The stale attempt can then no longer store
+or release the record. Server errors (5xx or exceptions) are not stored, so
+the client can retry.
+Records expire after IDEMPOTENCY_TTL seconds; ``manage.py
+purge_idempotency_keys`` deletes them.
+
+Put ``@idempotent`` nearest the function so it runs after DRF has
+authenticated the request:
+
+    @api_view(['POST'])
+    @permission_classes([IsAuthenticated])
+    @idempotent
+    def place_order(request):
+"""
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import metrics
+from .models import IdempotencyRecord
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.1
+
+OUTCOMES = metrics.counter('idempotency_requests_total', 'Requests carrying an Idempotency-Key', ['outcome'])
+
+
+def ttl():
+    return timedelta(seconds=getattr(settings, 'IDEMPOTENCY_TTL', 24 * 3600))
+
+
+def lease():
+    return timedelta(seconds=getattr(settings, 'IDEMPOTENCY_LEASE', 120))
+
+
+def fingerprint(request):
+    digest = hashlib.sha256()
+    for part in (request.method.encode(), request.get_full_path().encode(), request.body):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def request_scope(request):
+    if request.user and request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def _replay(record):
+    OUTCOMES.inc(outcome='replayed')
+    response = Response(record.response_body, status=record.response_status)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(scope, key, digest, claimed_at):
+    """Create the processing record; return the existing record if the key is taken"""
+    try:
+        # Savepoint: keep a duplicate-key error from breaking an enclosing transaction
+        with transaction.atomic():
+            IdempotencyRecord.objects.create(scope=scope, key=key, fingerprint=digest, claimed_at=claimed_at)
+        return None
+    except IntegrityError:
+        record = IdempotencyRecord.objects.filter(scope=scope, key=key).first()
+        if record is None or record.created_at < timezone.now() - ttl():
+            # Expired (or just purged): start over
+            IdempotencyRecord.objects.filter(scope=scope, key=key).delete()
+            return _claim(scope, key, digest, claimed_at)
+        return record
+
+
+def _lease_expired(record):
+    return record.status == 'processing' and record.claimed_at < timezone.now() - lease()
+
+
+def _reclaim(record, claimed_at):
+    """Take over a key whose attempt outlived its lease; False if another retry got there first"""
+    if not _lease_expired(record):
+        return False
+    return IdempotencyRecord.objects.filter(
+        pk=record.pk, status='processing', claimed_at=record.claimed_at,
+    ).update(claimed_at=claimed_at) == 1
+
+
+def _wait_for(record):
+    deadline = time.monotonic() + getattr(settings, 'IDEMPOTENCY_WAIT', 10)
+    while record.status == 'processing' and not _lease_expired(record) and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        record = IdempotencyRecord.objects.filter(pk=record.pk).first()
+        if record is None:
+            # The first attempt failed and released the key
+            return None
+    return record
+
+
+def idempotent(view):
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'}, status=400)
+
+        scope, digest, claimed_at = request_scope(request), fingerprint(request), timezone.now()
+        record = _claim(scope, key, digest, claimed_at)
+        if record is not None:
+            if record.fingerprint != digest:
+                OUTCOMES.inc(outcome='mismatch')
+                return Response({'error': f'{HEADER} was already used for a different request'}, status=422)
+            record = _wait_for(record)
+            if record is None:
+                return wrapper(request, *args, **kwargs)
+            if record.status == 'done':
+                return _replay(record)
+            if not _reclaim(record, claimed_at):
+                OUTCOMES.inc(outcome='conflict')
+                return Response({'error': 'A request with this Idempotency-Key is still being processed'}, status=409)
+            OUTCOMES.inc(outcome='reclaimed')
+
+        # Only the attempt holding the claim may release or complete the record
+        owned = IdempotencyRecord.objects.filter(scope=scope, key=key, claimed_at=claimed_at)
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            owned.delete()
+            raise
+        if response.status_code >= 500 or not hasattr(response, 'data'):
+            owned.delete()
+            return response
+
+        # Store the JSON form so a replay renders exactly what the first attempt sent
+        body = json.loads(json.dumps(response.data, cls=JSONEncoder))
+        owned.update(
+            status='done', response_status=response.status_code, response_body=body,
+        )
+        OUTCOMES.inc(outcome='stored')
+        return response
+    return wrapper
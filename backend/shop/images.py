@@ -0,0 +1,143 @@
+"""Thumbnail generation for Tea and Ingredient images.
+
+Uploads are resized to a fixed set of widths and re-encoded as WebP/AVIF.
+Variant filenames embed a hash of the source bytes, so a URL never changes
+content and can be cached forever. The variant names are stored on the model
+in ``image_variants``:
+
+    {
+        "source": "teas/rose.jpeg",
+        "hash": "3f2a9c0d1b7e",
+        "webp": {"160": "thumbs/teas/rose.3f2a9c0d1b7e.160w.webp", ...},
+        "avif": {...},
+    }
+"""
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, features
+
+from .cache import catalog_cache
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTHS = getattr(settings, 'THUMBNAIL_WIDTHS', (160, 320, 640))
+THUMBNAIL_FORMATS = getattr(settings, 'THUMBNAIL_FORMATS', ('webp', 'avif'))
+THUMBNAIL_QUALITY = getattr(settings, 'THUMBNAIL_QUALITY', 75)
+THUMBNAIL_DIR = 'thumbs'
+
+# Formats Pillow can actually encode on this machine (AVIF needs libavif)
+AVAILABLE_FORMATS = tuple(fmt for fmt in THUMBNAIL_FORMATS if features.check(fmt))
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2),
+    thread_name_prefix='thumbnails',
+)
+
+
+def content_hash(data):
+    """Short content hash used in variant filenames"""
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def variant_name(source_name, digest, width, fmt):
+    stem, _ = os.path.splitext(source_name)
+    return f"{THUMBNAIL_DIR}/{stem}.{digest}.{width}w.{fmt}"
+
+
+def render_variants(source_name):
+    """Write every thumbnail for `source_name` to storage and return the variant map.
+
+    Runs in worker threads and in the backfill process pool, so it only
+    touches storage and never the database.
+    """
+    with default_storage.open(source_name, 'rb') as fh:
+        data = fh.read()
+
+    digest = content_hash(data)
+    variants = {'source': source_name, 'hash': digest}
+
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        # Never upscale; an image narrower than every width gets one variant at its own size
+        widths = [w for w in THUMBNAIL_WIDTHS if w < image.width] or [image.width]
+
+        for fmt in AVAILABLE_FORMATS:
+            variants[fmt] = {}
+            for width in widths:
+                name = variant_name(source_name, digest, width, fmt)
+                if not default_storage.exists(name):
+                    height = max(1, round(image.height * width / image.width))
+                    resized = image.resize((width, height), Image.LANCZOS)
+                    buffer = io.BytesIO()
+                    resized.save(buffer, format=fmt.upper(), quality=THUMBNAIL_QUALITY)
+                    saved = default_storage.save(name, ContentFile(buffer.getvalue()))
+                    if saved != name:
+                        # Another worker wrote the same variant first; keep theirs
+                        default_storage.delete(saved)
+                variants[fmt][str(width)] = name
+
+    return variants
+
+
+def needs_variants(instance):
+    if not instance.image:
+        return False
+    return (instance.image_variants or {}).get('source') != instance.image.name
+
+
+def store_variants(model, pk, source_name, variants):
+    # update() skips post_save, and the image filter drops results for a stale upload
+    if model.objects.filter(pk=pk, image=source_name).update(image_variants=variants):
+        catalog_cache.bump()
+
+
+def _generate(model, pk, source_name):
+    try:
+        store_variants(model, pk, source_name, render_variants(source_name))
+    except Exception:
+        logger.exception('Thumbnail generation failed for %s', source_name)
+    finally:
+        close_old_connections()
+
+
+def schedule_variants(instance):
+    """Generate thumbnails for `instance` after the current transaction commits.
+
+    Work is handed to a small thread pool so uploads return immediately;
+    set THUMBNAIL_ASYNC = False to render inline (tests, shell scripts).
+    """
+    model, pk, source_name = type(instance), instance.pk, instance.image.name
+
+    def run():
+        if getattr(settings, 'THUMBNAIL_ASYNC', True):
+            _executor.submit(_generate, model, pk, source_name)
+        else:
+            _generate(model, pk, source_name)
+
+    transaction.on_commit(run)
+
+
+def srcset(variants, request=None):
+    """Build `srcset` strings per format, e.g. {'webp': 'https://.../a.160w.webp 160w, ...'}"""
+    result = {}
+    for fmt in AVAILABLE_FORMATS:
+        entries = []
+        for width, name in sorted((variants or {}).get(fmt, {}).items(), key=lambda kv: int(kv[0])):
+            url = default_storage.url(name)
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            entries.append(f"{url} {width}w")
+        if entries:
+            result[fmt] = ', '.join(entries)
+    return result
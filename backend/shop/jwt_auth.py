@@ -0,0 +1,204 @@
+"""JWT authentication without a user query per request.
+
+Tokens issued by ``tokens_for()`` (login, register, Google OAuth, and the
+simplejwt/djoser token routes through the serializers below) carry the
+claims views need besides the user id: ``staff``, ``superuser`` and
+``tier`` (the active membership tier, or null). ``ClaimsJWTAuthentication``
+turns such a token into a ``ClaimsUser``. Its id, staff flags and
+membership tier come from the claims. The User row is loaded only when a
+view reads anything else. ``filter(user=request.user)`` uses the id
+without loading the row. Tokens without these claims still load the user
+as before, so older tokens keep working until they expire. Refreshing
+re-reads the claims from the database, so a changed staff flag or tier
+is visible within one access-token lifetime.
+
+``revoke(token)`` revokes one token by jti. ``revoke_user(user)`` revokes
+every token the user holds; it runs when an account is deactivated. Each
+process keeps the unexpired revocations in memory and reloads them every
+JWT_REVOCATION_REFRESH seconds. A revocation made on another worker
+therefore applies there within that window.
+"""
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import RevokedToken, Subscription
+
+CLAIMS = ('staff', 'superuser', 'tier')
+
+
+def token_user_id(token):
+    """The user id claim as a primary key value (simplejwt stores it as a string)"""
+    return User._meta.pk.to_python(token.get(api_settings.USER_ID_CLAIM))
+
+
+def claims_for(user):
+    tier = (Subscription.objects.filter(user_id=user.pk, status='active')
+            .values_list('membership__tier', flat=True).first())
+    return {'staff': user.is_staff, 'superuser': user.is_superuser, 'tier': tier}
+
+
+def refresh_token_for(user):
+    refresh = RefreshToken.for_user(user)
+    for claim, value in claims_for(user).items():
+        refresh[claim] = value
+    return refresh
+
+
+def tokens_for(user):
+    """{'access', 'refresh'} for a login response; the access token copies the refresh token's claims"""
+    refresh = refresh_token_for(user)
+    return {'access': str(refresh.access_token), 'refresh': str(refresh)}
+
+
+class ClaimsUser(SimpleLazyObject):
+    """request.user built from token claims; any other attribute loads the User row"""
+
+    def __init__(self, token):
+        user_id = token_user_id(token)
+
+        def load():
+            try:
+                return User.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+            except User.DoesNotExist:
+                raise AuthenticationFailed('User not found', code='user_not_found')
+
+        super().__init__(load)
+        self.__dict__.update(
+            id=user_id, pk=user_id, _meta=User._meta,
+            is_staff=token['staff'], is_superuser=token['superuser'], membership_tier=token['tier'],
+            is_active=True, is_authenticated=True, is_anonymous=False,
+        )
+
+    @property
+    def __class__(self):
+        # isinstance() checks and ORM lookups see a User without loading the row
+        return User
+
+    def __getattr__(self, name):
+        # Django probes values with hasattr() (e.g. resolve_expression); a User has no such attribute
+        if not name.startswith('_') and not hasattr(User, name):
+            raise AttributeError(name)
+        return super().__getattr__(name)
+
+    # LazyObject would load the row for these; answer like User does instead
+    def __bool__(self):
+        return True
+
+    def _is_pk_set(self):
+        # Related lookups (filter(user=request.user)) check this before reading the pk
+        return self.pk is not None
+
+    def __eq__(self, other):
+        return isinstance(other, User) and other.pk == self.pk
+
+    def __hash__(self):
+        return hash(self.pk)
+
+
+class RevocationList:
+    """In-process copy of the unexpired RevokedToken rows"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._jtis = frozenset()
+        self._cutoffs = {}  # user id -> tokens issued at or before this timestamp are revoked
+
+    def _refresh(self):
+        max_age = getattr(settings, 'JWT_REVOCATION_REFRESH', 30)
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < max_age:
+            return
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < max_age:
+                return
+            jtis, cutoffs = set(), {}
+            rows = RevokedToken.objects.filter(expires_at__gt=timezone.now()).values_list('jti', 'user_id', 'created_at')
+            for jti, user_id, created_at in rows:
+                if jti:
+                    jtis.add(jti)
+                else:
+                    cutoffs[user_id] = max(cutoffs.get(user_id, 0), created_at.timestamp())
+            self._jtis, self._cutoffs, self._loaded_at = frozenset(jtis), cutoffs, time.monotonic()
+
+    def is_revoked(self, token):
+        self._refresh()
+        if token.get(api_settings.JTI_CLAIM) in self._jtis:
+            return True
+        cutoff = self._cutoffs.get(token_user_id(token))
+        return cutoff is not None and token.get('iat', 0) <= cutoff
+
+    def add(self, row):
+        with self._lock:
+            if row.jti:
+                self._jtis = self._jtis | {row.jti}
+            else:
+                self._cutoffs = {**self._cutoffs, row.user_id: row.created_at.timestamp()}
+
+    def clear(self):
+        """Forget everything; the next check reloads from the database"""
+        with self._lock:
+            self._loaded_at, self._jtis, self._cutoffs = None, frozenset(), {}
+
+
+revocations = RevocationList()
+
+
+def revoke(token):
+    """Revoke one access or refresh token until it expires"""
+    row = RevokedToken.objects.create(
+        jti=token[api_settings.JTI_CLAIM], user_id=token_user_id(token),
+        expires_at=datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc),
+    )
+    revocations.add(row)
+
+
+def revoke_user(user):
+    """Revoke every token issued to ``user`` until now"""
+    row, _ = RevokedToken.objects.update_or_create(
+        user=user, jti='',
+        defaults={'created_at': timezone.now(),
+                  'expires_at': timezone.now() + api_settings.REFRESH_TOKEN_LIFETIME},
+    )
+    revocations.add(row)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if revocations.is_revoked(validated_token):
+            raise AuthenticationFailed('Token has been revoked', code='token_revoked')
+        if all(claim in validated_token for claim in CLAIMS):
+            return ClaimsUser(validated_token)
+        return super().get_user(validated_token)
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return refresh_token_for(user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """Issue the access token with the user's current claims; revoked refresh tokens are refused"""
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        if revocations.is_revoked(refresh):
+            raise AuthenticationFailed('Token has been revoked', code='token_revoked')
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: token_user_id(refresh)}).first()
+        if not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+        access = refresh.access_token
+        for claim, value in claims_for(user).items():
+            access[claim] = value
+        return {'access': str(access)}
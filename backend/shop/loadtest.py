@@ -0,0 +1,365 @@
+"""Load-test harness for the checkout flow.
+
+Virtual users run browse -> add_to_cart -> initiate_payment -> webhook
+against a live server over HTTP. Paystack is replaced by `PaystackStub`, a
+local HTTP server the backend reaches through PAYSTACK_API_BASE, and the
+harness delivers signed ``charge.success`` webhooks itself. Stock is
+checked directly in the database before and after the run, so the harness
+must use the same database as the server. See ``manage.py loadtest``.
+
+Checkout calls answered by the waiting room (shop/admission.py) are not
+errors: the virtual user polls the queue like a real client and repeats
+the call with its ticket. Those answers are counted as ``queued`` and the
+time spent in line is reported per step. Run the server with
+ADMISSION_ENABLED=False to measure it without the waiting room.
+"""
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+
+from . import benchmarks, stock
+from .models import CartItem, OrderItem, Tea
+
+
+class PaystackStub:
+    """Minimal stand-in for the Paystack transaction API.
+
+    Remembers every initialized transaction so verify calls and the
+    harness's webhooks can return the original metadata.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, latency=0.0):
+        self.transactions = {}
+        self.lock = threading.Lock()
+        self.latency = latency
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, payload, code=200):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                time.sleep(stub.latency)
+                if self.path.rstrip('/') != '/transaction/initialize':
+                    return self._reply({'status': False, 'message': 'Not found'}, 404)
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                reference = payload.get('reference') or uuid.uuid4().hex
+                with stub.lock:
+                    stub.transactions[reference] = payload
+                self._reply({'status': True, 'message': 'Authorization URL created', 'data': {
+                    'authorization_url': f'https://checkout.paystack.test/{reference}',
+                    'access_code': uuid.uuid4().hex[:12], 'reference': reference,
+                }})
+
+            def do_GET(self):
+                time.sleep(stub.latency)
+                prefix = '/transaction/verify/'
+                if not self.path.startswith(prefix):
+                    return self._reply({'status': False, 'message': 'Not found'}, 404)
+                reference = self.path[len(prefix):]
+                with stub.lock:
+                    payload = stub.transactions.get(reference)
+                if payload is None:
+                    return self._reply({'status': False, 'message': 'Transaction reference not found'}, 400)
+                self._reply({'status': True, 'data': stub.charge(reference, payload)})
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @staticmethod
+    def charge(reference, payload):
+        # A stored transaction may carry 'stub_status' to play a failed or abandoned charge
+        return {'status': payload.get('stub_status', 'success'), 'reference': reference,
+                'amount': payload.get('amount', 0), 'metadata': payload.get('metadata', {})}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _ms(values, pct):
+    return round(benchmarks.percentile(values, pct), 1) if values else None
+
+
+class Stats:
+    """Per-step latencies and statuses.
+
+    Waiting-room answers are recorded with status 'queued': they count as
+    requests but not as errors, and stay out of the latency percentiles,
+    which describe served requests. ``record_wait`` adds the time a call
+    spent in line before it was served.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.waits = defaultdict(list)
+
+    def record(self, step, status, elapsed):
+        with self.lock:
+            self.statuses[step][status] += 1
+            if status != 'queued':
+                self.latencies[step].append(elapsed * 1000)
+            if status in ('error', 'queue_timeout') or (isinstance(status, int) and status >= 500):
+                self.errors[step] += 1
+
+    def record_wait(self, step, waited):
+        with self.lock:
+            self.waits[step].append(waited * 1000)
+
+    def report(self, elapsed):
+        rows = []
+        total = sum(sum(counts.values()) for counts in self.statuses.values())
+        for step, counts in self.statuses.items():
+            values, requests = self.latencies[step], sum(counts.values())
+            rows.append({
+                'step': step,
+                'requests': requests,
+                'rps': round(requests / elapsed, 1),
+                'p50_ms': _ms(values, 50),
+                'p95_ms': _ms(values, 95),
+                'errors': self.errors[step],
+                'queued': counts.get('queued', 0),
+                'queue_wait_p95_ms': _ms(self.waits[step], 95),
+                'statuses': dict(counts),
+            })
+        return {'elapsed_s': round(elapsed, 2), 'requests': total, 'throughput_rps': round(total / elapsed, 1),
+                'error_rate': round(sum(self.errors.values()) / total, 4) if total else 0.0,
+                'queued': sum(row['queued'] for row in rows), 'steps': rows}
+
+
+def stock_snapshot():
+    """Per tea: available stock plus quantities held in carts and sold in orders.
+
+    Stock is moved into carts on add and carts become orders at checkout,
+    so the sum of the three must not change during a run. Available stock
+    comes from the ledger, so a compaction during the run does not matter.
+    """
+    in_carts = dict(CartItem.objects.filter(tea__isnull=False).values_list('tea').annotate(q=Sum('quantity')))
+    in_orders = dict(OrderItem.objects.filter(tea__isnull=False).values_list('tea').annotate(q=Sum('quantity')))
+    return {
+        tea_id: {'stock': available, 'total': available + in_carts.get(tea_id, 0) + in_orders.get(tea_id, 0)}
+        for tea_id, available in stock.with_available_stock(Tea.objects.all()).values_list('id', 'available_stock')
+    }
+
+
+def stock_violations(before, after):
+    problems = []
+    for tea_id, snap in after.items():
+        if snap['stock'] < 0:
+            problems.append(f'tea {tea_id}: negative stock {snap["stock"]}')
+        if tea_id in before and snap['total'] != before[tea_id]['total']:
+            problems.append(f'tea {tea_id}: stock+carts+orders {before[tea_id]["total"]} -> {snap["total"]}')
+    return problems
+
+
+class LockSampler(threading.Thread):
+    """Sample sessions waiting on row/table locks (PostgreSQL only)"""
+
+    def __init__(self, interval=0.5):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        from django.db import connections
+        conn = connections.create_connection('default')
+        try:
+            while not self.stopped.wait(self.interval):
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'")
+                    self.samples.append(cursor.fetchone()[0])
+        finally:
+            conn.close()
+
+    def summary(self):
+        if not self.samples:
+            return {'max_waiting': 0, 'avg_waiting': 0.0}
+        return {'max_waiting': max(self.samples), 'avg_waiting': round(sum(self.samples) / len(self.samples), 2)}
+
+
+def queue_ticket(response):
+    """The ticket of a waiting-room 503 (see shop/admission.py), else None"""
+    if response is None or response.status_code != 503:
+        return None
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    return body.get('ticket') if body.get('queued') else None
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, harness, username):
+        super().__init__(daemon=True)
+        self.harness = harness
+        self.username = username
+        self.session = requests.Session()
+
+    def call(self, step, method, path, **kwargs):
+        """Send one request; a waiting-room answer waits in line and repeats it with the ticket"""
+        stats, queued_at = self.harness.stats, None
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, self.harness.base_url + path, timeout=30, **kwargs)
+                status = response.status_code
+            except requests.RequestException:
+                response, status = None, 'error'
+            ticket = queue_ticket(response)
+            if ticket is None:
+                stats.record(step, status, time.perf_counter() - start)
+                if queued_at is not None:
+                    stats.record_wait(step, time.perf_counter() - queued_at)
+                return response
+
+            stats.record(step, 'queued', time.perf_counter() - start)
+            if queued_at is None:
+                queued_at = time.perf_counter()
+            if not self.wait_in_line(ticket, response.json().get('retry_after', 1), queued_at):
+                stats.record(step, 'queue_timeout', 0.0)
+                return None
+            kwargs['headers'] = {**kwargs.get('headers', {}), 'X-Queue-Ticket': ticket}
+
+    def wait_in_line(self, ticket, retry_after, queued_at):
+        """Poll the queue until the ticket is admitted; False if it takes longer than max_queue_wait"""
+        h = self.harness
+        while time.perf_counter() - queued_at + retry_after <= h.max_queue_wait:
+            time.sleep(retry_after)
+            start = time.perf_counter()
+            try:
+                response = self.session.get(f'{h.base_url}/api/checkout/queue/', params={'ticket': ticket}, timeout=30)
+                h.stats.record('queue_status', response.status_code, time.perf_counter() - start)
+            except requests.RequestException:
+                h.stats.record('queue_status', 'error', time.perf_counter() - start)
+                continue
+            if response.status_code != 200:
+                return False
+            body = response.json()
+            if body['admitted']:
+                return True
+            retry_after = body['retry_after']
+        return False
+
+    def run(self):
+        h = self.harness
+        response = self.call('login', 'POST', '/api/token/', json={'username': self.username, 'password': h.password})
+        if response is None or response.status_code != 200:
+            return
+        self.session.headers['Authorization'] = f"Bearer {response.json()['access']}"
+
+        for _ in range(h.iterations):
+            if h.scenario == 'checkout':
+                self.call('browse', 'GET', '/api/teas/')
+                tea_id = h.rng_choice(h.tea_ids)
+                self.call('tea_detail', 'GET', f'/api/teas/{tea_id}/')
+            else:
+                tea_id = h.hot_tea_id
+            response = self.call('add_to_cart', 'POST', '/api/cart/add/', json={'tea_id': tea_id, 'quantity': 1})
+            if response is None or response.status_code != 201:
+                continue
+
+            response = self.call('initiate_payment', 'POST', '/api/payment/initiate/',
+                                 json={'delivery_type': 'pickup', 'pickup_id': h.pickup_id})
+            if response is None or response.status_code != 200:
+                continue
+            h.deliver_webhook(self, response.json()['reference'])
+            time.sleep(h.think_time)
+
+
+class LoadTest:
+    def __init__(self, base_url, stub, usernames, password, tea_ids, pickup_id, scenario='checkout',
+                 iterations=5, think_time=0.0, hot_tea_id=None, max_queue_wait=60.0):
+        self.base_url = base_url.rstrip('/')
+        self.stub = stub
+        self.usernames = usernames
+        self.password = password
+        self.tea_ids = tea_ids
+        self.pickup_id = pickup_id
+        self.scenario = scenario
+        self.iterations = iterations
+        self.think_time = think_time
+        self.hot_tea_id = hot_tea_id
+        self.max_queue_wait = max_queue_wait
+        self.stats = Stats()
+        self._rng = random.Random(7)
+        self._rng_lock = threading.Lock()
+
+    def rng_choice(self, seq):
+        with self._rng_lock:
+            return self._rng.choice(seq)
+
+    def deliver_webhook(self, user, reference):
+        with self.stub.lock:
+            payload = self.stub.transactions.get(reference)
+        if payload is None:
+            self.stats.record('webhook', 'error', 0.0)
+            return
+        body = json.dumps({'event': 'charge.success', 'data': self.stub.charge(reference, payload)}).encode('utf-8')
+        signature = hmac.new(settings.PAYSTACK_SECRET_KEY.encode('utf-8'), body, hashlib.sha512).hexdigest()
+        user.call('webhook', 'POST', '/api/payment/webhook/', data=body,
+                  headers={'Content-Type': 'application/json', 'X-Paystack-Signature': signature})
+
+    def scrape_lock_errors(self, metrics_token):
+        if not metrics_token:
+            return None
+        try:
+            text = requests.get(f'{self.base_url}/api/metrics/', timeout=10,
+                                headers={'Authorization': f'Bearer {metrics_token}'}).text
+        except requests.RequestException:
+            return None
+        return sum(float(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+                   if line.startswith('db_lock_errors_total'))
+
+    def run(self, metrics_token=''):
+        before = stock_snapshot()
+        lock_errors_before = self.scrape_lock_errors(metrics_token)
+        sampler = LockSampler() if connection.vendor == 'postgresql' else None
+        if sampler:
+            sampler.start()
+
+        users = [VirtualUser(self, name) for name in self.usernames]
+        start = time.perf_counter()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.perf_counter() - start
+
+        if sampler:
+            sampler.stopped.set()
+            sampler.join()
+        lock_errors_after = self.scrape_lock_errors(metrics_token)
+
+        report = self.stats.report(elapsed)
+        report['stock_violations'] = stock_violations(before, stock_snapshot())
+        report['db_lock_waits'] = sampler.summary() if sampler else {}
+        if lock_errors_before is not None and lock_errors_after is not None:
+            report['db_lock_waits']['lock_errors'] = int(lock_errors_after - lock_errors_before)
+        return report
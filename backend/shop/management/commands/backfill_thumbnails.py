@@ -0,0 +1,43 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+
+from shop.images import needs_variants, render_variants, store_variants
+from shop.models import Tea, Ingredient
+
+
+class Command(BaseCommand):
+    help = 'Generate WebP/AVIF thumbnails for existing Tea and Ingredient images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Worker processes (default: one per CPU)')
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate variants even when they are up to date')
+
+    def handle(self, *args, **options):
+        jobs = []
+        for model in (Tea, Ingredient):
+            for obj in model.objects.exclude(image='').exclude(image__isnull=True).only('id', 'image', 'image_variants'):
+                if options['force'] or needs_variants(obj):
+                    jobs.append((model, obj.pk, obj.image.name))
+
+        if not jobs:
+            self.stdout.write('All images already have thumbnails')
+            return
+
+        done = failed = 0
+        # Workers only render files; the parent process writes results to the database
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+            futures = {pool.submit(render_variants, name): (model, pk, name) for model, pk, name in jobs}
+            for future in as_completed(futures):
+                model, pk, name = futures[future]
+                try:
+                    store_variants(model, pk, name, future.result())
+                    done += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{model.__name__} {pk} ({name}): {e}')
+
+        self.stdout.write(self.style.SUCCESS(f'Generated thumbnails for {done} images ({failed} failed)'))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from shop import benchmarks, factories
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database, benchmark every API endpoint and compare '
+            'query counts and p95 latency against the JSON baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--volume', choices=sorted(factories.VOLUMES), default='small')
+        parser.add_argument('--repeat', type=int, default=20, help='Calls per endpoint')
+        parser.add_argument('--latency-threshold', type=float, default=1.0,
+                            help='Allowed relative p95 increase before failing (default: 1.0 = +100%%)')
+        parser.add_argument('--skip', nargs='*', default=[], metavar='URL_NAME',
+                            help='URL names to leave out, e.g. order-list on very large volumes')
+        parser.add_argument('--baseline', default=str(benchmarks.BASELINE_PATH))
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Write the results as the new baseline instead of comparing')
+
+    def handle(self, *args, **options):
+        volume = options['volume']
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write(f'Seeding {volume} data set...')
+            ctx = factories.seed(volume)
+            endpoints = [e for e in benchmarks.ENDPOINTS if e.name not in options['skip']]
+            results = benchmarks.run(ctx, repeat=options['repeat'], endpoints=endpoints)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"{'endpoint':<50} {'status':>6} {'queries':>7} {'p50 ms':>8} {'p95 ms':>8} {'bytes':>9}")
+        for key, r in sorted(results.items()):
+            self.stdout.write(f"{key:<50} {r['status']:>6} {r['queries']:>7} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['bytes']:>9}")
+
+        if options['update_baseline']:
+            benchmarks.save_baseline(volume, results, options['baseline'])
+            self.stdout.write(self.style.SUCCESS(f"Baseline for '{volume}' written to {options['baseline']}"))
+            return
+
+        baseline = benchmarks.load_baseline(options['baseline']).get(volume)
+        if not baseline:
+            raise CommandError(f"No '{volume}' baseline in {options['baseline']}; run with --update-baseline")
+        problems = benchmarks.compare(results, baseline, options['latency_threshold'])
+        if problems:
+            raise CommandError('Performance regressions:\n  ' + '\n  '.join(problems))
+        self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
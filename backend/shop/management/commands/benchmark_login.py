@@ -0,0 +1,67 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from rest_framework.test import APIClient
+
+from shop import benchmarks
+from shop.factories import PASSWORD
+
+
+class Command(BaseCommand):
+    help = ('Measure /api/auth/login/ throughput on a throwaway test database. '
+            'Login cost is dominated by password hashing, so logins per CPU-second '
+            'is the per-core capacity to size workers against.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=50)
+        parser.add_argument('--users', type=int, default=1000, help='Accounts in auth_user')
+        parser.add_argument('--iterations', type=int, nargs='*', default=[],
+                            help='PBKDF2 iteration counts to compare (default: PASSWORD_HASH_ITERATIONS)')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self._seed(options['users'])
+            settings_list = [{'PASSWORD_HASH_ITERATIONS': n} for n in options['iterations']] or [{}]
+            self.stdout.write(f"{'iterations':>10} {'logins/s':>9} {'per core':>9} {'p50 ms':>8} {'p95 ms':>8} {'queries':>7}")
+            for overrides in settings_list:
+                with override_settings(**overrides):
+                    self._run(options['logins'], options['users'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _seed(self, count):
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username=f'login{i}', email=f'Login{i}@Example.com', password=password) for i in range(count)
+        ], batch_size=1000)
+
+    def _run(self, logins, users):
+        client = APIClient()
+        # Move every stored hash to the iteration count under test
+        User.objects.update(password=make_password(PASSWORD))
+
+        latencies, queries = [], 0
+        wall, cpu = time.perf_counter(), time.process_time()
+        for i in range(logins):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                response = client.post('/api/auth/login/', {'email': f'login{i % users}@example.com',
+                                                             'password': PASSWORD}, format='json')
+                latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                self.stderr.write(f'Login failed with {response.status_code}: {response.content[:200]!r}')
+                return
+            queries = max(queries, len(ctx.captured_queries))
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        self.stdout.write(f'{settings.PASSWORD_HASH_ITERATIONS:>10} {logins / wall:>9.1f} {logins / cpu:>9.1f} '
+                          f'{benchmarks.percentile(latencies, 50):>8.1f} {benchmarks.percentile(latencies, 95):>8.1f} '
+                          f'{queries:>7}')
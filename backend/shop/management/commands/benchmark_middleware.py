@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils.module_loading import import_string
+
+from mybrutea_backend.middleware import HeaderAuthBypassMixin
+from shop import benchmarks, factories
+
+# Header-authenticated API calls, plus an anonymous one that keeps the full stack
+ENDPOINT_KEYS = ('GET get_user_cart', 'GET user_profile', 'POST initiate_payment',
+                 'POST initiate_membership_payment', 'GET tea-list')
+
+
+def full_middleware():
+    """settings.MIDDLEWARE with every header-auth bypass swapped back for the Django class it wraps"""
+    paths = []
+    for path in settings.MIDDLEWARE:
+        cls = import_string(path)
+        if issubclass(cls, HeaderAuthBypassMixin):
+            base = cls.__mro__[cls.__mro__.index(HeaderAuthBypassMixin) + 1]
+            path = f'{base.__module__}.{base.__qualname__}'
+        paths.append(path)
+    return paths
+
+
+class Command(BaseCommand):
+    help = ('Compare per-request latency and queries of token/JWT API calls with the full Django '
+            'middleware stack and with the session-free API profile, on a throwaway test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        endpoints = [e for e in benchmarks.ENDPOINTS if e.key in ENDPOINT_KEYS]
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            ctx = factories.seed('small')
+            results = {}
+            for profile, middleware in (('full', full_middleware()), ('api', settings.MIDDLEWARE)):
+                # Roll back so both profiles start from the same carts and orders
+                with override_settings(MIDDLEWARE=middleware), transaction.atomic():
+                    results[profile] = benchmarks.run(ctx, repeat=options['repeat'], endpoints=endpoints)
+                    transaction.set_rollback(True)
+
+            self.stdout.write(f"{'endpoint':<36} {'full p50':>9} {'api p50':>9} {'full q':>7} {'api q':>6}")
+            for key, full in results['full'].items():
+                api = results['api'][key]
+                self.stdout.write(f"{key:<36} {full['p50_ms']:>9.2f} {api['p50_ms']:>9.2f} "
+                                  f"{full['queries']:>7} {api['queries']:>6}")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
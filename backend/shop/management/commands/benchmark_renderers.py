@@ -0,0 +1,55 @@
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from shop import benchmarks, factories
+from shop.renderers import MessagePackRenderer, ORJSONRenderer, msgpack, orjson
+
+PAYLOADS = ('/api/teas/', '/api/orders/')
+
+
+class Command(BaseCommand):
+    help = ('Compare render time and body size of the API renderers on the /teas/ and /orders/ '
+            'payloads, using a throwaway test database seeded at the given volume.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--volume', choices=sorted(factories.VOLUMES), default='small')
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        renderers = [('drf-json', JSONRenderer())]
+        if orjson is not None:
+            renderers.append(('orjson', ORJSONRenderer()))
+        else:
+            self.stderr.write('orjson is not installed; ORJSONRenderer would fall back to drf-json')
+        if msgpack is not None:
+            renderers.append(('msgpack', MessagePackRenderer()))
+        else:
+            self.stderr.write('msgpack is not installed; skipping MessagePackRenderer')
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            ctx = factories.seed(options['volume'])
+            client = APIClient()
+            client.force_authenticate(ctx['staff'])
+            self.stdout.write(f"{'payload':<14} {'renderer':<10} {'p50 ms':>8} {'p95 ms':>8} {'bytes':>10}")
+            for path in PAYLOADS:
+                cache.clear()
+                data = client.get(path).data
+                for name, renderer in renderers:
+                    timings = []
+                    for _ in range(options['repeat']):
+                        start = time.perf_counter()
+                        body = renderer.render(data, renderer.media_type, {})
+                        timings.append((time.perf_counter() - start) * 1000)
+                    self.stdout.write(f'{path:<14} {name:<10} {benchmarks.percentile(timings, 50):>8.2f} '
+                                      f'{benchmarks.percentile(timings, 95):>8.2f} {len(body):>10}')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
@@ -0,0 +1,71 @@
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+
+from shop import benchmarks, stock
+from shop.models import Tea
+
+
+class Command(BaseCommand):
+    help = ('Compare add-to-cart style reservations on one hot tea with single-row and sharded stock.\n\n'
+            'Runs concurrent threads against the configured database and deletes the scratch tea\n'
+            'afterwards. SQLite serializes all writers; run it against PostgreSQL for production numbers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--reservations', type=int, default=200, help='Reservations per thread')
+        parser.add_argument('--slots', type=int, default=stock.DEFAULT_SLOTS, help='Slots in sharded mode')
+
+    def handle(self, *args, **options):
+        total = options['threads'] * options['reservations']
+        self.stdout.write(f"{'mode':>10} {'res/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7} {'left':>7}")
+        results = {}
+        for mode, slots in (('single', 0), ('sharded', options['slots'])):
+            tea = Tea.objects.create(name=f'Contention benchmark ({mode})', description='Scratch row',
+                                     price=Decimal('1.00'), quantity_in_stock=total)
+            try:
+                if slots:
+                    stock.shard(tea, slots)
+                results[mode] = self._run(tea, options['threads'], options['reservations'])
+                rate, p50, p95, errors = results[mode]
+                self.stdout.write(f'{mode:>10} {rate:>8.0f} {p50:>8.1f} {p95:>8.1f} {errors:>7} '
+                                  f'{stock.available(Tea.objects.get(pk=tea.pk)):>7}')
+            finally:
+                tea.delete()
+        if results['single'][0]:
+            self.stdout.write(f"Sharded/single throughput: {results['sharded'][0] / results['single'][0]:.2f}x")
+
+    def _run(self, tea, threads, reservations):
+        latencies, errors, lock = [], [0], threading.Lock()
+        start_gate = threading.Barrier(threads)
+
+        def worker():
+            product = Tea.objects.get(pk=tea.pk)
+            mine, failed = [], 0
+            start_gate.wait()
+            for _ in range(reservations):
+                started = time.perf_counter()
+                try:
+                    # Same shape as add_to_cart: one transaction per reservation
+                    with transaction.atomic():
+                        stock.reserve(product, 1, reference='benchmark')
+                except (DatabaseError, stock.InsufficientStock):
+                    failed += 1
+                mine.append((time.perf_counter() - started) * 1000)
+            connection.close()
+            with lock:
+                latencies.extend(mine)
+                errors[0] += failed
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        ok = len(latencies) - errors[0]
+        return (ok / elapsed, benchmarks.percentile(latencies, 50), benchmarks.percentile(latencies, 95), errors[0])
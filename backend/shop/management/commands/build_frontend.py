@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop.assets import build_frontend
+
+
+class Command(BaseCommand):
+    help = 'Build the frontend with content-hashed asset names and gzip/brotli siblings'
+
+    def handle(self, *args, **options):
+        manifest = build_frontend(settings.FRONTEND_SOURCE_DIR, settings.FRONTEND_BUILD_DIR)
+        self.stdout.write(self.style.SUCCESS(
+            f'Built {len(manifest)} hashed assets into {settings.FRONTEND_BUILD_DIR}'
+        ))
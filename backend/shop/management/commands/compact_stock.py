@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop import stock
+
+
+class Command(BaseCommand):
+    help = 'Fold pending stock ledger movements into the product balances and rebalance sharded stock (run from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Movements folded per transaction')
+        parser.add_argument('--loop', type=float, metavar='SECONDS',
+                            help='Keep running, compacting every SECONDS')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            folded = stock.compact(batch_size=options['batch_size'])
+            rebalanced = stock.rebalance_all()
+            self.stdout.write(f'Compacted {folded} movements and rebalanced {rebalanced} sharded products '
+                              f'in {time.perf_counter() - started:.2f}s')
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
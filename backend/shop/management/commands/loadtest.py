@@ -0,0 +1,103 @@
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from shop import stock
+from shop.loadtest import LoadTest, PaystackStub
+from shop.models import PickupLocation, Tea
+
+PASSWORD = 'loadtest-pass-123'
+
+
+class Command(BaseCommand):
+    help = ('Run browse -> add_to_cart -> initiate_payment -> webhook load against a running server.\n\n'
+            'Start the server pointed at the stub and sharing this database, e.g.\n'
+            '  PAYSTACK_API_BASE=http://127.0.0.1:8765 THROTTLE_ENABLED=False gunicorn mybrutea_backend.wsgi -w 4\n'
+            'then run `manage.py loadtest --users 50`.\n\n'
+            'Checkout calls also pass through the waiting room (ADMISSION_RATE per second). Queued\n'
+            'users poll and retry like real clients; their 503s are reported as "queued", not as\n'
+            'errors. Add ADMISSION_ENABLED=False to the server environment to load it without the\n'
+            'waiting room.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+        parser.add_argument('--scenario', choices=['checkout', 'flash-sale'], default='checkout',
+                            help='flash-sale sends every user at one limited-stock tea')
+        parser.add_argument('--users', type=int, default=20, help='Concurrent virtual users')
+        parser.add_argument('--iterations', type=int, default=5, help='Checkout attempts per user')
+        parser.add_argument('--think-time', type=float, default=0.0, help='Seconds between iterations')
+        parser.add_argument('--hot-stock', type=int, default=50, help='Stock of the flash-sale tea')
+        parser.add_argument('--stub-port', type=int, default=8765)
+        parser.add_argument('--stub-latency', type=float, default=0.2, help='Simulated Paystack latency (s)')
+        parser.add_argument('--max-queue-wait', type=float, default=60.0,
+                            help='Seconds a virtual user waits in the checkout queue before giving up')
+        parser.add_argument('--metrics-token', default=getattr(settings, 'METRICS_TOKEN', ''),
+                            help='Scrape /api/metrics/ for database lock errors')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        usernames = self._seed_users(options['users'])
+        pickup, _ = PickupLocation.objects.get_or_create(
+            name='Load Test Hub', defaults={'address': '1 Test Road', 'city': 'Lagos', 'branch': 'Main',
+                                            'delivery_fee': Decimal('0.00')})
+        hot_tea = None
+        if options['scenario'] == 'flash-sale':
+            hot_tea, created = Tea.objects.get_or_create(
+                name='Flash Sale Blend', defaults={'description': 'Limited drop', 'price': Decimal('5000.00'),
+                                                   'quantity_in_stock': options['hot_stock']})
+            if not created:
+                stock.adjust(hot_tea, options['hot_stock'] - stock.available(hot_tea), reference='loadtest')
+        tea_ids = list(stock.with_available_stock(Tea.objects.all()).filter(available_stock__gt=0)
+                       .values_list('id', flat=True))
+
+        with PaystackStub(port=options['stub_port'], latency=options['stub_latency']) as stub:
+            test = LoadTest(
+                options['base_url'], stub, usernames, PASSWORD, tea_ids, pickup.id,
+                scenario=options['scenario'], iterations=options['iterations'],
+                think_time=options['think_time'], hot_tea_id=hot_tea.id if hot_tea else None,
+                max_queue_wait=options['max_queue_wait'],
+            )
+            report = test.run(metrics_token=options['metrics_token'])
+
+        if hot_tea:
+            hot_tea.refresh_from_db()
+            report['flash_sale'] = {'initial_stock': options['hot_stock'], 'final_stock': stock.available(hot_tea)}
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self._print(report)
+
+    def _seed_users(self, count):
+        usernames = [f'loadtest{i}' for i in range(count)]
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username=name, email=f'{name}@example.com', password=password)
+            for name in usernames if name not in existing
+        ])
+        return usernames
+
+    def _print(self, report):
+        self.stdout.write(f"{report['requests']} requests in {report['elapsed_s']}s: "
+                          f"{report['throughput_rps']} req/s, error rate {report['error_rate']:.2%}, "
+                          f"{report['queued']} queued")
+        self.stdout.write(f"{'step':<18} {'requests':>8} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'errors':>6} "
+                          f"{'queued':>6} {'wait p95':>9}  statuses")
+        for row in report['steps']:
+            self.stdout.write(f"{row['step']:<18} {row['requests']:>8} {row['rps']:>7} {str(row['p50_ms']):>8} "
+                              f"{str(row['p95_ms']):>8} {row['errors']:>6} {row['queued']:>6} "
+                              f"{str(row['queue_wait_p95_ms']):>9}  {row['statuses']}")
+        if report.get('flash_sale'):
+            self.stdout.write(f"Flash sale stock: {report['flash_sale']['initial_stock']} -> {report['flash_sale']['final_stock']}")
+        self.stdout.write(f"DB lock waits: {report['db_lock_waits'] or 'n/a'}")
+        if report['stock_violations']:
+            self.stdout.write(self.style.ERROR('Stock consistency violations:'))
+            for problem in report['stock_violations']:
+                self.stdout.write(f'  {problem}')
+        else:
+            self.stdout.write(self.style.SUCCESS('No stock consistency violations'))
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from shop import analytics
+from shop.models import Order, Payment
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily sales rollups for a date range (default: all history)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First local date, YYYY-MM-DD')
+        parser.add_argument('--end', help='Last local date, YYYY-MM-DD')
+        parser.add_argument('--batch-days', type=int, default=31, help='Days recomputed per transaction')
+
+    def handle(self, *args, **options):
+        start, end = self._range(options['start'], options['end'])
+        if start is None:
+            self.stdout.write('No orders or payments; nothing to do')
+            return
+
+        rows, day = 0, start
+        while day <= end:
+            batch_end = min(day + timedelta(days=options['batch_days'] - 1), end)
+            rows += analytics.rebuild(day, batch_end)
+            self.stdout.write(f'{day} .. {batch_end}: {rows} rows so far')
+            day = batch_end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {start} .. {end}: {rows} rollup rows'))
+
+    def _range(self, start, end):
+        dates = []
+        for value in (start, end):
+            parsed = parse_date(value) if value else None
+            if value and parsed is None:
+                raise CommandError(f'Invalid date: {value}')
+            dates.append(parsed)
+        start, end = dates
+        if start is None or end is None:
+            orders = Order.objects.aggregate(first=Min('created_at'), last=Max('created_at'))
+            payments = Payment.objects.aggregate(first=Min('completed_at'), last=Max('completed_at'))
+            firsts = [v for v in (orders['first'], payments['first']) if v]
+            lasts = [v for v in (orders['last'], payments['last']) if v]
+            if not firsts:
+                return None, None
+            start = start or timezone.localdate(min(firsts))
+            end = end or timezone.localdate(max(lasts))
+        return start, end
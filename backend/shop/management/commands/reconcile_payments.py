@@ -0,0 +1,47 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from shop import reconciliation
+
+
+class Command(BaseCommand):
+    help = ('Verify payments that have been pending for too long with Paystack and settle them: create\n'
+            'the missing orders and subscriptions, or mark the payments failed.\n\n'
+            'Run it every few minutes from cron. Against the load-test stub:\n'
+            '  PAYSTACK_API_BASE=http://127.0.0.1:8765 manage.py reconcile_payments --older-than 0')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None,
+                            help='Seconds a payment must have been pending (default RECONCILE_AFTER)')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=5, help='Verify calls in flight')
+        parser.add_argument('--rate', type=float, default=10, help='Verify calls per second at most')
+        parser.add_argument('--dry-run', action='store_true', help='Verify only; change nothing')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        older_than = None
+        if options['older_than'] is not None:
+            older_than = timezone.now() - timedelta(seconds=options['older_than'])
+        references = reconciliation.stale_references(older_than)
+        report = reconciliation.reconcile(
+            references, batch_size=options['batch_size'], concurrency=options['concurrency'],
+            rate=options['rate'], dry_run=options['dry_run'],
+        )
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"Verified {report['references']} references in {report['elapsed_s']}s "
+                          f"(p50 {report['verify_p50_ms']} ms, p95 {report['verify_p95_ms']} ms)")
+        self.stdout.write(f"Paystack: {report['outcomes'] or 'nothing to check'}")
+        self.stdout.write(f"Updated: {report['updates'] or 'nothing'}{' (dry run)' if options['dry_run'] else ''}")
+        if report['outcomes'].get('error'):
+            self.stdout.write(self.style.WARNING(f"{report['outcomes']['error']} verify calls failed; "
+                                                 'they are retried on the next run'))
+        if report['updates'].get('review'):
+            self.stdout.write(self.style.WARNING(f"{report['updates']['review']} paid intents need review "
+                                                 '(admin: Payment intents, status review)'))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q
+
+from shop import stock
+from shop.models import StockMovement
+
+
+class Command(BaseCommand):
+    help = ('Check every stock balance against the sum of its compacted ledger movements.\n\n'
+            'Exits non-zero on drift. --fix accepts the stored balances and records the\n'
+            'difference as adjust movements (also how products that predate the ledger get one),\n'
+            'and rebalances sharded stock whose slots disagree with the ledger.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Record adjustments for every mismatch')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        counts = StockMovement.objects.aggregate(total=Count('id'), pending=Count('id', filter=Q(compacted=False)))
+        mismatched = 0
+        for model in stock.PRODUCTS:
+            mismatches = stock.reconcile(model)
+            mismatched += len(mismatches)
+            for pk, name, balance, ledger in mismatches:
+                self.stdout.write(f'{model._meta.verbose_name} {pk} ({name}): balance {balance}, ledger {ledger}')
+            if mismatches and options['fix']:
+                stock.fix(model, mismatches)
+            for pk, name, slots, ledger in stock.slot_drift(model):
+                mismatched += 1
+                self.stdout.write(f'{model._meta.verbose_name} {pk} ({name}): slots hold {slots}, ledger {ledger}')
+                if options['fix']:
+                    stock.rebalance(model.objects.get(pk=pk))
+        self.stdout.write(f"Checked {counts['total']} movements ({counts['pending']} pending) "
+                          f'in {time.perf_counter() - started:.2f}s')
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS('All stock balances match the ledger'))
+        elif options['fix']:
+            self.stdout.write(self.style.WARNING(f'Recorded adjustments for {mismatched} products'))
+        else:
+            raise CommandError(f'{mismatched} products drifted from the ledger; rerun with --fix to accept the balances')
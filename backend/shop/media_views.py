@@ -0,0 +1,115 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+from mybrutea_backend.middleware import accepted_encoding
+
+from .assets import cache_control_for
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Precompressed siblings, in order of preference
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+
+@require_safe
+def serve_media(request, path):
+    """Serve an uploaded file from MEDIA_ROOT with caching and range support.
+
+    Content-hashed names (thumbnails) get an immutable Cache-Control header,
+    other files a short max-age plus ETag/Last-Modified revalidation. A
+    ``.br``/``.gz`` sibling is used when the client accepts it, and a single
+    ``Range: bytes=start-end`` is answered with 206.
+    """
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Not found')
+    if not os.path.isfile(fullpath):
+        raise Http404('Not found')
+
+    content_type, _ = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+
+    available = [name for name, suffix in ENCODINGS.items() if os.path.isfile(fullpath + suffix)]
+    encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), available)
+    if encoding:
+        fullpath += ENCODINGS[encoding]
+
+    stat = os.stat(fullpath)
+    etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'
+
+    headers = {
+        'Cache-Control': cache_control_for(path),
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Vary': 'Accept-Encoding',
+    }
+    if encoding:
+        headers['Content-Encoding'] = encoding
+
+    if _not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        for key, value in headers.items():
+            response[key] = value
+        return response
+
+    byte_range = _parse_range(request.META.get('HTTP_RANGE'), stat.st_size) if not encoding else None
+    if byte_range == 'invalid':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        with open(fullpath, 'rb') as fh:
+            fh.seek(start)
+            data = fh.read(end - start + 1)
+        response = HttpResponse(data, status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    else:
+        response = FileResponse(open(fullpath, 'rb'), content_type=content_type)
+        response['Content-Length'] = stat.st_size
+
+    for key, value in headers.items():
+        response[key] = value
+    return response
+
+
+def _not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and int(mtime) <= since
+
+
+def _parse_range(header, size):
+    """Return (start, end) for a single byte range, None to send the full body, or 'invalid'"""
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # Multiple or malformed ranges: fall back to the full response
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the final N bytes
+        length = int(last)
+        if length == 0:
+            return 'invalid'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return 'invalid'
+    return start, end
@@ -0,0 +1,194 @@
+"""In-process metrics with Prometheus text exposition.
+
+Metrics live in the memory of each worker process; scrape every worker (or
+run a single worker) to see the full picture. Typical use:
+
+    from shop import metrics
+
+    LOGINS = metrics.counter('shop_logins_total', 'Successful logins', ['method'])
+    LOGINS.inc(method='password')
+
+    with metrics.timer(VERIFY_SECONDS):
+        ...
+"""
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{self._format_labels(key)} {value}' for key, value in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def snapshot(self, **labels):
+        """Return {'counts', 'sum', 'count'} for one label set (empty if never observed)"""
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            if entry is None:
+                return {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            return {'counts': list(entry['counts']), 'sum': entry['sum'], 'count': entry['count']}
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, dict(entry, counts=list(entry['counts']))) for key, entry in self._values.items())
+        lines = []
+        for key, entry in items:
+            for bound, count in zip(self.buckets, entry['counts']):
+                lines.append(f'{self.name}_bucket{self._format_labels(key, ("le", repr(float(bound))))} {count}')
+            lines.append(f'{self.name}_bucket{self._format_labels(key, ("le", "+Inf"))} {entry["count"]}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {entry["sum"]}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {entry["count"]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        # Modules may be imported more than once (autoreload, tests); reuse the first instance
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+@contextmanager
+def timer(hist, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        hist.observe(time.perf_counter() - start, **labels)
+
+
+# Per-request accumulators, set by the metrics middleware
+request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def _timed_representation(method):
+    @functools.wraps(method)
+    def wrapper(self, instance):
+        stats = request_stats.get()
+        # Only time the outermost serializer so nested ones are not counted twice
+        if stats is None or stats['serializing']:
+            return method(self, instance)
+        stats['serializing'] = True
+        start = time.perf_counter()
+        try:
+            return method(self, instance)
+        finally:
+            stats['serializer_time'] += time.perf_counter() - start
+            stats['serializing'] = False
+    wrapper._shop_timed = True
+    return wrapper
+
+
+def instrument_serializers():
+    """Wrap DRF's to_representation so request time spent serializing is recorded"""
+    from rest_framework import serializers
+
+    for cls in (serializers.Serializer, serializers.ListSerializer):
+        if not getattr(cls.to_representation, '_shop_timed', False):
+            cls.to_representation = _timed_representation(cls.to_representation)
@@ -5,6 +5,7 @@ from django.utils import timezone
 class IngredientCategory(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -18,7 +19,10 @@ class Ingredient(models.Model):
     category = models.ForeignKey(IngredientCategory, on_delete=models.SET_NULL, null=True, blank=True, related_name='ingredients')
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
+    stock_shards = models.PositiveSmallIntegerField(default=0)  # Sharded stock slots for hot products, see shop.stock
     image = models.ImageField(upload_to='ingredients/', blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)  # Thumbnails, see shop.images
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -29,7 +33,10 @@ class Tea(models.Model):
     ingredients = models.ManyToManyField(Ingredient)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     quantity_in_stock = models.PositiveIntegerField(default=0)
+    stock_shards = models.PositiveSmallIntegerField(default=0)  # Sharded stock slots for hot products, see shop.stock
     image = models.ImageField(upload_to='teas/', blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)  # Thumbnails, see shop.images
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -60,7 +67,7 @@ class Order(models.Model):
     ]
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='shop_orders')
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     ordered = models.BooleanField(default=False)
     total_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     delivery_type = models.CharField(max_length=50, default='pickup')
@@ -73,6 +80,7 @@ class Order(models.Model):
     delivery_fee = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     payment_reference = models.CharField(max_length=255, blank=True, null=True, unique=True)
     payment_status = models.CharField(max_length=20, choices=PAYMENT_STATUS_CHOICES, default='pending')
+    backordered = models.BooleanField(default=False)  # Paid for more than was in stock, see OrderItem.backordered
 
     def __str__(self):
         return f"Order {self.id} by {self.user.username}"
@@ -82,6 +90,7 @@ class OrderItem(models.Model):
     tea = models.ForeignKey(Tea, on_delete=models.CASCADE, null=True, blank=True)
     ingredient = models.ForeignKey('Ingredient', on_delete=models.CASCADE, null=True, blank=True)
     quantity = models.PositiveIntegerField(default=1)
+    backordered = models.PositiveIntegerField(default=0)  # Units paid for that stock could not cover
 
     def __str__(self):
         if self.ingredient:
@@ -109,6 +118,7 @@ class Membership(models.Model):
     max_customizations_per_month = models.PositiveIntegerField(default=0)  # 0 = unlimited
     includes_health_protocol = models.BooleanField(default=False) 
     created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['price']
@@ -177,7 +187,7 @@ class Payment(models.Model):
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHOD_CHOICES)
     transaction_ref = models.CharField(max_length=255, unique=True)  # Paystack or bank reference
     created_at = models.DateTimeField(auto_now_add=True)
-    completed_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True, db_index=True)
     
     class Meta:
         ordering = ['-created_at']
@@ -224,3 +234,230 @@ class PickupLocation(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class DailyRollup(models.Model):
+    """
+    Precomputed sales per day and dimension, maintained by shop.analytics.
+    Product rows carry units only: order items do not store a price.
+    """
+    DIMENSION_CHOICES = [
+        ('total', 'All paid orders'),
+        ('tea', 'Tea'),
+        ('ingredient', 'Ingredient'),
+        ('pickup', 'Pickup location'),
+        ('city', 'Delivery city'),
+        ('membership', 'Membership'),
+    ]
+
+    date = models.DateField()
+    dimension = models.CharField(max_length=20, choices=DIMENSION_CHOICES)
+    key = models.CharField(max_length=255, blank=True)  # Product/membership id, location or city
+    label = models.CharField(max_length=255, blank=True)
+    orders = models.PositiveIntegerField(default=0)  # Orders, or completed payments for memberships
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    delivery_fees = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['date']
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'date', 'key'], name='dailyrollup_dimension_date_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} {self.dimension} {self.label or self.key}"
+
+
+class RollupSource(models.Model):
+    """
+    What one paid order or completed payment currently adds to DailyRollup,
+    so shop.analytics can apply the difference when it changes.
+    """
+    KIND_CHOICES = [
+        ('order', 'Order'),
+        ('payment', 'Payment'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()  # Not a foreign key: the source outlives a deleted order
+    date = models.DateField(db_index=True)
+    rows = models.JSONField(default=list)  # [dimension, key, label, orders, units, revenue, delivery fees]
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='rollupsource_kind_object'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} on {self.date}"
+
+
+class IdempotencyRecord(models.Model):
+    """
+    Stored outcome of a request sent with an Idempotency-Key header (see shop.idempotency)
+    """
+    STATUS_CHOICES = [
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+    ]
+
+    scope = models.CharField(max_length=100)  # 'user:<id>' or 'ip:<address>'
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)  # sha256 of method, path and body
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='processing')
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    claimed_at = models.DateTimeField(default=timezone.now)  # When the running attempt took the key
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='idempotencyrecord_scope_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} ({self.status})"
+
+
+class StockMovement(models.Model):
+    """
+    Append-only stock ledger entry (see shop.stock). ``delta`` is the change
+    in available stock; pending rows are folded into the product's stock
+    field by compaction.
+    """
+    KIND_CHOICES = [
+        ('reserve', 'Reserve'),  # Into a cart
+        ('release', 'Release'),  # Back out of a cart
+        ('sell', 'Sell'),
+        ('restock', 'Restock'),
+        ('adjust', 'Adjust'),  # Stock count corrections
+    ]
+
+    tea = models.ForeignKey(Tea, on_delete=models.CASCADE, null=True, blank=True, related_name='stock_movements')
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, null=True, blank=True, related_name='stock_movements')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    delta = models.IntegerField()
+    reference = models.CharField(max_length=64, blank=True)  # e.g. 'cart:12', 'order:34'
+    created_at = models.DateTimeField(default=timezone.now)
+    compacted = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(tea__isnull=False, ingredient__isnull=True) | models.Q(tea__isnull=True, ingredient__isnull=False),
+                name='stockmovement_one_product',
+            ),
+        ]
+        indexes = [
+            # Small partial indexes: only pending rows are read on the hot path
+            models.Index(fields=['id'], condition=models.Q(compacted=False), name='stockmovement_pending'),
+            models.Index(fields=['tea'], condition=models.Q(compacted=False), name='stockmovement_pending_tea'),
+            models.Index(fields=['ingredient'], condition=models.Q(compacted=False), name='stockmovement_pending_ing'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.delta:+d} {self.tea or self.ingredient}"
+
+
+class StockShard(models.Model):
+    """
+    One slot of a hot product's available stock (see shop.stock). Buyers
+    decrement random slots so they do not all wait on one row.
+    """
+    tea = models.ForeignKey(Tea, on_delete=models.CASCADE, null=True, blank=True, related_name='stock_slots')
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, null=True, blank=True, related_name='stock_slots')
+    slot = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tea', 'slot'], name='stockshard_tea_slot'),
+            models.UniqueConstraint(fields=['ingredient', 'slot'], name='stockshard_ingredient_slot'),
+            models.CheckConstraint(
+                condition=models.Q(tea__isnull=False, ingredient__isnull=True) | models.Q(tea__isnull=True, ingredient__isnull=False),
+                name='stockshard_one_product',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.tea or self.ingredient} slot {self.slot}: {self.quantity}"
+
+
+class CatalogChange(models.Model):
+    """
+    Latest change to a catalog object, feeding the delta sync endpoint (see
+    shop.catalog_sync). The id is the change sequence clients sync from;
+    older rows for the same object are dropped, deletions stay as tombstones.
+    """
+    KIND_CHOICES = [
+        ('tea', 'Tea'),
+        ('ingredient', 'Ingredient'),
+        ('category', 'Ingredient category'),
+        ('membership', 'Membership'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    object_id = models.PositiveIntegerField()
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'object_id'], name='catalogchange_object'),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} {self.kind} {self.object_id}{' (deleted)' if self.deleted else ''}"
+
+
+class RevokedToken(models.Model):
+    """
+    A revoked JWT (see shop.jwt_auth). With a jti it revokes that token; with
+    a blank jti it revokes every token issued to the user before created_at.
+    Rows are only needed until the newest affected token would have expired.
+    """
+    jti = models.CharField(max_length=255, blank=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='revoked_tokens')
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.jti or 'all tokens'} of {self.user} until {self.expires_at:%Y-%m-%d %H:%M}"
+
+
+class PaymentIntent(models.Model):
+    """
+    A Paystack transaction the API initialized, kept until it is fulfilled
+    or known to have failed. ``manage.py reconcile_payments`` verifies the
+    stale pending ones, so a payment whose webhook was lost and whose
+    client never came back still becomes an order or subscription.
+    'review' means Paystack took the money but there was nothing to
+    fulfil. ``items`` is the cart as it was paid for, so the order does not
+    depend on what the cart holds when the payment is finally confirmed.
+    """
+    KIND_CHOICES = [
+        ('order', 'Order'),
+        ('membership', 'Membership'),
+    ]
+
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('fulfilled', 'Fulfilled'),
+        ('failed', 'Failed'),
+        ('review', 'Paid, needs review'),
+    ]
+    OPEN_STATUSES = ('pending', 'review')
+
+    reference = models.CharField(max_length=255, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payment_intents')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    items = models.JSONField(default=list, blank=True)  # [{'tea': id, 'ingredient': id, 'quantity': n}]
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', db_index=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    checked_at = models.DateTimeField(null=True, blank=True)
+    note = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return f"{self.kind} payment {self.reference} ({self.status})"
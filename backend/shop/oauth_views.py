@@ -6,6 +6,9 @@ from social_django.models import UserSocialAuth
 from django.contrib.auth.models import User
 import json
 
+from . import jwt_auth
+from .google_auth import get_verifier
+
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -20,12 +23,8 @@ def google_oauth_callback(request):
         return Response({'error': 'Access token is required'}, status=400)
     
     try:
-        # Use social-auth-app-django to authenticate with Google
-        from social_core.backends.google import GoogleOAuth2
-        backend = GoogleOAuth2()
-        
-        # Get user info from Google
-        user_data = backend.user_data(access_token)
+        # Get user info from Google over the verifier's pooled session
+        user_data = get_verifier().user_info(access_token)
         
         # Get or create user
         email = user_data.get('email')
@@ -37,8 +36,9 @@ def google_oauth_callback(request):
         
         # Try to get user by email
         user, created = User.objects.get_or_create(
-            email=email,
+            email__iexact=email,
             defaults={
+                'email': email,
                 'username': email.split('@')[0],
                 'first_name': first_name,
                 'last_name': last_name,
@@ -49,7 +49,7 @@ def google_oauth_callback(request):
         UserSocialAuth.objects.get_or_create(
             user=user,
             provider='google-oauth2',
-            defaults={'uid': user_data.get('id', email)}
+            defaults={'uid': user_data.get('sub') or user_data.get('id', email)}
         )
         
         # Get or create token
@@ -63,7 +63,8 @@ def google_oauth_callback(request):
                 'first_name': user.first_name,
                 'last_name': user.last_name,
             },
-            'token': token.key
+            'token': token.key,
+            **jwt_auth.tokens_for(user),
         }, status=200)
         
     except Exception as e:
@@ -77,22 +78,14 @@ def google_oauth_login(request):
     Authenticate user with Google using ID token from frontend.
     Expected POST data: { 'id_token': '<google_id_token>' }
     """
-    id_token = request.data.get('id_token')
+    token_str = request.data.get('id_token')
     
-    if not id_token:
+    if not token_str:
         return Response({'error': 'ID token is required'}, status=400)
     
     try:
-        from google.oauth2 import id_token
-        from google.auth.transport import requests
-        from django.conf import settings
-        
-        # Verify the token
-        idinfo = id_token.verify_oauth2_token(
-            id_token,
-            requests.Request(),
-            settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY
-        )
+        # Verify the token against Google's cached signing certs
+        idinfo = get_verifier().verify(token_str)
         
         # Get user info
         email = idinfo.get('email')
@@ -104,8 +97,9 @@ def google_oauth_login(request):
         
         # Get or create user
         user, created = User.objects.get_or_create(
-            email=email,
+            email__iexact=email,
             defaults={
+                'email': email,
                 'username': email.split('@')[0],
                 'first_name': first_name,
                 'last_name': last_name,
@@ -130,7 +124,8 @@ def google_oauth_login(request):
                 'first_name': user.first_name,
                 'last_name': user.last_name,
             },
-            'token': token.key
+            'token': token.key,
+            **jwt_auth.tokens_for(user),
         }, status=200)
         
     except ValueError as e:
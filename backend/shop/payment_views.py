@@ -1,6 +1,6 @@
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework import status
 from django.conf import settings
 from django.utils import timezone
@@ -10,17 +10,23 @@ import hmac
 import hashlib
 import requests
 
-from .models import Cart, Order, OrderItem, PickupLocation, DeliveryAddress, Subscription
-from .serializers import OrderSerializer, DeliveryAddressSerializer
+from .models import Cart, PaymentIntent, PickupLocation, Subscription
+from .serializers import OrderSerializer
+from . import fulfillment
+from .admission import admission_controlled
+from .idempotency import idempotent
 from django.contrib.auth import get_user_model
 User = get_user_model()
 
 # Get frontend URL from settings for Paystack redirect
 FRONTEND_URL = settings.FRONTEND_URL
+PAYSTACK_API_BASE = settings.PAYSTACK_API_BASE.rstrip('/')
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@admission_controlled
+@idempotent
 def initiate_payment(request):
     """Initiate a Paystack payment for the user's cart.
     
@@ -51,13 +57,15 @@ def initiate_payment(request):
     pickup_id = data.get('pickup_id')
     delivery_address_id = data.get('delivery_address_id')
 
-    # Calculate subtotal
+    # Calculate subtotal, and keep the lines being paid for
     subtotal = Decimal('0.00')
+    lines = []
     for ci in cart.items.all():
         if ci.ingredient:
             subtotal += (ci.ingredient.price * ci.quantity)
         elif ci.tea:
             subtotal += (ci.tea.price * ci.quantity)
+        lines.append({'tea': ci.tea_id, 'ingredient': ci.ingredient_id, 'quantity': ci.quantity})
 
     delivery_fee = Decimal('0.00')
 
@@ -69,8 +77,7 @@ def initiate_payment(request):
 
     total_price = subtotal + delivery_fee
 
-    # Store order details in session for verification after payment
-    # We'll create a temporary order record to track payment
+    # Order details travel in the Paystack metadata and come back on verification
     order_data = {
         'delivery_type': delivery_type,
         'pickup_id': pickup_id,
@@ -88,9 +95,6 @@ def initiate_payment(request):
     import uuid
     reference = f"ORDER-{user.id}-{uuid.uuid4().hex[:12].upper()}"
 
-    # Store payment intent in session
-    request.session[f'payment_{reference}'] = order_data
-
     # Initialize Paystack payment
     paystack_key = settings.PAYSTACK_SECRET_KEY
     amount_in_kobo = int(float(total_price) * 100)  # Paystack uses kobo (1/100 of naira)
@@ -113,7 +117,7 @@ def initiate_payment(request):
 
     try:
         response = requests.post(
-            'https://api.paystack.co/transaction/initialize',
+            f'{PAYSTACK_API_BASE}/transaction/initialize',
             json=paystack_payload,
             headers=headers,
             timeout=10
@@ -122,6 +126,9 @@ def initiate_payment(request):
         if response.status_code == 200:
             paystack_response = response.json()
             if paystack_response.get('status'):
+                # Lets reconcile_payments finish the order if the webhook and the client never come back
+                PaymentIntent.objects.create(reference=reference, user=user, kind='order', amount=total_price,
+                                             items=lines)
                 return Response({
                     'status': True,
                     'authorization_url': paystack_response['data']['authorization_url'],
@@ -166,7 +173,7 @@ def verify_payment(request):
 
     try:
         response = requests.get(
-            f'https://api.paystack.co/transaction/verify/{reference}',
+            f'{PAYSTACK_API_BASE}/transaction/verify/{reference}',
             headers=headers,
             timeout=10
         )
@@ -187,86 +194,22 @@ def verify_payment(request):
                     'status': data.get('status')
                 }, status=status.HTTP_400_BAD_REQUEST)
 
-            # Payment successful - create order
-            user = request.user
-            
-            try:
-                cart = Cart.objects.get(user=user)
-            except Cart.DoesNotExist:
-                return Response({'error': 'Cart not found'}, status=status.HTTP_404_NOT_FOUND)
-
-            if not cart.items.exists():
-                return Response({'error': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
-
-            # Retrieve stored order data from metadata
+            # Payment successful - create the order (once, whoever gets here first)
             metadata = data.get('metadata', {})
-            order_data = metadata.get('order_data', {})
-
-            delivery_type = order_data.get('delivery_type', 'pickup')
-            pickup_id = order_data.get('pickup_id')
-            delivery_address_id = order_data.get('delivery_address_id')
-            total_price = Decimal(str(order_data.get('total_price', '0')))
-            delivery_fee = Decimal(str(order_data.get('delivery_fee', '0')))
-
-            pickup_name = None
-
-            if delivery_type == 'pickup' and pickup_id:
-                pickup = PickupLocation.objects.get(id=pickup_id)
-                pickup_name = f"{pickup.name} - {pickup.branch}"
-            else:
-                # Delivery path
-                if delivery_address_id:
-                    addr = DeliveryAddress.objects.get(id=delivery_address_id, user=user)
-                else:
-                    # Create a delivery address from stored data
-                    addr_data = {
-                        'address_line1': order_data.get('address_line1'),
-                        'address_line2': order_data.get('address_line2'),
-                        'city': order_data.get('city'),
-                        'state': order_data.get('state'),
-                        'zip_code': order_data.get('zip_code'),
-                    }
-                    addr_serializer = DeliveryAddressSerializer(data=addr_data)
-                    if addr_serializer.is_valid():
-                        addr = addr_serializer.save(user=user)
-                    else:
-                        return Response({
-                            'error': 'Invalid delivery address',
-                            'details': addr_serializer.errors
-                        }, status=status.HTTP_400_BAD_REQUEST)
-
-            # Create order
-            order = Order.objects.create(
-                user=user,
-                total_price=total_price,
-                delivery_type=delivery_type,
-                pickup_location=pickup_name if pickup_name else (addr.address_line1 if delivery_type == 'delivery' else ''),
-                delivery_address_line1=(addr.address_line1 if delivery_type == 'delivery' else None),
-                delivery_address_line2=(addr.address_line2 if delivery_type == 'delivery' else None),
-                delivery_city=(addr.city if delivery_type == 'delivery' else None),
-                delivery_state=(addr.state if delivery_type == 'delivery' else None),
-                delivery_zip_code=(addr.zip_code if delivery_type == 'delivery' else None),
-                delivery_fee=delivery_fee,
-                payment_reference=reference,
-                payment_status='paid'
-            )
-
-            # Move cart items to order
-            for ci in cart.items.all():
-                if ci.ingredient:
-                    OrderItem.objects.create(order=order, ingredient=ci.ingredient, quantity=ci.quantity)
-                else:
-                    OrderItem.objects.create(order=order, tea=ci.tea, quantity=ci.quantity)
-
-            # Clear cart
-            cart.items.all().delete()
+            try:
+                order, created = fulfillment.create_order(request.user, reference, metadata.get('order_data', {}))
+            except fulfillment.FulfillmentError as e:
+                body = {'error': e.message}
+                if e.details:
+                    body['details'] = e.details
+                return Response(body, status=e.status)
 
             serializer = OrderSerializer(order)
             return Response({
                 'status': True,
-                'message': 'Payment verified and order created successfully',
+                'message': 'Payment verified and order created successfully' if created else 'Payment already verified',
                 'order': serializer.data
-            }, status=status.HTTP_201_CREATED)
+            }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
         else:
             return Response({
@@ -282,6 +225,7 @@ def verify_payment(request):
 
 
 @api_view(['POST'])
+@permission_classes([AllowAny])  # Paystack is anonymous; the signature check below authenticates it
 def paystack_webhook(request):
     """Handle Paystack webhook for payment confirmation.
     
@@ -307,131 +251,14 @@ def paystack_webhook(request):
         # We only process successful charge events
         if event.get('event') == 'charge.success':
             data = event.get('data', {})
-            reference = data.get('reference')
             metadata = data.get('metadata', {}) or {}
 
-            # Idempotency: if we've already recorded this reference, acknowledge
-            if Order.objects.filter(payment_reference=reference).exists() or Subscription.objects.filter(payment_reference=reference).exists():
-                return Response(status=status.HTTP_200_OK)
-
-            ptype = metadata.get('type') or metadata.get('payment_type')
-
-            # MEMBERSHIP flow
-            if ptype == 'membership' or metadata.get('membership_id'):
-                try:
-                    membership_id = metadata.get('membership_id') or metadata.get('membership')
-                    if not membership_id:
-                        return Response(status=status.HTTP_200_OK)
-
-                    from .models import Membership
-                    from datetime import timedelta
-
-                    try:
-                        membership = Membership.objects.get(id=membership_id)
-                    except Membership.DoesNotExist:
-                        return Response(status=status.HTTP_200_OK)
-
-                    user_id = metadata.get('user_id')
-                    if not user_id:
-                        return Response(status=status.HTTP_200_OK)
-
-                    try:
-                        user = User.objects.get(id=user_id)
-                    except User.DoesNotExist:
-                        return Response(status=status.HTTP_200_OK)
-
-                    amount_paid = Decimal(str(data.get('amount', 0) / 100))
-
-                    subscription, created = Subscription.objects.get_or_create(
-                        user=user,
-                        membership=membership,
-                        defaults={
-                            'payment_reference': reference,
-                            'payment_status': 'paid',
-                            'amount_paid': amount_paid,
-                            'renewal_date': timezone.now() + timedelta(days=30),
-                            'status': 'active'
-                        }
-                    )
-
-                    if not created:
-                        subscription.payment_reference = reference
-                        subscription.payment_status = 'paid'
-                        subscription.amount_paid = amount_paid
-                        subscription.status = 'active'
-                        subscription.renewal_date = timezone.now() + timedelta(days=30)
-                        subscription.save()
-                except Exception:
-                    # Acknowledge to avoid webhook retries; log if needed
-                    pass
-
-            # ORDER flow
-            elif ptype == 'order' or metadata.get('order_data'):
+            user = User.objects.filter(id=metadata.get('user_id')).first() if metadata.get('user_id') else None
+            if user is not None:
                 try:
-                    user_id = metadata.get('user_id')
-                    if not user_id:
-                        return Response(status=status.HTTP_200_OK)
-
-                    try:
-                        user = User.objects.get(id=user_id)
-                    except User.DoesNotExist:
-                        return Response(status=status.HTTP_200_OK)
-
-                    try:
-                        cart = Cart.objects.get(user=user)
-                    except Cart.DoesNotExist:
-                        return Response(status=status.HTTP_200_OK)
-
-                    if not cart.items.exists():
-                        return Response(status=status.HTTP_200_OK)
-
-                    order_data = metadata.get('order_data', {})
-                    delivery_type = order_data.get('delivery_type', 'pickup')
-                    pickup_id = order_data.get('pickup_id')
-                    delivery_address_id = order_data.get('delivery_address_id')
-                    total_price = Decimal(str(order_data.get('total_price', '0')))
-                    delivery_fee = Decimal(str(order_data.get('delivery_fee', '0')))
-
-                    pickup_name = None
-                    addr = None
-
-                    if delivery_type == 'pickup' and pickup_id:
-                        try:
-                            pickup = PickupLocation.objects.get(id=pickup_id)
-                            pickup_name = f"{pickup.name} - {pickup.branch}"
-                        except PickupLocation.DoesNotExist:
-                            pickup_name = ''
-                    else:
-                        if delivery_address_id:
-                            try:
-                                addr = DeliveryAddress.objects.get(id=delivery_address_id, user=user)
-                            except DeliveryAddress.DoesNotExist:
-                                addr = None
-
-                    # Create order
-                    order = Order.objects.create(
-                        user=user,
-                        total_price=total_price,
-                        delivery_type=delivery_type,
-                        pickup_location=pickup_name if pickup_name else (addr.address_line1 if addr else ''),
-                        delivery_address_line1=(addr.address_line1 if addr else None),
-                        delivery_address_line2=(addr.address_line2 if addr else None),
-                        delivery_city=(addr.city if addr else None),
-                        delivery_state=(addr.state if addr else None),
-                        delivery_zip_code=(addr.zip_code if addr else None),
-                        delivery_fee=delivery_fee,
-                        payment_reference=reference,
-                        payment_status='paid'
-                    )
-
-                    for ci in cart.items.all():
-                        if ci.ingredient:
-                            OrderItem.objects.create(order=order, ingredient=ci.ingredient, quantity=ci.quantity)
-                        else:
-                            OrderItem.objects.create(order=order, tea=ci.tea, quantity=ci.quantity)
-
-                    cart.items.all().delete()
-                except Exception:
+                    fulfillment.fulfill_charge(data, user)
+                except fulfillment.FulfillmentError:
+                    # Nothing to build the order from; acknowledge so Paystack stops retrying
                     pass
 
         return Response(status=status.HTTP_200_OK)
@@ -443,6 +270,8 @@ def paystack_webhook(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@admission_controlled
+@idempotent
 def initiate_membership_payment(request):
     """Initiate a Paystack payment for membership subscription.
     
@@ -507,7 +336,7 @@ def initiate_membership_payment(request):
     
     try:
         response = requests.post(
-            'https://api.paystack.co/transaction/initialize',
+            f'{PAYSTACK_API_BASE}/transaction/initialize',
             headers=paystack_headers,
             json=paystack_payload
         )
@@ -516,9 +345,10 @@ def initiate_membership_payment(request):
         paystack_response = response.json()
         
         if paystack_response.get('status'):
-            # Store payment reference in session for later verification
-            request.session['membership_payment_reference'] = payment_reference
-            
+            # The reference only changes once a second, so a double submit can repeat it
+            PaymentIntent.objects.bulk_create([PaymentIntent(
+                reference=payment_reference, user=user, kind='membership', amount=amount_in_naira,
+            )], ignore_conflicts=True)
             return Response({
                 'status': True,
                 'authorization_url': paystack_response['data']['authorization_url'],
@@ -551,8 +381,7 @@ def verify_membership_payment(request):
     - amount: Amount paid
     - status: Subscription status
     """
-    from .models import Membership, Subscription
-    from datetime import timedelta
+    from .models import Membership
     from .serializers import SubscriptionSerializer
 
     user = request.user
@@ -567,7 +396,7 @@ def verify_membership_payment(request):
 
     try:
         response = requests.get(
-            f'https://api.paystack.co/transaction/verify/{reference}',
+            f'{PAYSTACK_API_BASE}/transaction/verify/{reference}',
             headers=paystack_headers,
             timeout=10
         )
@@ -602,28 +431,8 @@ def verify_membership_payment(request):
         except Membership.DoesNotExist:
             return Response({'error': 'Membership not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        # Create or update subscription
         amount_paid = Decimal(str(data.get('amount', 0) / 100))  # Convert from kobo to naira
-
-        subscription, created = Subscription.objects.get_or_create(
-            user=user,
-            membership=membership,
-            defaults={
-                'payment_reference': reference,
-                'payment_status': 'paid',
-                'amount_paid': amount_paid,
-                'renewal_date': timezone.now() + timedelta(days=30),
-                'status': 'active'
-            }
-        )
-
-        if not created:
-            subscription.payment_reference = reference
-            subscription.payment_status = 'paid'
-            subscription.amount_paid = amount_paid
-            subscription.status = 'active'
-            subscription.renewal_date = timezone.now() + timedelta(days=30)
-            subscription.save()
+        subscription, _ = fulfillment.activate_subscription(user, membership, reference, amount_paid)
 
         return Response({
             'success': True,
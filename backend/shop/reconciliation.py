@@ -0,0 +1,202 @@
+"""Finish checkouts whose webhook never arrived.
+
+``stale_references()`` collects the payment references that have been
+pending for longer than RECONCILE_AFTER seconds. They come from
+PaymentIntent rows, orders and subscriptions whose payment_status is
+'pending', and Payment rows with status 'pending'. ``reconcile()`` asks
+Paystack about each reference. The verify calls run in batches of
+``batch_size`` on ``concurrency`` threads, and a shared token bucket
+keeps them under ``rate`` calls per second, Paystack's limit. The threads
+only do HTTP. Database writes happen on the calling thread after each
+batch:
+
+- success: the intent becomes an order or subscription (see
+  fulfillment.py), and pending rows are marked paid/completed. An intent
+  with nothing to fulfil goes to 'review'.
+- failed, abandoned or reversed: the rows are marked failed.
+- still pending, or not found by Paystack: the rows are left for the
+  next run, and marked failed once older than RECONCILE_GIVE_UP seconds.
+- errors (timeouts, 5xx, or a refused call such as a 401 for a bad key):
+  the rows are left alone, however old, since nothing was learnt.
+
+Every step is idempotent, so overlapping runs, webhooks and client
+verifications cannot create a second order. ``manage.py
+reconcile_payments`` runs it; point PAYSTACK_API_BASE at
+``loadtest.PaystackStub`` to try it locally.
+"""
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import quote
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+from . import benchmarks, fulfillment
+from .models import Order, Payment, PaymentIntent, Subscription
+from .throttling import take
+
+FAILED = ('failed', 'abandoned', 'reversed')
+
+
+class RateLimiter:
+    """At most ``rate`` calls per second across threads (a token bucket with one second of burst)"""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate, self.clock, self.sleep = rate, clock, sleep
+        self._lock = threading.Lock()
+        self._state = None
+
+    def wait(self):
+        while True:
+            with self._lock:
+                allowed, self._state, wait = take(self._state, self.clock(), self.rate, self.rate, 1)
+            if allowed:
+                return
+            self.sleep(wait)
+
+
+def stale_references(older_than=None):
+    """{reference: [pending rows carrying it]} for everything pending since before ``older_than``"""
+    if older_than is None:
+        older_than = timezone.now() - timedelta(seconds=getattr(settings, 'RECONCILE_AFTER', 900))
+    found = defaultdict(list)
+    sources = [
+        PaymentIntent.objects.filter(status='pending', created_at__lt=older_than).select_related('user'),
+        Order.objects.filter(payment_status='pending', payment_reference__isnull=False, created_at__lt=older_than),
+        Subscription.objects.filter(payment_status='pending', payment_reference__isnull=False,
+                                    start_date__lt=older_than),
+        Payment.objects.filter(status='pending', created_at__lt=older_than).select_related('subscription'),
+    ]
+    for queryset in sources:
+        for row in queryset:
+            found[_reference(row)].append(row)
+    found.pop('', None)
+    return dict(found)
+
+
+def _reference(row):
+    if isinstance(row, PaymentIntent):
+        return row.reference
+    if isinstance(row, Payment):
+        return row.transaction_ref
+    return row.payment_reference or ''
+
+
+def verify(reference, limiter=None):
+    """Ask Paystack about one reference: (outcome, charge data, seconds)"""
+    if limiter is not None:
+        limiter.wait()
+    started = time.perf_counter()
+    try:
+        response = requests.get(
+            f"{settings.PAYSTACK_API_BASE.rstrip('/')}/transaction/verify/{quote(reference, safe='')}",
+            headers={'Authorization': f'Bearer {settings.PAYSTACK_SECRET_KEY}'},
+            timeout=getattr(settings, 'RECONCILE_TIMEOUT', 10),
+        )
+        body = response.json() if response.status_code < 500 else {}
+    except (requests.RequestException, ValueError):
+        return 'error', None, time.perf_counter() - started
+    elapsed = time.perf_counter() - started
+    if response.status_code >= 500:
+        return 'error', None, elapsed
+    if not body.get('status'):
+        # Paystack answers 400 "Transaction reference not found" for references it never saw. Anything
+        # else (a 401 for a bad key, a malformed request) says nothing about the payment.
+        if response.status_code in (400, 404) and 'not found' in str(body.get('message', '')).lower():
+            return 'missing', None, elapsed
+        return 'error', None, elapsed
+    charge = body.get('data') or {}
+    if charge.get('status') == 'success':
+        return 'success', charge, elapsed
+    if charge.get('status') in FAILED:
+        return 'failed', charge, elapsed
+    return 'pending', charge, elapsed
+
+
+def _batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _apply_success(rows, charge, counts):
+    now = timezone.now()
+    for row in rows:
+        if isinstance(row, PaymentIntent):
+            try:
+                result = fulfillment.fulfill_charge(charge, row.user)
+            except fulfillment.FulfillmentError as e:
+                result, note = None, e.message
+            else:
+                note = 'Nothing to fulfil' if result is None else ''
+            if result is None:
+                fulfillment.mark_intent(row.reference, 'review', note)
+                counts['review'] += 1
+            else:
+                counts['fulfilled'] += 1
+        elif isinstance(row, Order):
+            Order.objects.filter(pk=row.pk, payment_status='pending').update(payment_status='paid')
+            counts['paid'] += 1
+        elif isinstance(row, Subscription):
+            Subscription.objects.filter(pk=row.pk, payment_status='pending').update(payment_status='paid')
+            counts['paid'] += 1
+        else:
+            Payment.objects.filter(pk=row.pk, status='pending').update(status='completed', completed_at=now)
+            Subscription.objects.filter(pk=row.subscription_id, payment_status='pending').update(payment_status='paid')
+            counts['paid'] += 1
+
+
+def _apply_failure(rows, note, counts):
+    for row in rows:
+        if isinstance(row, PaymentIntent):
+            fulfillment.mark_intent(row.reference, 'failed', note)
+        elif isinstance(row, Order):
+            Order.objects.filter(pk=row.pk, payment_status='pending').update(payment_status='failed')
+        elif isinstance(row, Subscription):
+            Subscription.objects.filter(pk=row.pk, payment_status='pending').update(payment_status='failed')
+        else:
+            Payment.objects.filter(pk=row.pk, status='pending').update(status='failed')
+        counts['failed'] += 1
+
+
+def _created_at(row):
+    return row.start_date if isinstance(row, Subscription) else row.created_at
+
+
+def reconcile(references, batch_size=50, concurrency=5, rate=10, dry_run=False):
+    """Verify and settle ``references`` (from ``stale_references()``); returns a report dict"""
+    started = time.perf_counter()
+    give_up = timezone.now() - timedelta(seconds=getattr(settings, 'RECONCILE_GIVE_UP', 24 * 3600))
+    limiter = RateLimiter(rate)
+    outcomes, counts, latencies = Counter(), Counter(), []
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for batch in _batches(sorted(references), batch_size):
+            results = list(pool.map(lambda reference: verify(reference, limiter), batch))
+            for reference, (outcome, charge, seconds) in zip(batch, results):
+                outcomes[outcome] += 1
+                latencies.append(seconds * 1000)
+                rows = references[reference]
+                if dry_run:
+                    continue
+                if outcome == 'success':
+                    _apply_success(rows, charge, counts)
+                elif outcome == 'failed':
+                    _apply_failure(rows, f"Paystack status {charge.get('status')}", counts)
+                elif outcome in ('missing', 'pending'):
+                    expired = [row for row in rows if _created_at(row) < give_up]
+                    _apply_failure(expired, f'Still {outcome} after the give-up period', counts)
+                    if len(rows) > len(expired):
+                        counts['waiting'] += len(rows) - len(expired)
+
+    return {
+        'references': len(references),
+        'outcomes': dict(outcomes),
+        'updates': dict(counts),
+        'elapsed_s': round(time.perf_counter() - started, 2),
+        'verify_p50_ms': round(benchmarks.percentile(latencies, 50), 1) if latencies else None,
+        'verify_p95_ms': round(benchmarks.percentile(latencies, 95), 1) if latencies else None,
+    }
@@ -0,0 +1,88 @@
+"""Fast JSON and MessagePack renderers and parsers for the API.
+
+``ORJSONRenderer`` produces the same bytes as DRF's JSONRenderer (compact,
+UTF-8, DRF's Decimal/datetime formatting) several times faster; indented
+output (``Accept: application/json; indent=2``) still goes through DRF.
+``MessagePackRenderer`` answers ``Accept: application/msgpack``, which the
+mobile client can send to get smaller, cheaper-to-decode bodies.
+
+Both libraries are optional. Without orjson the JSON classes fall back to
+DRF's implementation; without msgpack the MessagePack classes are skipped
+by ``AvailableContentNegotiation`` and such requests get a 406 (or 415).
+``manage.py benchmark_renderers`` compares render time and size.
+"""
+from rest_framework.exceptions import ParseError
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Everything orjson and msgpack do not handle the way DRF does goes through DRF's encoder
+_encode_default = JSONEncoder().default
+
+
+class ORJSONRenderer(JSONRenderer):
+    available = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Passthrough keeps DRF's datetime format (milliseconds, 'Z' for UTC)
+        return orjson.dumps(data, default=_encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+class ORJSONParser(JSONParser):
+    available = True
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    available = msgpack is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_encode_default, use_bin_type=True, datetime=False)
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+    available = msgpack is not None
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False, strict_map_key=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as exc:
+            raise ParseError(f'MessagePack parse error - {exc}')
+
+
+class AvailableContentNegotiation(DefaultContentNegotiation):
+    """Leave out renderers and parsers whose library is not installed"""
+
+    def select_parser(self, request, parsers):
+        return super().select_parser(request, [p for p in parsers if getattr(p, 'available', True)])
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return super().select_renderer(request, [r for r in renderers if getattr(r, 'available', True)],
+                                       format_suffix)
@@ -0,0 +1,100 @@
+"""Read-replica routing.
+
+REPLICA_DATABASES names the DATABASES aliases that replicate ``default``.
+Views opt in: viewsets with ``ReplicaReadMixin`` (the public catalog, staff
+order and subscription listings) and function views decorated with
+``@replica_reads`` (staff export and analytics) call ``use_replica()``
+once DRF has authenticated the request. From then on ``ReplicaRouter``
+sends that request's reads to a randomly chosen replica. Everything else,
+including every write, uses ``default``.
+
+Replicas lag behind the primary. After a user's successful POST, PUT,
+PATCH or DELETE, ``ReplicaRoutingMiddleware`` pins that user to the
+primary for REPLICA_PIN_SECONDS. The pin lives in the shared cache, so it
+holds on every worker, and the user reads back their own cart, checkout
+or subscription change.
+
+Cached catalog lists are rendered from the primary (``primary()``): a
+copy rendered from a lagging replica just after a change would be cached
+as the new version and served until the next change.
+
+The chosen alias lives in a context variable, which the middleware clears
+at the end of each request. Querysets evaluated after the view returns
+(streaming responses) must be bound with ``.using()`` while the view runs.
+"""
+import functools
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_read_alias = ContextVar('read_alias', default=None)
+
+
+def aliases():
+    return getattr(settings, 'REPLICA_DATABASES', ())
+
+
+def _pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def pin(user_id):
+    """Send ``user_id``'s reads to the primary until replicas have caught up with their write"""
+    cache.set(_pin_key(user_id), True, getattr(settings, 'REPLICA_PIN_SECONDS', 5))
+
+
+def is_pinned(user_id):
+    return cache.get(_pin_key(user_id), False)
+
+
+def use_replica(request):
+    """Route the rest of this request's reads to a replica, if it may read stale data"""
+    replicas = aliases()
+    if not replicas or request.method not in SAFE_METHODS:
+        return None
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated and is_pinned(user.pk):
+        return None
+    alias = random.choice(replicas)
+    _read_alias.set(alias)
+    return alias
+
+
+def reset():
+    _read_alias.set(None)
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside the block, whatever the request chose"""
+    token = _read_alias.set(None)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def replica_reads(view):
+    """For @api_view functions: place below @permission_classes so DRF has authenticated the user"""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        use_replica(request)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
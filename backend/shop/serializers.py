@@ -2,20 +2,58 @@ from django.db import transaction
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import Tea, Ingredient, Cart, CartItem, Order, OrderItem, Membership, Subscription, Profile, PickupLocation, DeliveryAddress, Payment, IngredientCategory
+from .images import srcset
+from .auth import email_taken
+from .shaping import ShapedSerializerMixin
+from . import stock
 
-class IngredientSerializer(serializers.ModelSerializer):
+
+class ImageSrcsetMixin(serializers.Serializer):
+    """Expose thumbnail variants as srcset strings keyed by format (webp/avif)"""
+    image_srcset = serializers.SerializerMethodField()
+    shape_sources = {'image_srcset': ['image_variants']}
+
+    def get_image_srcset(self, obj):
+        return srcset(obj.image_variants, self.context.get('request'))
+
+
+class AvailableStockMixin:
+    """Report available stock (balance plus pending ledger movements) when the queryset annotated it"""
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        _, field = stock.PRODUCTS[type(instance)]
+        if field in data and getattr(instance, 'available_stock', None) is not None:
+            data[field] = instance.available_stock
+        return data
+
+    @classmethod
+    def shape_base_queryset(cls, queryset):
+        return stock.with_available_stock(queryset)
+
+    def update(self, instance, validated_data):
+        # Setting the stock records an adjustment instead of overwriting the balance
+        _, field = stock.PRODUCTS[type(instance)]
+        if field in validated_data:
+            target = validated_data.pop(field)
+            stock.adjust(instance, target - stock.available(instance), reference='api')
+            instance.available_stock = target
+        return super().update(instance, validated_data)
+
+
+class IngredientSerializer(ShapedSerializerMixin, AvailableStockMixin, ImageSrcsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Ingredient
-        fields = '__all__'
+        exclude = ['image_variants', 'stock_shards']
 
-class TeaSerializer(serializers.ModelSerializer):
+class TeaSerializer(ShapedSerializerMixin, AvailableStockMixin, ImageSrcsetMixin, serializers.ModelSerializer):
     ingredients = IngredientSerializer(many=True, read_only=True)
 
     class Meta:
         model = Tea
-        fields = '__all__'
+        exclude = ['image_variants', 'stock_shards']
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     tea = TeaSerializer(read_only=True)
     ingredient = IngredientSerializer(read_only=True)
 
@@ -23,14 +61,14 @@ class CartItemSerializer(serializers.ModelSerializer):
         model = CartItem
         fields = '__all__'
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
 
     class Meta:
         model = Cart
         fields = '__all__'
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     tea = TeaSerializer(read_only=True)
     ingredient = IngredientSerializer(read_only=True)
     order = serializers.PrimaryKeyRelatedField(read_only=True)
@@ -39,7 +77,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
         model = OrderItem
         fields = '__all__'
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
 
     class Meta:
@@ -52,15 +90,14 @@ class OrderSerializer(serializers.ModelSerializer):
             order = Order.objects.create(**validated_data)
             for item_data in items_data:
                 tea = item_data['tea']
-                quantity = item_data['quantity']
-                if tea.quantity_in_stock < quantity:
+                try:
+                    stock.sell(tea, item_data['quantity'], reference=f'order:{order.id}')
+                except stock.InsufficientStock:
                     raise serializers.ValidationError(f"Not enough stock for {tea.name}")
-                tea.quantity_in_stock -= quantity
-                tea.save()
                 OrderItem.objects.create(order=order, **item_data)
         return order
 
-class MembershipSerializer(serializers.ModelSerializer):
+class MembershipSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Membership
         fields = ['id', 'tier', 'name', 'description', 'price', 'features', 'max_customizations_per_month', 'includes_health_protocol', 'created_at']
@@ -121,6 +158,11 @@ class CustomUserCreateSerializer(serializers.ModelSerializer):
         model = User
         fields = ['username', 'email', 'first_name', 'last_name', 'password', 'password2']
 
+    def validate_email(self, value):
+        if value and email_taken(value):
+            raise serializers.ValidationError('A user with this email already exists.')
+        return value
+
     def validate(self, data):
         if data['password'] != data.pop('password2'):
             raise serializers.ValidationError({"password": "Passwords must match."})
@@ -137,14 +179,14 @@ class CustomUserCreateSerializer(serializers.ModelSerializer):
         return user
 
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = ['id', 'subscription', 'amount', 'status', 'payment_method', 'transaction_ref', 'created_at', 'completed_at']
         read_only_fields = ['id', 'created_at', 'completed_at']
 
 
-class SubscriptionSerializer(serializers.ModelSerializer):
+class SubscriptionSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     membership = MembershipSerializer(read_only=True)
     membership_id = serializers.IntegerField(write_only=True, required=False)
     payments = PaymentSerializer(many=True, read_only=True)
@@ -165,9 +207,10 @@ class SubscriptionSerializer(serializers.ModelSerializer):
         return Subscription.objects.create(user=user, **validated_data)
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     current_membership = MembershipSerializer(read_only=True)
     user_details = serializers.SerializerMethodField()
+    shape_sources = {'user_details': ['user']}
 
     class Meta:
         model = Profile
@@ -192,19 +235,19 @@ class ProfileSerializer(serializers.ModelSerializer):
             }
 
 
-class PickupLocationSerializer(serializers.ModelSerializer):
+class PickupLocationSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = PickupLocation
         fields = '__all__'
 
 
-class IngredientCategorySerializer(serializers.ModelSerializer):
+class IngredientCategorySerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = IngredientCategory
         fields = ['id', 'name', 'description']
 
 
-class DeliveryAddressSerializer(serializers.ModelSerializer):
+class DeliveryAddressSerializer(ShapedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = DeliveryAddress
         fields = ['id', 'user', 'address_line1', 'address_line2', 'city', 'state', 'zip_code', 'is_default', 'created_at']
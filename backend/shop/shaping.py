@@ -0,0 +1,150 @@
+"""Request-driven response shapes: ``?fields=`` and ``?expand=``.
+
+    /api/orders/?fields=id,total_price,items.quantity,items.tea.name
+    /api/teas/?expand=            (ingredients as ids)
+    /api/carts/?expand=items,items.tea
+
+``fields`` keeps only the listed fields; a dotted path reaches into a nested
+serializer, and naming a nested field without children keeps all of its
+fields. ``expand`` lists the nested relations to render as objects; every
+other nested relation is rendered as its id (or list of ids). Without the
+parameter everything is expanded, so existing clients see no change.
+Unknown names are ignored. Only GET and HEAD responses are shaped.
+
+``ShapedSerializerMixin`` applies the shape to a serializer's fields, and
+``shape_queryset()`` derives ``only()`` and ``prefetch_related()`` from
+the same shaped serializer, so list views load exactly what they render.
+SerializerMethodFields declare what they read in ``shape_sources``; a
+serializer reading anything the shaper cannot see loads full rows.
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+
+def parse(value):
+    """'a,b.c,b.d' -> {'a': {}, 'b': {'c': {}, 'd': {}}}"""
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in filter(None, (part.strip() for part in path.split('.'))):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def requested(request, param):
+    """Parsed tree for ``param``, or None when the request does not restrict it"""
+    if request is None or request.method not in SAFE_METHODS:
+        return None
+    value = request.query_params.get(param)
+    return None if value is None else parse(value)
+
+
+def _descend(tree, path, missing):
+    for name in path:
+        if tree is None:
+            return None
+        tree = tree.get(name, missing)
+    return tree
+
+
+class ShapedSerializerMixin:
+    """Drop unrequested fields and collapse unexpanded relations to ids"""
+    shape_sources = {}  # SerializerMethodField name -> model fields it reads
+
+    def _shape_path(self):
+        path, node = [], self
+        while node.parent is not None:
+            if node.field_name:
+                path.insert(0, node.field_name)
+            node = node.parent
+        return path
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        path = self._shape_path()
+
+        wanted = _descend(requested(request, 'fields'), path, None)
+        if wanted:
+            fields = {name: field for name, field in fields.items() if name in wanted}
+
+        expand = requested(request, 'expand')
+        if expand is not None:
+            expanded = _descend(expand, path, {}) or {}
+            for name, field in list(fields.items()):
+                if isinstance(field, serializers.BaseSerializer) and name not in expanded:
+                    fields[name] = _as_ids(name, field)
+        return fields
+
+    @classmethod
+    def shape_base_queryset(cls, queryset):
+        """Hook for annotations the serializer needs on every queryset it renders"""
+        return queryset
+
+
+def _as_ids(name, field):
+    kwargs = {'read_only': True}
+    if field.source and field.source != name:
+        kwargs['source'] = field.source
+    if isinstance(field, serializers.ListSerializer):
+        kwargs['many'] = True
+    return serializers.PrimaryKeyRelatedField(**kwargs)
+
+
+def _model_field(model, source):
+    try:
+        return model._meta.get_field(source)
+    except FieldDoesNotExist:
+        return None
+
+
+def shape_queryset(queryset, serializer, required=()):
+    """Restrict ``queryset`` to the columns and relations the bound ``serializer`` renders"""
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    model = queryset.model
+    columns, prefetches, complete = {model._meta.pk.name, *required}, {}, True
+
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        source = field.source
+        if isinstance(field, serializers.SerializerMethodField):
+            sources = getattr(serializer, 'shape_sources', {}).get(name)
+            if sources is None:
+                complete = False
+                continue
+        elif source == '*' or '.' in source:
+            complete = False
+            continue
+        else:
+            sources = [source]
+
+        for source in sources:
+            model_field = _model_field(model, source)
+            if model_field is None:
+                # A property or annotation: unknown columns behind it
+                complete = False
+                continue
+            if model_field.concrete and not model_field.many_to_many:
+                columns.add(source)
+            if not model_field.is_relation or source in prefetches:
+                continue
+            if isinstance(field, serializers.BaseSerializer):
+                child = field.child if isinstance(field, serializers.ListSerializer) else field
+                related = model_field.related_model._default_manager.all()
+                if hasattr(child, 'shape_base_queryset'):
+                    related = child.shape_base_queryset(related)
+                # The reverse side of a foreign key needs its column to attach the rows
+                back = (model_field.field.name,) if model_field.one_to_many else ()
+                prefetches[source] = Prefetch(source, queryset=shape_queryset(related, child, back))
+            elif model_field.many_to_many or model_field.one_to_many or isinstance(field, serializers.SerializerMethodField):
+                # Ids only (or a method that reads the relation)
+                prefetches[source] = Prefetch(source)
+
+    if complete:
+        queryset = queryset.only(*columns)
+    return queryset.prefetch_related(*prefetches.values())
@@ -0,0 +1,110 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import analytics, catalog_sync, jwt_auth, stock
+from .cache import catalog_cache
+from .images import needs_variants, schedule_variants
+from .models import Tea, Ingredient, IngredientCategory, Membership, Order, OrderItem, Payment, PickupLocation
+
+
+@receiver(post_save, sender=Tea)
+@receiver(post_save, sender=Ingredient)
+def generate_image_variants(sender, instance, **kwargs):
+    """Queue thumbnail generation whenever a new image is uploaded"""
+    if needs_variants(instance):
+        schedule_variants(instance)
+
+
+@receiver(post_save, sender=Tea)
+@receiver(post_save, sender=Ingredient)
+def open_stock_ledger(sender, instance, created, raw=False, **kwargs):
+    """Start the ledger of a new product with its initial stock"""
+    if created and not raw:
+        stock.open_balances([instance])
+
+
+@receiver(post_save, sender=Tea)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=IngredientCategory)
+@receiver(post_save, sender=Membership)
+@receiver(post_save, sender=PickupLocation)
+@receiver(post_delete, sender=Tea)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=IngredientCategory)
+@receiver(post_delete, sender=Membership)
+@receiver(post_delete, sender=PickupLocation)
+@receiver(m2m_changed, sender=Tea.ingredients.through)
+def invalidate_catalog(sender, **kwargs):
+    """Drop cached catalog responses once the change is committed"""
+    transaction.on_commit(catalog_cache.bump)
+
+
+@receiver(post_save, sender=Tea)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=IngredientCategory)
+@receiver(post_save, sender=Membership)
+def log_catalog_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        catalog_sync.touch(sender, [instance.pk])
+
+
+@receiver(post_delete, sender=Tea)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=IngredientCategory)
+@receiver(post_delete, sender=Membership)
+def log_catalog_delete(sender, instance, **kwargs):
+    catalog_sync.touch(sender, [instance.pk], deleted=True)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(pre_delete, sender=Ingredient)
+def log_teas_of_ingredient(sender, instance, raw=False, **kwargs):
+    """Tea payloads embed their ingredients (stock-only changes excepted, see shop.catalog_sync)"""
+    if not raw:
+        catalog_sync.touch(Tea, instance.tea_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=IngredientCategory)
+def log_ingredients_of_category(sender, instance, **kwargs):
+    # SET_NULL rewrites the ingredients without sending signals
+    catalog_sync.touch(Ingredient, instance.ingredients.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Tea.ingredients.through)
+def log_tea_ingredients(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action in ('post_add', 'post_remove'):
+        catalog_sync.touch(Tea, pk_set)
+    elif reverse and action == 'pre_clear':
+        catalog_sync.touch(Tea, instance.tea_set.values_list('pk', flat=True))
+    elif not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        catalog_sync.touch(Tea, [instance.pk])
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def order_changed(sender, instance, created=False, **kwargs):
+    # A new unpaid order adds nothing to the rollups yet
+    if not created or instance.payment_status == 'paid':
+        analytics.mark_order(instance.pk)
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def order_item_changed(sender, instance, **kwargs):
+    analytics.mark_order(instance.order_id)
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def payment_changed(sender, instance, created=False, **kwargs):
+    if not created or instance.status == 'completed':
+        analytics.mark_payment(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def revoke_deactivated_tokens(sender, instance, created, raw=False, **kwargs):
+    # JWT requests no longer load the user, so is_active is not rechecked per request
+    if not created and not raw and not instance.is_active:
+        jwt_auth.revoke_user(instance)
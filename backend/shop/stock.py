@@ -0,0 +1,418 @@
+"""Append-only stock ledger.
+
+Every stock change is a StockMovement row: reserve (into a cart), release
+(back out of a cart), sell, restock, and adjust (stock count corrections).
+Request handlers only insert rows; they no longer rewrite the product row
+on every cart click, and every change is on record for later diagnosis.
+
+``Tea.quantity_in_stock`` and ``Ingredient.stock`` hold the balance as of
+the last compaction. ``compact()`` (``manage.py compact_stock``, run from
+cron) folds pending movements into them in batches. Until then
+
+    available = balance + sum(delta of pending movements)
+
+which ``available()`` and ``with_available_stock()`` compute. Compaction
+keeps the invariant ``balance == sum(delta of compacted movements)`` that
+``manage.py reconcile_stock`` checks.
+
+Checking out a cart records a release and a sell for each item, so
+reservations and sales can be told apart in the ledger.
+
+Catalog payloads include available stock. Most movements only change a
+count, so they leave the catalog cache and the sync feed alone and the
+counts there may be up to the cache TTL old. A product that runs out or
+comes back in stock invalidates both. Reservations check the ledger
+itself, never the cached count.
+
+Hot products can be sharded (``shard()``, or the admin action): their
+available stock is also split over ``stock_shards`` StockShard slots.
+Takes decrement a random slot with a conditional UPDATE instead of
+locking the product row, and puts add to a random slot, in the same
+transaction as the movement. The ledger stays authoritative;
+``rebalance()`` (run by compact_stock) re-spreads it evenly over the slots.
+"""
+import random
+
+from django.db import transaction
+from django.db.models import Case, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from . import catalog_sync
+from .cache import catalog_cache
+from .models import Ingredient, StockMovement, StockShard, Tea
+
+# model -> (movement foreign key, balance field)
+PRODUCTS = {
+    Tea: ('tea', 'quantity_in_stock'),
+    Ingredient: ('ingredient', 'stock'),
+}
+SIGNS = {'reserve': -1, 'release': 1, 'sell': -1, 'restock': 1}
+DEFAULT_SLOTS = 8
+# Random slots tried with a conditional decrement before locking them all
+SLOT_ATTEMPTS = 3
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product, available):
+        super().__init__(f'Not enough stock for {product}. Available: {available}')
+        self.product = product
+        self.available = available
+
+
+def _movement(product, kind, quantity, reference='', compacted=False):
+    fk, _ = PRODUCTS[type(product)]
+    delta = quantity if kind == 'adjust' else SIGNS[kind] * quantity
+    return StockMovement(**{fk: product}, kind=kind, delta=delta, reference=reference, compacted=compacted)
+
+
+def _net_changes(movements):
+    """(product, net delta) per product, in first-seen order"""
+    totals = {}
+    for m in movements:
+        product = m.tea if m.tea_id else m.ingredient
+        key = (type(product), product.pk)
+        totals[key] = (product, totals.get(key, (product, 0))[1] + m.delta)
+    return list(totals.values())
+
+
+def _crossed_zero(changes, before):
+    """Products from (product, delta) whose availability went from none to some or back.
+
+    ``before`` maps (model, pk) to the available stock before the changes,
+    where the caller already knows it; the rest are read after the insert.
+    """
+    crossed, unknown = [], {}
+    for product, delta in changes:
+        key = (type(product), product.pk)
+        if key in before:
+            if (before[key] > 0) != (before[key] + delta > 0):
+                crossed.append(product)
+        else:
+            unknown.setdefault(type(product), {})[product.pk] = (product, delta)
+    for model, products in unknown.items():
+        rows = with_available_stock(model.objects.filter(pk__in=products)).values_list('pk', 'available_stock')
+        for pk, now in rows:
+            product, delta = products[pk]
+            if (now - delta > 0) != (now > 0):
+                crossed.append(product)
+    return crossed
+
+
+def _bulk_record(movements, before=None):
+    movements = [m for m in movements if m.delta or m.kind != 'adjust']
+    if not movements:
+        return movements
+    changes = [(product, delta) for product, delta in _net_changes(movements) if delta]
+    sharded = [(product, delta) for product, delta in changes if product.stock_shards]
+    if sharded:
+        # Savepoint: a product that runs dry undoes the slots already changed
+        with transaction.atomic():
+            for product, delta in sharded:
+                if delta > 0:
+                    _put(product, delta)
+                elif not _withdraw(product, -delta):
+                    raise InsufficientStock(product, available(product))
+            StockMovement.objects.bulk_create(movements)
+    else:
+        StockMovement.objects.bulk_create(movements)
+
+    crossed = _crossed_zero(changes, before or {}) if changes else []
+    if crossed:
+        # Whether a product is in stock is part of the catalog payloads
+        for model in PRODUCTS:
+            catalog_sync.touch(model, [product.pk for product in crossed if type(product) is model])
+        transaction.on_commit(catalog_cache.bump)
+    return movements
+
+
+def record(product, kind, quantity, reference='', before=None):
+    """Append one movement; ``quantity`` is signed for 'adjust', otherwise positive.
+
+    ``before`` is the product's available stock, if the caller already read it.
+    """
+    known = {} if before is None else {(type(product), product.pk): before}
+    movements = _bulk_record([_movement(product, kind, quantity, reference)], known)
+    return movements[0] if movements else None
+
+
+def pending(product):
+    fk, _ = PRODUCTS[type(product)]
+    return StockMovement.objects.filter(**{fk: product}, compacted=False).aggregate(total=Sum('delta'))['total'] or 0
+
+
+def available(product):
+    fk, field = PRODUCTS[type(product)]
+    if product.stock_shards:
+        return StockShard.objects.filter(**{fk: product}).aggregate(total=Sum('quantity'))['total'] or 0
+    return getattr(product, field) + pending(product)
+
+
+def _ledger_available(model):
+    fk, field = PRODUCTS[model]
+    pending_sum = (StockMovement.objects.filter(**{fk: OuterRef('pk')}, compacted=False)
+                   .order_by().values(fk).annotate(total=Sum('delta')).values('total'))
+    return F(field) + Coalesce(Subquery(pending_sum), Value(0))
+
+
+def _slot_total(model):
+    fk, _ = PRODUCTS[model]
+    slots = (StockShard.objects.filter(**{fk: OuterRef('pk')})
+             .order_by().values(fk).annotate(total=Sum('quantity')).values('total'))
+    return Coalesce(Subquery(slots), Value(0))
+
+
+def with_available_stock(queryset):
+    """Annotate ``available_stock`` on a Tea or Ingredient queryset"""
+    model = queryset.model
+    return queryset.annotate(available_stock=Case(
+        When(stock_shards__gt=0, then=_slot_total(model)),
+        default=_ledger_available(model),
+    ))
+
+
+def _take(product, kind, quantity, reference):
+    if product.stock_shards:
+        # The slots do the check
+        return record(product, kind, quantity, reference)
+    # No savepoint: nothing is written unless the check passes
+    with transaction.atomic(savepoint=False):
+        # The row lock serializes takers of one product so two carts cannot
+        # both get the last unit; nothing on the row is written
+        locked = with_available_stock(type(product).objects.select_for_update(of=('self',))).get(pk=product.pk)
+        free = locked.available_stock
+        if locked.stock_shards:
+            # Sharded while we waited for the lock: the slots check instead
+            return record(locked, kind, quantity, reference)
+        if free >= quantity:
+            return record(locked, kind, quantity, reference, before=free)
+    raise InsufficientStock(product, free)
+
+
+def reserve(product, quantity, reference=''):
+    """Hold stock for a cart; raise InsufficientStock if it is not available"""
+    return _take(product, 'reserve', quantity, reference)
+
+
+def release(product, quantity, reference=''):
+    return record(product, 'release', quantity, reference)
+
+
+def sell(product, quantity, reference=''):
+    """Sell stock that was not reserved (orders created directly through the API)"""
+    return _take(product, 'sell', quantity, reference)
+
+
+def restock(product, quantity, reference=''):
+    return record(product, 'restock', quantity, reference)
+
+
+def adjust(product, delta, reference=''):
+    return record(product, 'adjust', delta, reference)
+
+
+def _item_product(item):
+    return item.ingredient if item.ingredient_id else item.tea
+
+
+def record_items(items, kind, reference=''):
+    """Record one movement per cart or order item in one insert, without a stock check"""
+    return _bulk_record([_movement(_item_product(i), kind, i.quantity, reference) for i in items])
+
+
+def release_items(items, reference=''):
+    """Release the reservations held by cart items"""
+    return record_items(items, 'release', reference)
+
+
+def sell_items(items, reference=''):
+    """Turn the reservations held by cart items into sales (one insert)"""
+    return _bulk_record([
+        _movement(_item_product(i), kind, i.quantity, reference)
+        for i in items
+        for kind in ('release', 'sell')
+    ])
+
+
+def _free(product):
+    """Available stock, locked until the transaction ends so it cannot shrink before it is taken"""
+    fk, _ = PRODUCTS[type(product)]
+    if product.stock_shards:
+        return sum(StockShard.objects.filter(**{fk: product}).select_for_update().values_list('quantity', flat=True))
+    return with_available_stock(type(product).objects.select_for_update(of=('self',))).get(pk=product.pk).available_stock
+
+
+def sell_paid(sold, reserved, reference=''):
+    """Record the sale of a paid order's ``sold`` items, of which ``reserved`` held cart reservations.
+
+    Reserved units become sales as in sell_items. The rest take what is
+    available and never drive stock below zero, so compaction and sharded
+    takes keep working; it has been paid for, so running short is not an
+    error. Returns {(model, pk): units short}.
+    """
+    need = {}
+    for item in sold:
+        product = _item_product(item)
+        key = (type(product), product.pk)
+        need[key] = (product, need.get(key, (product, 0))[1] + item.quantity)
+    for item in reserved:
+        product = _item_product(item)
+        key = (type(product), product.pk)
+        need[key] = (product, need[key][1] - item.quantity)
+
+    movements = [_movement(_item_product(i), kind, i.quantity, reference)
+                 for i in reserved for kind in ('release', 'sell')]
+    short = {}
+    # No savepoint: the locks only need to last until the movements are in
+    with transaction.atomic(savepoint=False):
+        for key, (product, quantity) in need.items():
+            if quantity <= 0:
+                continue
+            taken = min(quantity, max(_free(product), 0))
+            if taken:
+                movements.append(_movement(product, 'sell', taken, reference))
+            if taken < quantity:
+                short[key] = quantity - taken
+        _bulk_record(movements)
+    return short
+
+
+def open_balances(products, reference='opening'):
+    """Record the initial stock of new products as already-compacted restocks.
+
+    The balance field already holds the quantity, so the movement must not
+    be folded in again.
+    """
+    movements = []
+    for product in products:
+        _, field = PRODUCTS[type(product)]
+        if getattr(product, field):
+            movements.append(_movement(product, 'restock', getattr(product, field), reference, compacted=True))
+    return StockMovement.objects.bulk_create(movements)
+
+
+def _put(product, quantity):
+    fk, _ = PRODUCTS[type(product)]
+    StockShard.objects.filter(**{fk: product}, slot=random.randrange(product.stock_shards)).update(
+        quantity=F('quantity') + quantity)
+
+
+def _withdraw(product, quantity):
+    """Take ``quantity`` from the product's slots; False if they do not hold enough"""
+    fk, _ = PRODUCTS[type(product)]
+    slots = StockShard.objects.filter(**{fk: product})
+    for slot in random.sample(range(product.stock_shards), min(SLOT_ATTEMPTS, product.stock_shards)):
+        # Conditional decrement: only this slot's row is locked, and only briefly
+        if slots.filter(slot=slot, quantity__gte=quantity).update(quantity=F('quantity') - quantity):
+            return True
+
+    # No sampled slot holds enough (stock is running low): take across all of them
+    locked = list(slots.select_for_update().order_by('slot'))
+    if sum(shard.quantity for shard in locked) < quantity:
+        return False
+    for shard in sorted(locked, key=lambda shard: shard.quantity, reverse=True):
+        taken = min(shard.quantity, quantity)
+        slots.filter(pk=shard.pk).update(quantity=F('quantity') - taken)
+        quantity -= taken
+        if not quantity:
+            break
+    return True
+
+
+def shard(product, slots=DEFAULT_SLOTS):
+    """Split a product's available stock over ``slots`` slots; 0 goes back to the single row"""
+    model = type(product)
+    fk, _ = PRODUCTS[model]
+    with transaction.atomic():
+        # Writing the row waits for single-row reservations holding its lock
+        model.objects.filter(pk=product.pk).update(stock_shards=slots)
+        StockShard.objects.filter(**{fk: product}).delete()
+        StockShard.objects.bulk_create([StockShard(**{fk: product}, slot=slot) for slot in range(slots)])
+        product.stock_shards = slots
+        rebalance(product)
+    transaction.on_commit(catalog_cache.bump)
+
+
+def rebalance(product):
+    """Spread the ledger's available stock evenly over the product's slots.
+
+    Every slot is locked first, so no take or put is half done and the
+    ledger total is exact. This also repairs slots that drifted, e.g. a
+    release that raced with shard().
+    """
+    model = type(product)
+    fk, _ = PRODUCTS[model]
+    with transaction.atomic():
+        slots = list(StockShard.objects.filter(**{fk: product}).select_for_update().order_by('slot'))
+        if not slots:
+            return False
+        total = model.objects.filter(pk=product.pk).annotate(total=_ledger_available(model)).values_list('total', flat=True).get()
+        share, extra = divmod(max(total, 0), len(slots))
+        for i, slot in enumerate(slots):
+            quantity = share + (i < extra)
+            if slot.quantity != quantity:
+                StockShard.objects.filter(pk=slot.pk).update(quantity=quantity)
+    return True
+
+
+def rebalance_all():
+    """Rebalance every sharded product; return how many there were"""
+    count = 0
+    for model in PRODUCTS:
+        for product in model.objects.filter(stock_shards__gt=0).only('pk', 'stock_shards'):
+            count += rebalance(product)
+    return count
+
+
+def compact(batch_size=5000):
+    """Fold pending movements into the product balances; return how many were folded"""
+    folded = 0
+    while True:
+        with transaction.atomic():
+            # skip_locked lets two compactors run without waiting on each other
+            batch = list(StockMovement.objects.filter(compacted=False).order_by('id')
+                         .select_for_update(skip_locked=True)
+                         .values_list('id', 'tea_id', 'ingredient_id', 'delta')[:batch_size])
+            if not batch:
+                return folded
+            totals = {}
+            for _, tea_id, ingredient_id, delta in batch:
+                key = (Tea, tea_id) if tea_id else (Ingredient, ingredient_id)
+                totals[key] = totals.get(key, 0) + delta
+            for (model, pk), delta in totals.items():
+                if delta:
+                    _, field = PRODUCTS[model]
+                    model.objects.filter(pk=pk).update(**{field: F(field) + delta})
+            StockMovement.objects.filter(id__in=[row[0] for row in batch]).update(compacted=True)
+        folded += len(batch)
+
+
+def reconcile(model):
+    """Products of ``model`` whose balance differs from their compacted ledger.
+
+    One statement per model, so the balance and the ledger sum come from the
+    same snapshot even while compaction runs. Returns (product_id, name,
+    balance, ledger).
+    """
+    fk, field = PRODUCTS[model]
+    ledger_sum = (StockMovement.objects.filter(**{fk: OuterRef('pk')}, compacted=True)
+                  .order_by().values(fk).annotate(total=Sum('delta')).values('total'))
+    rows = (model.objects.order_by().annotate(ledger=Coalesce(Subquery(ledger_sum), Value(0)))
+            .exclude(ledger=F(field)).values_list('pk', 'name', field, 'ledger'))
+    return list(rows)
+
+
+def slot_drift(model):
+    """Sharded products whose slots no longer add up to the ledger; (product_id, name, slots, ledger)"""
+    rows = (model.objects.filter(stock_shards__gt=0).order_by()
+            .annotate(slots=_slot_total(model), ledger=_ledger_available(model))
+            .exclude(slots=F('ledger')).values_list('pk', 'name', 'slots', 'ledger'))
+    return list(rows)
+
+
+def fix(model, mismatches, reference='reconcile'):
+    """Accept the stored balances: append compacted adjustments so the ledger matches them"""
+    fk, _ = PRODUCTS[model]
+    return StockMovement.objects.bulk_create([
+        StockMovement(**{f'{fk}_id': pk}, kind='adjust', delta=balance - ledger, reference=reference, compacted=True)
+        for pk, _, balance, ledger in mismatches
+    ])
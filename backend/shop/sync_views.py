@@ -0,0 +1,52 @@
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+
+from . import catalog_sync, stock
+from .models import Ingredient, IngredientCategory, Membership, Tea
+from .serializers import IngredientCategorySerializer, IngredientSerializer, MembershipSerializer, TeaSerializer
+
+# Response key -> (change kind, queryset, serializer)
+SECTIONS = {
+    'teas': ('tea', lambda: stock.with_available_stock(Tea.objects.prefetch_related('ingredients')), TeaSerializer),
+    'ingredients': ('ingredient', lambda: stock.with_available_stock(Ingredient.objects.all()), IngredientSerializer),
+    'categories': ('category', lambda: IngredientCategory.objects.all(), IngredientCategorySerializer),
+    'memberships': ('membership', lambda: Membership.objects.all(), MembershipSerializer),
+}
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def catalog_sync_feed(request):
+    """
+    Teas, ingredients, categories and memberships changed since ?since=<token>,
+    plus the ids deleted since. Without a usable token the whole catalog is
+    returned with "full": true. Keep the returned token for the next call.
+    """
+    since = request.query_params.get('since') or None
+    if since is not None:
+        if not since.isdigit():
+            return Response({'error': 'since must be a token returned by a previous sync'}, status=400)
+        since = int(since)
+
+    # Take the token before reading, so anything changed meanwhile comes again next time
+    token = catalog_sync.settled_token()
+    # A token from before a database reset is newer than any change we have
+    full = since is None or since > catalog_sync.latest_id()
+    if full:
+        changed, deleted = None, {}
+    else:
+        token = max(token, since)
+        changed, deleted = catalog_sync.changes_between(since, token)
+
+    data = {'token': str(token), 'full': full}
+    for key, (kind, queryset, serializer) in SECTIONS.items():
+        if changed is None:
+            objects = queryset()
+        elif changed.get(kind):
+            objects = queryset().filter(pk__in=changed[kind])
+        else:
+            objects = []
+        data[key] = serializer(objects, many=True, context={'request': request}).data
+    data['deleted'] = {key: deleted.get(kind, []) for key, (kind, _, _) in SECTIONS.items()}
+    return Response(data)
@@ -1,3 +1,1503 @@
-from django.test import TestCase
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in, user_login_failed
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, connections
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from google.auth import crypt, jwt
+from PIL import Image
+from mybrutea_backend import middleware
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import admission, analytics, benchmarks, factories, fulfillment, images, jwt_auth, metrics, reconciliation, renderers, replicas, stock
+from .auth import authenticate_email
+from .cache import TieredCache, catalog_cache, clear_l1
+from .models import CartItem, CatalogChange, DailyRollup, Ingredient, IdempotencyRecord, Order, OrderItem, Payment, PaymentIntent, RollupSource, StockMovement, StockShard, Subscription, Tea
+from .throttling import TokenBucketThrottle, take
+from .google_auth import GoogleTokenVerifier
+from .loadtest import LoadTest, PaystackStub, Stats, VirtualUser
+
+
+def use_temp_media(test):
+    """Point MEDIA_ROOT at a throwaway directory for the rest of ``test``"""
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    override = override_settings(MEDIA_ROOT=directory.name)
+    override.enable()
+    test.addCleanup(override.disable)
+    return directory.name
+
+
+def png_upload(name='rose.png', size=(800, 400)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 60)).save(buffer, format='PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(THUMBNAIL_ASYNC=False)
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        use_temp_media(self)
+        # Keep this test's catalog responses out of later tests
+        self.addCleanup(clear_l1)
+        self.addCleanup(cache.clear)
+
+    def create_tea(self, **kwargs):
+        return Tea.objects.create(name='Rose', description='Floral', price=1000, quantity_in_stock=5, **kwargs)
+
+    def test_render_variants_writes_every_width_and_format(self):
+        name = default_storage.save('teas/rose.png', png_upload())
+        variants = images.render_variants(name)
+        self.assertEqual((variants['source'], len(variants['hash'])), (name, 12))
+        for fmt in images.AVAILABLE_FORMATS:
+            self.assertEqual(sorted(variants[fmt], key=int), ['160', '320', '640'])
+            for width, variant in variants[fmt].items():
+                self.assertTrue(variant.endswith(f'.{variants["hash"]}.{width}w.{fmt}'))
+                with default_storage.open(variant) as fh, Image.open(fh) as thumbnail:
+                    self.assertEqual((thumbnail.format, thumbnail.size), (fmt.upper(), (int(width), int(width) // 2)))
+
+        srcset = images.srcset(variants)
+        self.assertEqual(srcset['webp'].count('w, '), 2)
+        self.assertTrue(srcset['webp'].startswith(f'/media/thumbs/teas/rose.{variants["hash"]}.160w.webp 160w'))
+
+    def test_small_images_are_not_upscaled(self):
+        name = default_storage.save('teas/tiny.png', png_upload('tiny.png', size=(100, 50)))
+        self.assertEqual(list(images.render_variants(name)['webp']), ['100'])
+
+    def test_upload_generates_variants_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            tea = self.create_tea(image=png_upload())
+        tea.refresh_from_db()
+        self.assertEqual(tea.image_variants['source'], tea.image.name)
+        self.assertTrue(default_storage.exists(tea.image_variants['webp']['640']))
+        srcset = self.client.get(f'/api/teas/{tea.pk}/').json()['image_srcset']
+        self.assertIn('640w', srcset['webp'])
+
+        # Saving again without a new image leaves the variants alone
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            tea.save()
+        self.assertFalse([cb for cb in callbacks if 'schedule' in cb.__qualname__])
+
+    def test_backfill_is_idempotent(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            tea = self.create_tea(image=png_upload())
+        out = io.StringIO()
+        call_command('backfill_thumbnails', '--workers', '1', stdout=out)
+        self.assertIn('Generated thumbnails for 1 images (0 failed)', out.getvalue())
+        tea.refresh_from_db()
+        files = sorted(os.listdir(os.path.join(default_storage.location, 'thumbs', 'teas')))
+        self.assertEqual(len(files), 3 * len(images.AVAILABLE_FORMATS))
+
+        out = io.StringIO()
+        call_command('backfill_thumbnails', '--workers', '1', stdout=out)
+        self.assertIn('All images already have thumbnails', out.getvalue())
+        call_command('backfill_thumbnails', '--workers', '1', '--force', stdout=io.StringIO())
+        self.assertEqual(sorted(os.listdir(os.path.join(default_storage.location, 'thumbs', 'teas'))), files)
+        variants = tea.image_variants
+        tea.refresh_from_db()
+        self.assertEqual(tea.image_variants, variants)
+
+
+class MediaServingTests(SimpleTestCase):
+    body = b'0123456789' * 10
+
+    def setUp(self):
+        root = use_temp_media(self)
+        os.makedirs(os.path.join(root, 'docs'))
+        self.write(root, 'docs/menu.txt', self.body)
+        self.write(root, 'docs/menu.txt.gz', gzip.compress(self.body))
+        self.write(root, 'docs/menu.txt.br', b'brotli bytes')
+        self.write(root, 'docs/menu.3f2a9c0d1b7e.txt', self.body)
+
+    def write(self, root, name, data):
+        with open(os.path.join(root, name), 'wb') as fh:
+            fh.write(data)
+
+    def get(self, path='docs/menu.txt', **headers):
+        return self.client.get(f'/media/{path}', **headers)
+
+    def test_full_response_and_revalidation(self):
+        response = self.get()
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, self.body))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', self.get('docs/menu.3f2a9c0d1b7e.txt')['Cache-Control'])
+
+        etag = response['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=f'"other", {etag}').status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.get('docs/missing.txt').status_code, 404)
+        self.assertEqual(self.get('../settings.py').status_code, 404)
+
+    def test_byte_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual((response.status_code, response.content), (206, b'0123456789'))
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(self.get(HTTP_RANGE='bytes=-3').content, b'789')
+        self.assertEqual(self.get(HTTP_RANGE='bytes=95-200').content, b'56789')
+
+        response = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */100'))
+        # Several ranges are answered with the whole file
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-1,5-6').status_code, 200)
+
+    def test_precompressed_variants_follow_accept_encoding(self):
+        def encoding(accept):
+            return self.get(HTTP_ACCEPT_ENCODING=accept).get('Content-Encoding')
+
+        self.assertEqual(encoding('gzip, br'), 'br')
+        self.assertEqual(encoding('br;q=0, gzip'), 'gzip')
+        self.assertEqual(encoding('br;q=0.5, gzip'), 'gzip')
+        self.assertIsNone(encoding('identity'))
+        self.assertIsNone(encoding('gzip;q=0'))
+
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.body)
+        self.assertNotEqual(response['ETag'], self.get()['ETag'])
+        # No brotli sibling for the hashed copy, and none needed
+        self.assertIsNone(self.get('docs/menu.3f2a9c0d1b7e.txt', HTTP_ACCEPT_ENCODING='br').get('Content-Encoding'))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.addCleanup(clear_l1)
+        self.addCleanup(cache.clear)
+
+    def test_exposition_format(self):
+        registry = metrics.Registry()
+        logins = registry.register(metrics.Counter('logins_total', 'Logins', ['method']))
+        queue = registry.register(metrics.Gauge('queue_length', 'Waiting'))
+        latency = registry.register(metrics.Histogram('latency_seconds', 'Latency', ['route'], buckets=(0.1, 1)))
+        logins.inc(method='password')
+        logins.inc(2, method='google "one tap"')
+        queue.set(5)
+        queue.dec()
+        latency.observe(0.05, route='teas/')
+        latency.observe(0.5, route='teas/')
+        self.assertIs(registry.register(metrics.Counter('logins_total', 'Again')), logins)
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="teas/",le="0.1"} 1',
+            'latency_seconds_bucket{route="teas/",le="1.0"} 2',
+            'latency_seconds_bucket{route="teas/",le="+Inf"} 2',
+            'latency_seconds_sum{route="teas/"} 0.55',
+            'latency_seconds_count{route="teas/"} 2',
+            '# HELP logins_total Logins',
+            '# TYPE logins_total counter',
+            'logins_total{method="google \\"one tap\\""} 2',
+            'logins_total{method="password"} 1',
+            '# HELP queue_length Waiting',
+            '# TYPE queue_length gauge',
+            'queue_length 4',
+        ]) + '\n')
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_endpoint_needs_token_or_staff(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE http_requests_total counter', response.content.decode())
+
+        user = User.objects.create_user('customer', password='pw')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 200)
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_middleware_records_requests_by_route(self):
+        route = 'api/teas/$'  # the router's pattern, not the path
+        before = middleware.REQUESTS.value(method='GET', route=route, status=200)
+        queries = middleware.DB_QUERIES.snapshot(method='GET', route=route)['count']
+        self.client.get('/api/teas/')
+        self.assertEqual(middleware.REQUESTS.value(method='GET', route=route, status=200), before + 1)
+        self.assertEqual(middleware.DB_QUERIES.snapshot(method='GET', route=route)['count'], queries + 1)
+
+        profile = self.client.get('/api/teas/', HTTP_X_PROFILE='scrape-secret').content.decode()
+        self.assertTrue(profile.startswith('GET /api/teas/ -> 200'))
+        self.assertIn('cumulative', profile)
+        self.assertNotIn('cumulative', self.client.get('/api/teas/', HTTP_X_PROFILE='wrong').content.decode())
+
+
+class EndpointQueryBudgetTests(TestCase):
+    """Fail when an endpoint runs more queries than recorded in benchmark_baseline.json.
+
+    After an intentional change, refresh the baseline with
+    ``python manage.py benchmark_api --update-baseline``.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def test_every_route_is_benchmarked(self):
+        self.assertEqual(benchmarks.uncovered_routes(), [])
+
+    def test_query_counts_within_baseline(self):
+        baseline = benchmarks.load_baseline().get('small')
+        self.assertTrue(baseline, 'No small-volume baseline recorded')
+        results = benchmarks.run(self.ctx, repeat=1)
+        self.assertEqual(benchmarks.compare(results, baseline), [])
+
+    def test_cart_queries_do_not_grow_with_the_cart(self):
+        client = APIClient()
+        client.force_authenticate(self.ctx['user'])
+        cart = self.ctx['user'].shop_cart
+
+        def queries(path, data_for):
+            item = CartItem.objects.create(cart=cart, tea=self.ctx['tea'], quantity=1)
+            with CaptureQueriesContext(connection) as captured:
+                client.post(path, data_for(item), format='json')
+            return len(captured)
+
+        for path, data_for in [('/api/cart/update/', lambda item: {'cart_item_id': item.id, 'quantity': 2}),
+                               ('/api/cart/remove/', lambda item: {'cart_item_id': item.id})]:
+            counts = [queries(path, data_for)]
+            for tea in Tea.objects.exclude(pk=self.ctx['tea'].pk)[:5]:
+                CartItem.objects.create(cart=cart, tea=tea, quantity=1)
+            counts.append(queries(path, data_for))
+            self.assertEqual(counts[0], counts[1], path)
+
+
+def fake_response(status, body=None):
+    return mock.Mock(status_code=status, json=mock.Mock(return_value=body or {}))
+
+
+class LoadTestHarnessTests(SimpleTestCase):
+    def test_report_aggregates_steps(self):
+        stats = Stats()
+        for status, elapsed in [(201, 0.010), (201, 0.030), (400, 0.020), (500, 0.040), ('error', 1.0)]:
+            stats.record('add_to_cart', status, elapsed)
+        stats.record('add_to_cart', 'queued', 0.001)
+        stats.record_wait('add_to_cart', 2.5)
+        stats.record('browse', 200, 0.005)
+
+        report = stats.report(elapsed=2.0)
+        self.assertEqual((report['requests'], report['queued'], report['error_rate']), (7, 1, round(2 / 7, 4)))
+        self.assertEqual(report['throughput_rps'], 3.5)
+        add = report['steps'][0]
+        self.assertEqual(add['step'], 'add_to_cart')
+        self.assertEqual((add['requests'], add['rps'], add['errors'], add['queued']), (6, 3.0, 2, 1))
+        # Queued answers stay out of the served-request latencies
+        self.assertEqual((add['p50_ms'], add['p95_ms'], add['queue_wait_p95_ms']), (30.0, 1000.0, 2500.0))
+        self.assertEqual(add['statuses'], {201: 2, 400: 1, 500: 1, 'error': 1, 'queued': 1})
+        self.assertIsNone(report['steps'][1]['queue_wait_p95_ms'])
+
+    @mock.patch('shop.loadtest.time.sleep')
+    def test_queued_calls_wait_in_line_and_retry_with_the_ticket(self, sleep):
+        harness = LoadTest('http://shop.test/', None, [], '', [], None, max_queue_wait=30)
+        user = VirtualUser(harness, 'shopper')
+        user.session = mock.Mock()
+        user.session.request.side_effect = [
+            fake_response(503, {'queued': True, 'ticket': 'T1', 'position': 3, 'retry_after': 2}),
+            fake_response(201),
+        ]
+        user.session.get.side_effect = [
+            fake_response(200, {'admitted': False, 'position': 1, 'retry_after': 1}),
+            fake_response(200, {'admitted': True, 'position': 0, 'retry_after': 0}),
+        ]
+
+        response = user.call('add_to_cart', 'POST', '/api/cart/add/', json={'tea_id': 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [2, 1])
+        retry = user.session.request.call_args_list[1]
+        self.assertEqual(retry.kwargs['headers'], {'X-Queue-Ticket': 'T1'})
+        self.assertEqual(user.session.get.call_args.kwargs['params'], {'ticket': 'T1'})
+
+        report = harness.stats.report(elapsed=1.0)
+        steps = {row['step']: row for row in report['steps']}
+        self.assertEqual(steps['add_to_cart']['statuses'], {'queued': 1, 201: 1})
+        self.assertEqual((steps['add_to_cart']['errors'], steps['queue_status']['requests']), (0, 2))
+        self.assertIsNotNone(steps['add_to_cart']['queue_wait_p95_ms'])
+
+    @mock.patch('shop.loadtest.time.sleep')
+    def test_gives_up_after_max_queue_wait(self, sleep):
+        harness = LoadTest('http://shop.test', None, [], '', [], None, max_queue_wait=1)
+        user = VirtualUser(harness, 'shopper')
+        user.session = mock.Mock()
+        user.session.request.return_value = fake_response(
+            503, {'queued': True, 'ticket': 'T1', 'position': 90, 'retry_after': 5})
+
+        self.assertIsNone(user.call('add_to_cart', 'POST', '/api/cart/add/'))
+        self.assertFalse(user.session.get.called)
+        row = harness.stats.report(elapsed=1.0)['steps'][0]
+        self.assertEqual((row['statuses'], row['errors']), ({'queued': 1, 'queue_timeout': 1}, 1))
+        # An ordinary 503 is an error, not a queue
+        user.session.request.return_value = fake_response(503, {'detail': 'down'})
+        self.assertEqual(user.call('browse', 'GET', '/api/teas/').status_code, 503)
+        self.assertEqual(harness.stats.report(elapsed=1.0)['steps'][1]['errors'], 1)
+
+
+def make_signing_key(key_id):
+    """Return (signer, PEM certificate) for a throwaway RSA key"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, key_id)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256()))
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption())
+    return crypt.RSASigner.from_string(pem, key_id), cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+class FakeCertsSession:
+    """Serves a certs document the way Google does, counting downloads"""
+
+    def __init__(self, certs, max_age=3600, delay=0.0):
+        self.certs = certs
+        self.max_age = max_age
+        self.delay = delay
+        self.calls = 0
+
+    def get(self, url, timeout=None, headers=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        return mock.Mock(status_code=200, headers={'Cache-Control': f'public, max-age={self.max_age}'},
+                         json=mock.Mock(return_value=dict(self.certs)))
+
+
+class GoogleTokenVerifierTests(SimpleTestCase):
+    audience = 'client-id.apps.googleusercontent.com'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.signer, cls.cert = make_signing_key('key-1')
+
+    def setUp(self):
+        self.now = time.time()
+        self.session = FakeCertsSession({'key-1': self.cert})
+        self.verifier = GoogleTokenVerifier(self.audience, session=self.session, clock=lambda: self.now)
+
+    def make_token(self, signer=None, **claims):
+        now = int(time.time())
+        payload = {'iss': 'https://accounts.google.com', 'aud': self.audience, 'sub': '1234',
+                   'email': 'tea@example.com', 'iat': now, 'exp': now + 600}
+        payload.update(claims)
+        return jwt.encode(signer or self.signer, payload).decode()
+
+    def test_valid_token_returns_claims(self):
+        claims = self.verifier.verify(self.make_token())
+        self.assertEqual(claims['email'], 'tea@example.com')
+
+    def test_certs_cached_until_max_age(self):
+        self.verifier.verify(self.make_token())
+        self.verifier.verify(self.make_token())
+        self.assertEqual(self.session.calls, 1)
+        self.now += 3601
+        self.verifier.verify(self.make_token())
+        self.assertEqual(self.session.calls, 2)
+
+    def test_concurrent_refreshes_share_one_download(self):
+        self.session.delay = 0.05
+        threads = [threading.Thread(target=self.verifier.certs) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.session.calls, 1)
+
+    def test_unknown_key_id_refreshes_certs(self):
+        self.verifier.certs()
+        rotated, cert = make_signing_key('key-2')
+        self.session.certs['key-2'] = cert
+        self.now += self.verifier.min_refresh_interval
+        self.verifier.verify(self.make_token(signer=rotated))
+        self.assertEqual(self.session.calls, 2)
+
+    def test_rejects_wrong_audience_and_issuer(self):
+        with self.assertRaises(ValueError):
+            self.verifier.verify(self.make_token(aud='someone-else'))
+        with self.assertRaises(ValueError):
+            self.verifier.verify(self.make_token(iss='https://evil.example.com'))
+
+
+@override_settings(PASSWORD_HASH_ITERATIONS=1000)
+class EmailLoginTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tee', email='Tee@Example.com', password='s3cret-pass')
+
+    def test_login_is_case_insensitive(self):
+        response = self.client.post('/api/auth/login/', {'email': 'tee@example.COM', 'password': 's3cret-pass'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user']['id'], self.user.id)
+
+    def test_wrong_password_and_inactive_user_rejected(self):
+        self.assertIsNone(authenticate_email('tee@example.com', 'wrong'))
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsNone(authenticate_email('tee@example.com', 's3cret-pass'))
+
+    def test_login_sends_auth_signals(self):
+        failed, logged_in = mock.Mock(), mock.Mock()
+        user_login_failed.connect(failed)
+        user_logged_in.connect(logged_in)
+        self.addCleanup(user_login_failed.disconnect, failed)
+        self.addCleanup(user_logged_in.disconnect, logged_in)
+
+        self.client.post('/api/auth/login/', {'email': 'tee@example.com', 'password': 'wrong'},
+                         content_type='application/json')
+        self.assertEqual(failed.call_args.kwargs['credentials'], {'email': 'tee@example.com'})
+        self.client.post('/api/auth/login/', {'email': 'tee@example.com', 'password': 's3cret-pass'},
+                         content_type='application/json')
+        self.assertEqual(logged_in.call_args.kwargs['user'], self.user)
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+    def test_rehashes_with_new_iteration_count(self):
+        with override_settings(PASSWORD_HASH_ITERATIONS=1200):
+            authenticate_email('tee@example.com', 's3cret-pass')
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$1200$'))
+
+    def test_email_unique_regardless_of_case(self):
+        with self.assertRaises(IntegrityError):
+            User.objects.create_user('tee2', email='TEE@example.com', password='x')
+
+
+@override_settings(PASSWORD_HASH_ITERATIONS=1000)
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def login(self, **headers):
+        return self.client.post('/api/auth/login/', {'email': 'nobody@example.com', 'password': 'x'},
+                                content_type='application/json', **headers)
+
+    def test_bucket_refills_over_time(self):
+        allowed, state, _ = take(None, 0.0, capacity=2, refill=1.0, cost=2)
+        self.assertTrue(allowed)
+        allowed, state, wait = take(state, 0.5, capacity=2, refill=1.0, cost=1)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 0.5)
+        allowed, _, _ = take(state, 1.0, capacity=2, refill=1.0, cost=1)
+        self.assertTrue(allowed)
+
+    def test_login_scope_throttles_per_ip(self):
+        statuses = [self.login().status_code for _ in range(11)]
+        self.assertEqual(statuses[:10], [401] * 10)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # Catalog reads come out of a different bucket
+        self.assertEqual(self.client.get('/api/teas/').status_code, 200)
+
+    def test_spoofed_forwarded_for_does_not_reset_the_bucket(self):
+        statuses = [self.login(HTTP_X_FORWARDED_FOR=f'10.0.0.{n}').status_code for n in range(11)]
+        self.assertEqual(statuses, [401] * 10 + [429])
+
+    def test_weighted_cost(self):
+        with override_settings(THROTTLE_ROUTE_COSTS={'login': ('login', 5)}):
+            statuses = [self.login().status_code for _ in range(3)]
+        self.assertEqual(statuses, [401, 401, 429])
+
+    def test_route_cost_can_depend_on_the_method(self):
+        user = User.objects.create_user('reader', email='reader@example.com', password='x')
+        client = APIClient()
+        client.force_authenticate(user)
+        # Reading the user list and /me is not a registration attempt
+        for _ in range(6):
+            self.assertEqual(client.get('/api/auth/users/me/').status_code, 200)
+            self.assertEqual(client.get('/api/auth/users/').status_code, 200)
+        registrations = [self.client.post('/api/auth/users/', {'username': f'new{i}', 'password': 'short'},
+                                          content_type='application/json').status_code for i in range(4)]
+        self.assertEqual(registrations[3], 429)
+
+    def test_falls_back_to_local_buckets_when_cache_fails(self):
+        broken = mock.Mock(get=mock.Mock(side_effect=ConnectionError('cache down')))
+        with mock.patch.object(TokenBucketThrottle, 'cache', broken), self.assertLogs('shop.throttling', 'WARNING'):
+            self.assertEqual(self.login().status_code, 401)
+
+
+class TieredCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache = TieredCache(f'test-{self._testMethodName}', ttl=60)
+
+    def test_l1_then_l2_then_miss(self):
+        self.cache.set('k', 'v')
+        self.assertEqual(self.cache.get('k'), 'v')
+        self.cache.l1.clear()
+        self.assertEqual(self.cache.get('k'), 'v')
+        self.assertIsNone(self.cache.get('other'))
+        self.assertEqual(self.cache.stats(), {'l1_hit': 1, 'l2_hit': 1, 'miss': 1})
+
+    def test_bump_invalidates_prefix(self):
+        self.cache.set('k', 'v')
+        self.cache.bump()
+        self.assertIsNone(self.cache.get('k'))
+
+    def test_get_or_set_computes_once_under_concurrency(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_set('k', compute)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 8)
+
+    def test_catalog_list_invalidated_on_save(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            tea = Tea.objects.create(name='Hibiscus', description='Red', price=1000, quantity_in_stock=5)
+        self.assertEqual(self.client.get('/api/teas/').json()[0]['name'], 'Hibiscus')
+        with self.assertNumQueries(0):
+            self.client.get('/api/teas/')
+        with self.captureOnCommitCallbacks(execute=True):
+            tea.name = 'Zobo'
+            tea.save()
+        self.assertEqual(self.client.get('/api/teas/').json()[0]['name'], 'Zobo')
+
+
+class OrderExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    client_class = APIClient
+
+    def setUp(self):
+        self.client.force_authenticate(self.ctx['staff'])
+
+    def get(self, path):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_has_one_row_per_item(self):
+        lines = self.get('/api/orders/export/csv/').splitlines()
+        self.assertEqual(lines[0].split(',')[:2], ['order_id', 'created_at'])
+        self.assertEqual(len(lines) - 1, Order.objects.values('items').count())
+
+    def test_ndjson_filters(self):
+        rows = [json.loads(line) for line in self.get('/api/orders/export/ndjson/?payment_status=paid').splitlines()]
+        self.assertTrue(rows)
+        self.assertEqual({row['payment_status'] for row in rows}, {'paid'})
+        self.assertEqual(self.get('/api/orders/export/ndjson/?start=2999-01-01'), '')
+
+    def test_staff_only_and_validated(self):
+        self.assertEqual(self.client.get('/api/orders/export/xml/').status_code, 404)
+        self.assertEqual(self.client.get('/api/orders/export/csv/?end=yesterday').status_code, 400)
+        self.client.force_authenticate(self.ctx['user'])
+        self.assertEqual(self.client.get('/api/orders/export/csv/').status_code, 403)
+
+
+class SalesAnalyticsTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        self.client.force_authenticate(self.ctx['staff'])
+
+    def test_rollups_match_order_history(self):
+        paid = Order.objects.filter(payment_status='paid')
+        totals = DailyRollup.objects.filter(dimension='total')
+        self.assertEqual(sum(totals.values_list('orders', flat=True)), paid.count())
+        self.assertEqual(sum(totals.values_list('units', flat=True)),
+                         sum(OrderItem.objects.filter(order__in=paid).values_list('quantity', flat=True)))
+
+    def test_new_paid_order_updates_its_day(self):
+        before = DailyRollup.objects.filter(dimension='total', date=timezone.localdate()).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(user=self.ctx['user'], total_price=1000, payment_status='paid',
+                                         delivery_type='delivery', delivery_city='Ilorin')
+            OrderItem.objects.create(order=order, tea=self.ctx['tea'], quantity=4)
+        after = DailyRollup.objects.get(dimension='total', date=timezone.localdate())
+        self.assertEqual(after.orders, (before.orders if before else 0) + 1)
+        self.assertTrue(DailyRollup.objects.filter(dimension='city', key='Ilorin').exists())
+
+    def rollups(self, day):
+        return sorted(DailyRollup.objects.filter(date=day).values_list(
+            'dimension', 'key', 'orders', 'units', 'revenue', 'delivery_fees'))
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        today = timezone.localdate()
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(user=self.ctx['user'], total_price=1000, payment_status='paid',
+                                         delivery_type='pickup', pickup_location='Test kiosk')
+            OrderItem.objects.create(order=order, tea=self.ctx['tea'], quantity=2)
+            OrderItem.objects.create(order=order, tea=self.ctx['tea'], quantity=1)
+        incremental = self.rollups(today)
+        self.assertIn(('pickup', 'Test kiosk', 1, 0, Decimal('1000.00'), Decimal('0.00')), incremental)
+        # Applying the same order again changes nothing
+        analytics.apply_changes(order_ids=[order.pk])
+        self.assertEqual(self.rollups(today), incremental)
+        analytics.rebuild(today, today)
+        self.assertEqual(self.rollups(today), incremental)
+
+    def test_order_that_stops_being_paid_is_subtracted(self):
+        today = timezone.localdate()
+        before = self.rollups(today)
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(user=self.ctx['user'], total_price=700, payment_status='paid',
+                                         delivery_type='delivery', delivery_city='Kano')
+            OrderItem.objects.create(order=order, ingredient=self.ctx['ingredient'], quantity=3)
+        self.assertNotEqual(self.rollups(today), before)
+        with self.captureOnCommitCallbacks(execute=True):
+            order.payment_status = 'failed'
+            order.save()
+        self.assertEqual(self.rollups(today), before)
+        self.assertFalse(RollupSource.objects.filter(kind='order', object_id=order.pk).exists())
+
+    def test_reports(self):
+        daily = self.client.get('/api/analytics/daily/?start=2000-01-01').json()
+        self.assertEqual(sum(row['orders'] for row in daily['rows']),
+                         Order.objects.filter(payment_status='paid').count())
+        with self.assertNumQueries(1):
+            teas = self.client.get('/api/analytics/tea/?start=2000-01-01&limit=3').json()
+        self.assertEqual(len(teas['rows']), 3)
+        self.assertEqual(self.client.get('/api/analytics/weather/').status_code, 404)
+        self.assertEqual(self.client.get('/api/analytics/daily/?start=2020-02-02&end=2020-01-01').status_code, 400)
+        for limit in ('-1', '0', 'ten'):
+            with self.subTest(limit=limit):
+                self.assertEqual(self.client.get('/api/analytics/tea/', {'limit': limit}).status_code, 400)
+
+
+class AdminChangelistTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        self.client.force_login(self.ctx['staff'])
+
+    def test_changelists_use_bounded_queries(self):
+        for model in ('order', 'orderitem', 'subscription', 'payment', 'paymentintent', 'tea', 'ingredient', 'deliveryaddress'):
+            with self.subTest(model=model), CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(f'/admin/shop/{model}/')
+                self.assertEqual(response.status_code, 200)
+            # Session, user, count, page and filter lookups; never one query per row
+            self.assertLess(len(ctx.captured_queries), 12)
+
+    def test_change_pages_render(self):
+        order = self.ctx['order']
+        self.assertEqual(self.client.get(f'/admin/shop/order/{order.id}/change/').status_code, 200)
+        self.assertEqual(self.client.get(f'/admin/shop/subscription/{self.ctx["subscription"].id}/change/').status_code, 200)
+
+    def test_stock_edits_become_adjustments(self):
+        ingredient = Ingredient.objects.get(pk=self.ctx['ingredient'].pk)
+        stock.reserve(ingredient, 2, reference='cart')
+        available = stock.available(ingredient)
+        url = f'/admin/shop/ingredient/{ingredient.id}/change/'
+        self.assertContains(self.client.get(url), f'value="{available}"')
+        form = {'name': ingredient.name, 'description': ingredient.description, 'price': ingredient.price,
+                'category': ingredient.category_id or '', 'stock': available + 5}
+        self.assertEqual(self.client.post(url, form).status_code, 302)
+        self.assertEqual(stock.available(ingredient), available + 5)
+        movement = StockMovement.objects.filter(ingredient=ingredient).latest('id')
+        self.assertEqual((movement.kind, movement.delta), ('adjust', 5))
+        # The balance column is left to compaction
+        self.assertEqual(Ingredient.objects.get(pk=ingredient.pk).stock, ingredient.stock)
+
+
+class IdempotencyTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        self.client.force_authenticate(self.ctx['user'])
+
+    def add(self, key, quantity=1):
+        return self.client.post('/api/cart/add/', {'tea_id': self.ctx['tea'].id, 'quantity': quantity},
+                                format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_stored_response(self):
+        before = stock.available(Tea.objects.get(pk=self.ctx['tea'].pk))
+        first = self.add('retry-1')
+        second = self.add('retry-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(stock.available(Tea.objects.get(pk=self.ctx['tea'].pk)), before - 1)
+
+    def test_key_reused_for_different_request(self):
+        self.add('reuse-1')
+        self.assertEqual(self.add('reuse-1', quantity=2).status_code, 422)
+
+    @override_settings(IDEMPOTENCY_WAIT=0)
+    def test_duplicate_while_processing(self):
+        first = self.add('busy-1')
+        IdempotencyRecord.objects.filter(key='busy-1').update(status='processing')
+        second = self.add('busy-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 409)
+
+    def test_retry_takes_over_an_attempt_past_its_lease(self):
+        self.add('stuck-1')
+        # The first attempt's worker died mid-request
+        IdempotencyRecord.objects.filter(key='stuck-1').update(
+            status='processing', response_body=None, claimed_at=timezone.now() - datetime.timedelta(minutes=5),
+        )
+        stale = IdempotencyRecord.objects.get(key='stuck-1').claimed_at
+        retry = self.add('stuck-1')
+        self.assertEqual(retry.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', retry)
+        # The stale attempt cannot overwrite the retry's stored response
+        IdempotencyRecord.objects.filter(key='stuck-1', claimed_at=stale).update(response_status=500)
+        record = IdempotencyRecord.objects.get(key='stuck-1')
+        self.assertEqual((record.status, record.response_status), ('done', 201))
+        self.assertEqual(self.add('stuck-1')['Idempotent-Replayed'], 'true')
+
+    def test_expired_records_run_again_and_are_purged(self):
+        self.add('old-1')
+        IdempotencyRecord.objects.filter(key='old-1').update(created_at=timezone.now() - datetime.timedelta(days=2))
+        self.assertNotIn('Idempotent-Replayed', self.add('old-1'))
+        IdempotencyRecord.objects.update(created_at=timezone.now() - datetime.timedelta(days=2))
+        call_command('purge_idempotency_keys', stdout=io.StringIO())
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+    def test_requests_without_key_are_untouched(self):
+        self.client.post('/api/cart/add/', {'tea_id': self.ctx['tea'].id, 'quantity': 1}, format='json')
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+
+class StockLedgerTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        self.client.force_authenticate(self.ctx['user'])
+        self.tea = Tea.objects.get(pk=self.ctx['tea'].pk)
+
+    def test_cart_operations_append_movements(self):
+        balance, available = self.tea.quantity_in_stock, stock.available(self.tea)
+        held = CartItem.objects.filter(cart__user=self.ctx['user'], tea=self.tea).first()
+        held = held.quantity if held else 0
+
+        self.client.post('/api/cart/add/', {'tea_id': self.tea.id, 'quantity': 2}, format='json')
+        self.assertEqual(stock.available(self.tea), available - 2)
+        item = CartItem.objects.get(cart__user=self.ctx['user'], tea=self.tea)
+        self.client.post('/api/cart/update/', {'cart_item_id': item.id, 'quantity': item.quantity - 1}, format='json')
+        self.assertEqual(stock.available(self.tea), available - 1)
+        self.client.post('/api/cart/remove/', {'cart_item_id': item.id}, format='json')
+        self.assertEqual(stock.available(self.tea), available + held)
+
+        # Only movements were written; the balance waits for compaction
+        self.assertEqual(Tea.objects.get(pk=self.tea.pk).quantity_in_stock, balance)
+        kinds = StockMovement.objects.filter(tea=self.tea, reference__startswith='cart:').order_by('id')
+        self.assertEqual(list(kinds.values_list('kind', flat=True)), ['reserve', 'release', 'release'])
+
+    def test_reserve_refuses_more_than_available(self):
+        response = self.client.post('/api/cart/add/', {'tea_id': self.tea.id, 'quantity': stock.available(self.tea) + 1},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(f'Available: {stock.available(self.tea)}', response.json()['error'])
+
+    def test_checkout_turns_reservations_into_sales(self):
+        items = list(CartItem.objects.filter(cart__user=self.ctx['user']))
+        available = {(i.tea_id, i.ingredient_id): stock.available(i.tea or i.ingredient) for i in items}
+        response = self.client.post('/api/checkout/place-order/', {'delivery_type': 'pickup', 'pickup_id': self.ctx['pickup'].id},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        sold = StockMovement.objects.filter(reference=f"order:{response.json()['id']}")
+        self.assertEqual(sold.filter(kind='sell').count(), len(items))
+        for item in items:
+            self.assertEqual(stock.available(item.tea or item.ingredient), available[(item.tea_id, item.ingredient_id)])
+
+    def test_failed_checkout_leaves_no_order_and_keeps_the_cart(self):
+        orders, in_cart = Order.objects.count(), CartItem.objects.filter(cart__user=self.ctx['user']).count()
+        with mock.patch('shop.cart_views.stock.sell_items', side_effect=RuntimeError('ledger down')):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/api/checkout/place-order/', {'delivery_type': 'pickup', 'pickup_id': self.ctx['pickup'].id},
+                                 format='json')
+        self.assertEqual(Order.objects.count(), orders)
+        self.assertEqual(CartItem.objects.filter(cart__user=self.ctx['user']).count(), in_cart)
+
+    def test_compaction_keeps_available_stock_and_reconciles(self):
+        stock.restock(self.tea, 10)
+        stock.reserve(self.tea, 3)
+        available = stock.available(self.tea)
+        self.assertGreater(stock.compact(batch_size=4), 2)
+
+        self.tea.refresh_from_db()
+        self.assertEqual(self.tea.quantity_in_stock, available)
+        self.assertEqual(stock.pending(self.tea), 0)
+        self.assertEqual(stock.reconcile(Tea), [])
+        self.assertEqual(self.client.get(f'/api/teas/{self.tea.id}/').json()['quantity_in_stock'], available)
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        Tea.objects.filter(pk=self.tea.pk).update(quantity_in_stock=F('quantity_in_stock') + 7)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_stock', stdout=io.StringIO())
+        call_command('reconcile_stock', '--fix', stdout=io.StringIO())
+        self.assertEqual(StockMovement.objects.get(tea=self.tea, kind='adjust').delta, 7)
+        out = io.StringIO()
+        call_command('reconcile_stock', stdout=out)
+        self.assertIn('All stock balances match', out.getvalue())
+
+
+class ShardedStockTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        self.client.force_authenticate(self.ctx['user'])
+        self.tea = Tea.objects.create(name='Launch Blend', description='Hot', price=1000, quantity_in_stock=10)
+
+    def add(self, quantity):
+        return self.client.post('/api/cart/add/', {'tea_id': self.tea.id, 'quantity': quantity}, format='json')
+
+    def test_same_availability_through_slots(self):
+        stock.shard(self.tea, 4)
+        self.assertEqual(sorted(StockShard.objects.filter(tea=self.tea).values_list('quantity', flat=True)), [2, 2, 3, 3])
+        self.assertEqual(self.add(3).status_code, 201)
+        self.assertEqual(stock.available(Tea.objects.get(pk=self.tea.pk)), 7)
+        self.assertEqual(self.client.get(f'/api/teas/{self.tea.id}/').json()['quantity_in_stock'], 7)
+        self.assertEqual(stock.pending(self.tea), -3)
+        self.assertEqual(stock.slot_drift(Tea), [])
+
+    def test_takes_across_slots_and_refuses_past_total(self):
+        stock.shard(self.tea, 4)
+        # No single slot holds 5
+        self.assertEqual(self.add(5).status_code, 201)
+        response = self.add(6)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Available: 5', response.json()['error'])
+        self.assertEqual(self.add(5).status_code, 201)
+        self.assertEqual(stock.available(Tea.objects.get(pk=self.tea.pk)), 0)
+
+    def test_rebalance_repairs_drift_and_unshard_restores_single_row(self):
+        stock.shard(self.tea, 3)
+        self.add(2)
+        StockShard.objects.filter(tea=self.tea, slot=0).update(quantity=F('quantity') + 5)
+        self.assertEqual(len(stock.slot_drift(Tea)), 1)
+        call_command('compact_stock', stdout=io.StringIO())
+        self.assertEqual(stock.slot_drift(Tea), [])
+        self.assertEqual(stock.available(Tea.objects.get(pk=self.tea.pk)), 8)
+
+        stock.shard(self.tea, 0)
+        tea = Tea.objects.get(pk=self.tea.pk)
+        self.assertEqual((tea.stock_shards, tea.quantity_in_stock, stock.available(tea)), (0, 8, 8))
+        self.assertFalse(StockShard.objects.filter(tea=self.tea).exists())
+
+
+@override_settings(CATALOG_SYNC_SETTLE=0)
+class CatalogSyncTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def sync(self, since=None):
+        response = self.client.get('/api/catalog/sync/', {'since': since} if since is not None else {})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_cold_start_returns_everything(self):
+        data = self.sync().json()
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['teas']), Tea.objects.count())
+        self.assertEqual(len(data['memberships']), 3)
+        self.assertEqual(self.sync(since=10 ** 9).json()['full'], True)
+        self.assertEqual(self.client.get('/api/catalog/sync/?since=abc').status_code, 400)
+
+    def test_warm_start_only_sends_changes(self):
+        token = self.sync().json()['token']
+        unchanged = self.sync(token)
+        self.assertFalse(unchanged.json()['full'])
+        self.assertLess(len(unchanged.content), 400)
+
+        tea, ingredient = self.ctx['tea'], Ingredient.objects.get(pk=self.ctx['ingredient'].pk)
+        tea.price = 1234
+        tea.save()
+        teas_using = set(ingredient.tea_set.values_list('pk', flat=True))
+        ingredient_id = ingredient.pk
+        ingredient.delete()
+        data = self.sync(token).json()
+        # Teas embed their ingredients, so the ingredient's teas come too
+        self.assertEqual({t['id'] for t in data['teas']}, {tea.id} | teas_using)
+        self.assertEqual(data['deleted']['ingredients'], [ingredient_id])
+        self.assertEqual(self.sync(data['token']).json()['teas'], [])
+
+    def test_running_out_and_restocking_are_synced(self):
+        tea = self.ctx['tea']
+        token = self.sync().json()['token']
+        # A count that stays above zero is not pushed
+        stock.reserve(tea, 1)
+        data = self.sync(token).json()
+        self.assertEqual(data['teas'], [])
+        stock.adjust(tea, -stock.available(tea))
+        data = self.sync(data['token']).json()
+        self.assertEqual([t['quantity_in_stock'] for t in data['teas']], [0])
+        stock.restock(tea, 5)
+        self.assertEqual([t['quantity_in_stock'] for t in self.sync(data['token']).json()['teas']], [5])
+
+    @override_settings(CATALOG_SYNC_SETTLE=60)
+    def test_recent_changes_wait_to_settle(self):
+        CatalogChange.objects.update(created_at=timezone.now() - datetime.timedelta(minutes=5))
+        token = self.sync().json()['token']
+        self.ctx['tea'].save()
+        data = self.sync(token).json()
+        self.assertEqual((data['token'], data['teas']), (token, []))
+        self.assertTrue(CatalogChange.objects.filter(kind='tea', object_id=self.ctx['tea'].id).exists())
+
+
+class ResponseShapingTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.ctx['staff'])
+
+    def test_default_shape_is_fully_expanded(self):
+        order = self.client.get('/api/orders/').json()[0]
+        item = next(item for item in order['items'] if item['tea'])
+        self.assertIsInstance(item['tea'], dict)
+        self.assertIsInstance(item['tea']['ingredients'][0], dict)
+
+    def test_fields_prunes_nested_serializers(self):
+        teas = self.client.get('/api/teas/', {'fields': 'id,name,ingredients.name'}).json()
+        self.assertEqual(set(teas[0]), {'id', 'name', 'ingredients'})
+        self.assertEqual(set(teas[0]['ingredients'][0]), {'name'})
+
+    def test_unexpanded_relations_render_as_ids(self):
+        tea = self.client.get(f"/api/teas/{self.ctx['tea'].id}/", {'expand': ''}).json()
+        self.assertEqual(sorted(tea['ingredients']), sorted(self.ctx['tea'].ingredients.values_list('id', flat=True)))
+        order = self.client.get('/api/orders/', {'expand': 'items'}).json()[0]
+        self.assertIsInstance(order['items'][0], dict)
+        self.assertTrue(all(isinstance(item['tea'], (int, type(None))) for item in order['items']))
+
+    def test_shaped_queryset_loads_only_requested_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/orders/', {'fields': 'id,items.quantity,items.tea.name', 'expand': 'items.tea'})
+        tea_query = next(q['sql'] for q in queries.captured_queries if 'FROM "shop_tea"' in q['sql'])
+        self.assertNotIn('"shop_tea"."description"', tea_query)
+        self.assertLessEqual(len(queries), 4)
+
+    def test_available_stock_survives_shaping(self):
+        tea = self.ctx['tea']
+        stock.reserve(tea, 1, reference='test')
+        data = self.client.get(f'/api/teas/{tea.id}/', {'fields': 'quantity_in_stock'}).json()
+        self.assertEqual(data, {'quantity_in_stock': stock.available(tea)})
+
+    def test_writes_ignore_shape_parameters(self):
+        address = {'address_line1': '1 Tea Street', 'city': 'Lagos', 'state': 'Lagos', 'zip_code': '100001'}
+        response = self.client.post('/api/delivery-addresses/?fields=id', address, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['city'], 'Lagos')
+
+
+class RendererTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.ctx['staff'])
+
+    def test_fast_json_matches_drf_output(self):
+        response = self.client.get('/api/orders/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.content, JSONRenderer().render(response.data))
+
+    def test_indented_json_still_available(self):
+        response = self.client.get('/api/teas/', HTTP_ACCEPT='application/json; indent=2')
+        self.assertTrue(response.content.startswith(b'[\n  {'))
+
+    def test_invalid_json_body_is_rejected(self):
+        response = self.client.post('/api/cart/add/', b'{"tea_id":', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    @skipIf(renderers.msgpack is not None, 'msgpack is installed')
+    def test_msgpack_not_acceptable_without_library(self):
+        response = self.client.get('/api/teas/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 406)
+
+    @skipUnless(renderers.msgpack is not None, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        response = self.client.get('/api/teas/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(renderers.msgpack.unpackb(response.content), json.loads(self.client.get('/api/teas/').content))
+        body = renderers.msgpack.packb({'tea_id': self.ctx['tea'].id, 'quantity': 1})
+        response = self.client.post('/api/cart/add/', body, content_type='application/msgpack')
+        self.assertEqual(response.status_code, 201)
+
+
+class CompressionTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        cache.clear()
+        catalog_cache.l1.clear()
+        self.client.force_authenticate(self.ctx['staff'])
+
+    def test_negotiates_encoding_by_quality(self):
+        self.assertEqual(middleware.accepted_encoding('gzip, deflate'), 'gzip')
+        self.assertIsNone(middleware.accepted_encoding('identity'))
+        self.assertIsNone(middleware.accepted_encoding('gzip;q=0'))
+        if middleware.brotli is not None:
+            self.assertEqual(middleware.accepted_encoding('gzip, br'), 'br')
+            self.assertEqual(middleware.accepted_encoding('br;q=0.5, gzip'), 'gzip')
+            self.assertEqual(middleware.accepted_encoding('*'), 'br')
+
+    def test_gzip_response_decompresses_to_identity_body(self):
+        plain = self.client.get('/api/orders/')
+        response = self.client.get('/api/orders/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertLess(int(response['Content-Length']), len(plain.content) / 4)
+
+    @skipUnless(middleware.brotli is not None, 'brotli is not installed')
+    def test_brotli_preferred(self):
+        response = self.client.get('/api/orders/', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(middleware.brotli.decompress(response.content)),
+                         self.client.get('/api/orders/').json())
+
+    @override_settings(COMPRESSION_MIN_BYTES=10 ** 9)
+    def test_small_bodies_are_sent_as_is(self):
+        response = self.client.get('/api/orders/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_streaming_and_binary_bodies_are_skipped(self):
+        response = self.client.get('/api/orders/export/csv/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_cached_catalog_is_compressed_once(self):
+        with mock.patch.object(middleware, 'compress', wraps=middleware.compress) as compress:
+            first = self.client.get('/api/teas/', HTTP_ACCEPT_ENCODING='gzip')
+            second = self.client.get('/api/teas/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['Content-Encoding'], 'gzip')
+
+
+class CorsTests(TestCase):
+    origin = 'http://localhost:3000'
+
+    def preflight(self, origin=origin):
+        return self.client.options('/api/cart/add/', HTTP_ORIGIN=origin, HTTP_ACCESS_CONTROL_REQUEST_METHOD='POST',
+                                   HTTP_ACCESS_CONTROL_REQUEST_HEADERS='authorization, content-type')
+
+    def test_preflight_answered_before_the_view(self):
+        before = middleware.REQUESTS.value(method='OPTIONS', route='preflight', status=200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.preflight()
+        self.assertEqual((response.status_code, response.content, len(queries)), (200, b'', 0))
+        self.assertEqual(middleware.REQUESTS.value(method='OPTIONS', route='preflight', status=200), before + 1)
+        self.assertEqual(response['Access-Control-Allow-Origin'], self.origin)
+        self.assertEqual(response['Access-Control-Max-Age'], '86400')
+        self.assertIn('idempotency-key', response['Access-Control-Allow-Headers'])
+        self.assertEqual(response['Access-Control-Allow-Credentials'], 'true')
+
+    def test_origin_regexes_and_disallowed_origins(self):
+        self.assertEqual(self.preflight('http://127.0.0.1:5173')['Access-Control-Allow-Origin'], 'http://127.0.0.1:5173')
+        response = self.preflight('https://evil.example')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Access-Control-Allow-Origin'))
+
+    def test_simple_requests_get_origin_headers(self):
+        response = self.client.get('/api/memberships/', HTTP_ORIGIN=self.origin)
+        self.assertEqual(response['Access-Control-Allow-Origin'], self.origin)
+        self.assertIn('Origin', response['Vary'])
+        self.assertFalse(response.has_header('Access-Control-Max-Age'))
+
+    @override_settings(CORS_ALLOWED_ORIGINS=['https://shop.example'], CORS_ALLOWED_ORIGIN_REGEXES=[])
+    def test_policy_follows_settings_changes(self):
+        self.assertFalse(self.preflight().has_header('Access-Control-Allow-Origin'))
+        self.assertTrue(self.preflight('https://shop.example').has_header('Access-Control-Allow-Origin'))
+
+
+class SessionlessApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        self.auth = {'HTTP_AUTHORIZATION': f"Token {Token.objects.get_or_create(user=self.ctx['user'])[0].key}"}
+
+    def test_header_authenticated_api_requests_skip_sessions(self):
+        with mock.patch.object(SessionMiddleware, 'process_request', autospec=True,
+                               side_effect=SessionMiddleware.process_request) as process_request:
+            response = self.client.get('/api/cart/', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user'], self.ctx['user'].id)
+        process_request.assert_not_called()
+        self.assertEqual(response.cookies, {})
+
+    @override_settings(METRICS_TOKEN='scrape-me')
+    def test_plain_views_work_through_the_bypass(self):
+        staff_jwt = f"Bearer {jwt_auth.tokens_for(self.ctx['staff'])['access']}"
+        with mock.patch.object(CsrfViewMiddleware, 'process_view', autospec=True) as process_view:
+            for header in ('Bearer wrong', 'Token abc', staff_jwt):
+                with self.subTest(header=header[:12]):
+                    # The metrics view reads request.user, which the skipped middleware would set
+                    self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION=header).status_code, 403)
+            self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape-me').status_code, 200)
+        process_view.assert_not_called()
+
+    def test_browser_flows_keep_sessions(self):
+        with mock.patch.object(SessionMiddleware, 'process_request', autospec=True,
+                               side_effect=SessionMiddleware.process_request) as process_request:
+            self.client.get('/api/teas/')
+            self.assertEqual(process_request.call_count, 1)
+            self.client.force_login(self.ctx['staff'])
+            self.assertEqual(self.client.get('/admin/shop/order/').status_code, 200)
+        self.assertEqual(process_request.call_count, 2)
+
+
+class JwtClaimsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        jwt_auth.revocations.clear()
+        self.addCleanup(jwt_auth.revocations.clear)
+        self.tokens = jwt_auth.tokens_for(self.ctx['user'])
+        self.auth = {'HTTP_AUTHORIZATION': f"Bearer {self.tokens['access']}"}
+
+    def test_login_returns_tokens_with_claims(self):
+        response = self.client.post('/api/auth/login/', {'email': self.ctx['user'].email, 'password': factories.PASSWORD},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        access = AccessToken(response.json()['access'])
+        self.assertEqual(jwt_auth.token_user_id(access), self.ctx['user'].id)
+        self.assertEqual({claim: access[claim] for claim in jwt_auth.CLAIMS}, jwt_auth.claims_for(self.ctx['user']))
+
+    def test_reads_do_not_load_the_user(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/cart/', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user'], self.ctx['user'].id)
+        self.assertFalse([q for q in queries if 'FROM "auth_user"' in q['sql']])
+
+    def test_logout_revokes_access_and_refresh(self):
+        response = self.client.post('/api/auth/logout/', {'refresh': self.tokens['refresh']},
+                                    content_type='application/json', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/cart/', **self.auth).status_code, 401)
+        response = self.client.post('/api/token/refresh/', {'refresh': self.tokens['refresh']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_deactivation_revokes_every_token(self):
+        user = self.ctx['user']
+        user.is_active = False
+        user.save()
+        jwt_auth.revocations.clear()  # as another worker would see it after reloading
+        self.assertEqual(self.client.get('/api/cart/', **self.auth).status_code, 401)
+
+    def test_refresh_reads_current_claims(self):
+        User.objects.filter(pk=self.ctx['user'].pk).update(is_staff=True)
+        response = self.client.post('/api/token/refresh/', {'refresh': self.tokens['refresh']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(AccessToken(response.json()['access'])['staff'])
+
+
+@override_settings(REPLICA_DATABASES=['replica'])
+class ReplicaRoutingTests(TestCase):
+    # 'replica' is a second, empty test database: a read that finds nothing came from it
+    databases = {'default', 'replica'}
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_catalog_reads_go_to_a_replica(self):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.get(f"/api/teas/{self.ctx['tea'].id}/")
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(queries)
+        with override_settings(REPLICA_DATABASES=[]):
+            self.assertEqual(self.client.get(f"/api/teas/{self.ctx['tea'].id}/").status_code, 200)
+
+    def test_cached_catalog_lists_render_from_the_primary(self):
+        self.assertEqual(len(self.client.get('/api/teas/').json()), Tea.objects.count())
+
+    def test_staff_listings_read_from_a_replica_users_from_the_primary(self):
+        self.client.force_authenticate(self.ctx['staff'])
+        self.assertEqual(self.client.get('/api/orders/').json(), [])
+        self.client.force_authenticate(self.ctx['user'])
+        self.assertTrue(self.client.get('/api/orders/').json())
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        self.client.force_authenticate(self.ctx['staff'])
+        response = self.client.post('/api/cart/add/', {'tea_id': self.ctx['tea'].id, 'quantity': 1}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(replicas.is_pinned(self.ctx['staff'].pk))
+        self.assertTrue(self.client.get('/api/orders/').json())
+        self.assertFalse(replicas.is_pinned(self.ctx['user'].pk))
+
+    def test_routing_does_not_outlive_the_request(self):
+        self.client.get(f"/api/teas/{self.ctx['tea'].id}/")
+        self.assertEqual(Tea.objects.all().db, 'default')
+
+
+@override_settings(ADMISSION_RATE=1)
+class AdmissionControlTests(TestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        cache.clear()
+        admission.counters().clear()
+        self.now = 1000.0
+        patcher = mock.patch('shop.admission.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_to_cart(self, user, **headers):
+        self.client.force_authenticate(user)
+        return self.client.post('/api/cart/add/', {'tea_id': self.ctx['tea'].id, 'quantity': 1}, format='json',
+                                **headers)
+
+    def test_surge_waits_in_line_and_is_admitted_in_order(self):
+        self.assertEqual(self.add_to_cart(self.ctx['user']).status_code, 201)
+        queued = self.add_to_cart(self.ctx['staff'])
+        self.assertEqual(queued.status_code, 503)
+        self.assertEqual(queued['Retry-After'], '1')
+        ticket = queued.json()['ticket']
+        self.assertEqual(queued.json()['position'], 1)
+
+        status = self.client.get('/api/checkout/queue/', {'ticket': ticket}).json()
+        self.assertEqual((status['admitted'], status['queue_length']), (False, 1))
+        self.assertEqual(self.add_to_cart(self.ctx['staff'], HTTP_X_QUEUE_TICKET=ticket).status_code, 503)
+
+        self.now += 1
+        self.assertTrue(self.client.get('/api/checkout/queue/', {'ticket': ticket}).json()['admitted'])
+        self.assertEqual(self.add_to_cart(self.ctx['staff'], HTTP_X_QUEUE_TICKET=ticket).status_code, 201)
+
+    def test_admission_pass_covers_later_checkout_calls(self):
+        self.assertEqual(self.add_to_cart(self.ctx['user']).status_code, 201)
+        self.assertEqual(self.add_to_cart(self.ctx['user']).status_code, 201)
+
+    def test_tickets_are_signed_and_bound_to_their_user(self):
+        self.add_to_cart(self.ctx['user'])
+        ticket = self.add_to_cart(self.ctx['staff']).json()['ticket']
+        self.assertEqual(self.client.get('/api/checkout/queue/', {'ticket': ticket + 'x'}).status_code, 400)
+        self.now += 1
+        other = User.objects.create_user('latecomer', email='late@example.com', password='x')
+        response = self.add_to_cart(other, HTTP_X_QUEUE_TICKET=ticket)
+        self.assertEqual(response.status_code, 503)
+        self.assertNotEqual(response.json()['ticket'], ticket)
+
+    def test_queue_counters_survive_the_shared_cache_and_resync(self):
+        self.add_to_cart(self.ctx['user'])
+        self.assertEqual(self.add_to_cart(self.ctx['staff']).json()['position'], 1)
+        # Culling or clearing the shared cache must not reopen the line to newcomers
+        cache.clear()
+        self.assertEqual(admission.queue_state(), (1, 0))
+        late = User.objects.create_user('latecomer', email='late@example.com', password='x')
+        self.assertEqual(self.add_to_cart(late).status_code, 503)
+
+        admission.counters().delete(admission.NEXT_KEY)
+        self.assertEqual(admission.queue_state(), (0, 0))
+        self.now += 1
+        self.assertEqual(self.add_to_cart(late).status_code, 201)
+
+
+class PaymentReconciliationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.ctx = factories.seed('small')
+
+    def setUp(self):
+        self.stub = PaystackStub(port=0)
+        self.stub.__enter__()
+        self.addCleanup(self.stub.__exit__)
+        port = self.stub.server.server_address[1]
+        override = override_settings(PAYSTACK_API_BASE=f'http://127.0.0.1:{port}')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.hour_ago = timezone.now() - datetime.timedelta(hours=1)
+
+    def intent(self, reference, kind, metadata, items=(), **charge):
+        PaymentIntent.objects.create(reference=reference, user=self.ctx['user'], kind=kind, amount=5000,
+                                     items=list(items), created_at=self.hour_ago)
+        self.stub.transactions[reference] = {'amount': 500000, 'metadata': metadata, **charge}
+
+    def reconcile(self, *references):
+        # Leave the seeded pending orders alone
+        stale = {ref: rows for ref, rows in reconciliation.stale_references().items() if ref in references}
+        return reconciliation.reconcile(stale, batch_size=2, rate=100)
+
+    def test_lost_webhooks_become_orders_and_subscriptions_once(self):
+        user = self.ctx['user']
+        user.shop_cart.items.all().delete()
+        CartItem.objects.create(cart=user.shop_cart, tea=self.ctx['tea'], quantity=2)
+        self.intent('ORDER-LOST', 'order', {'type': 'order', 'user_id': user.id, 'order_data': {
+            'delivery_type': 'pickup', 'pickup_id': self.ctx['pickup'].id, 'total_price': 5000}})
+        self.intent('MEMBERSHIP-LOST', 'membership',
+                    {'type': 'membership', 'user_id': user.id, 'membership_id': self.ctx['membership'].id})
+
+        report = self.reconcile('ORDER-LOST', 'MEMBERSHIP-LOST')
+        self.assertEqual(report['outcomes'], {'success': 2})
+        self.assertEqual(report['updates'], {'fulfilled': 2})
+        order = Order.objects.get(payment_reference='ORDER-LOST')
+        self.assertEqual((order.payment_status, order.items.get().quantity), ('paid', 2))
+        self.assertFalse(user.shop_cart.items.exists())
+        self.assertEqual(Subscription.objects.get(payment_reference='MEMBERSHIP-LOST').status, 'active')
+        self.assertEqual(set(PaymentIntent.objects.values_list('status', flat=True)), {'fulfilled'})
+
+        # A late webhook or client verification finds the order already there
+        self.assertFalse(fulfillment.create_order(user, 'ORDER-LOST', {})[1])
+        self.assertEqual(self.reconcile('ORDER-LOST', 'MEMBERSHIP-LOST')['references'], 0)
+
+    def test_orders_are_built_from_the_cart_that_was_paid_for(self):
+        user, tea, ingredient = self.ctx['user'], self.ctx['tea'], self.ctx['ingredient']
+        user.shop_cart.items.all().delete()
+        # Paid for three teas, then edited the cart before the payment was confirmed
+        self.intent('ORDER-EDITED', 'order', {'type': 'order', 'order_data': {'total_price': 1}},
+                    items=[{'tea': tea.id, 'ingredient': None, 'quantity': 3}])
+        CartItem.objects.create(cart=user.shop_cart, tea=tea, quantity=1)
+        CartItem.objects.create(cart=user.shop_cart, ingredient=ingredient, quantity=2)
+        stock.reserve(tea, 1)
+        available = stock.available(Tea.objects.get(pk=tea.pk))
+
+        self.assertEqual(self.reconcile('ORDER-EDITED')['updates'], {'fulfilled': 1})
+        order = Order.objects.get(payment_reference='ORDER-EDITED')
+        self.assertEqual(order.total_price, 5000)
+        self.assertEqual(list(order.items.values_list('tea', 'quantity')), [(tea.id, 3)])
+        # The reserved tea became a sale, the rest was sold outright; the ingredient stays in the cart
+        self.assertEqual(stock.available(Tea.objects.get(pk=tea.pk)), available - 2)
+        self.assertEqual(list(user.shop_cart.items.values_list('ingredient', 'quantity')), [(ingredient.id, 2)])
+
+    def test_paid_orders_beyond_stock_are_backordered(self):
+        user = self.ctx['user']
+        user.shop_cart.items.all().delete()
+        tea, ingredient = Tea.objects.get(pk=self.ctx['tea'].pk), Ingredient.objects.get(pk=self.ctx['ingredient'].pk)
+        stock.shard(ingredient, 4)
+        ingredient.refresh_from_db()
+        tea_stock, ingredient_stock = stock.available(tea), stock.available(ingredient)
+        self.intent('ORDER-OVERSOLD', 'order', {'type': 'order', 'order_data': {}}, items=[
+            {'tea': tea.id, 'ingredient': None, 'quantity': tea_stock + 3},
+            {'tea': None, 'ingredient': ingredient.id, 'quantity': ingredient_stock + 2},
+        ])
+
+        order, created = fulfillment.create_order(user, 'ORDER-OVERSOLD', {}, strict=False)
+        self.assertTrue(created)
+        self.assertTrue(order.backordered)
+        self.assertEqual(sorted(order.items.values_list('quantity', 'backordered')),
+                         sorted([(tea_stock + 3, 3), (ingredient_stock + 2, 2)]))
+        self.assertEqual((stock.available(tea), stock.available(ingredient)), (0, 0))
+        # Compaction can still fold every movement
+        stock.compact()
+        self.assertEqual(stock.reconcile(Tea), [])
+        self.assertEqual(stock.slot_drift(Ingredient), [])
+
+    def test_refused_verify_calls_leave_payments_alone(self):
+        expired = Payment.objects.create(subscription=self.ctx['subscription'], amount=5000,
+                                         payment_method='paystack', transaction_ref='TXN-BAD-KEY')
+        Payment.objects.filter(pk=expired.pk).update(created_at=timezone.now() - datetime.timedelta(days=2))
+        refused = fake_response(401, {'status': False, 'message': 'Invalid key'})
+        with mock.patch('shop.reconciliation.requests.get', return_value=refused):
+            self.assertEqual(reconciliation.verify('TXN-BAD-KEY')[0], 'error')
+            self.assertEqual(self.reconcile('TXN-BAD-KEY')['outcomes'], {'error': 1})
+        self.assertEqual(Payment.objects.get(pk=expired.pk).status, 'pending')
+
+    def test_failed_unknown_and_unfulfillable_payments(self):
+        self.intent('ORDER-ABANDONED', 'order', {'type': 'order', 'user_id': self.ctx['user'].id},
+                    stub_status='abandoned')
+        self.intent('ORDER-EMPTY-CART', 'order', {'type': 'order', 'user_id': self.ctx['user'].id, 'order_data': {}})
+        self.ctx['user'].shop_cart.items.all().delete()
+        subscription = self.ctx['subscription']
+        recent = Payment.objects.create(subscription=subscription, amount=5000, payment_method='paystack',
+                                        transaction_ref='TXN-RECENT')
+        expired = Payment.objects.create(subscription=subscription, amount=5000, payment_method='paystack',
+                                         transaction_ref='TXN-EXPIRED')
+        Payment.objects.filter(pk=recent.pk).update(created_at=self.hour_ago)
+        Payment.objects.filter(pk=expired.pk).update(created_at=timezone.now() - datetime.timedelta(days=2))
+
+        report = self.reconcile('ORDER-ABANDONED', 'ORDER-EMPTY-CART', 'TXN-RECENT', 'TXN-EXPIRED')
+        self.assertEqual(report['outcomes'], {'failed': 1, 'success': 1, 'missing': 2})
+        self.assertEqual(PaymentIntent.objects.get(reference='ORDER-ABANDONED').status, 'failed')
+        self.assertEqual(PaymentIntent.objects.get(reference='ORDER-EMPTY-CART').status, 'review')
+        self.assertEqual(Payment.objects.get(pk=recent.pk).status, 'pending')
+        self.assertEqual(Payment.objects.get(pk=expired.pk).status, 'failed')
+
+    def test_command_reports_counts_and_latency(self):
+        self.intent('ORDER-ABANDONED', 'order', {'type': 'order'}, stub_status='abandoned')
+        seeded = len(reconciliation.stale_references()) - 1  # the stub has never seen these
+        out = io.StringIO()
+        call_command('reconcile_payments', '--json', '--dry-run', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual((report['references'], report['outcomes'], report['updates']),
+                         (seeded + 1, {'failed': 1, 'missing': seeded}, {}))
+        self.assertIsNotNone(report['verify_p95_ms'])
+        self.assertEqual(PaymentIntent.objects.get(reference='ORDER-ABANDONED').status, 'pending')
+
+    def test_rate_limiter_spaces_out_calls(self):
+        clock = [0.0]
+        limiter = reconciliation.RateLimiter(2, clock=lambda: clock[0],
+                                             sleep=lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+        for _ in range(6):
+            limiter.wait()
+        # Two calls of burst, then one every half second
+        self.assertAlmostEqual(clock[0], 2.0)
@@ -0,0 +1,147 @@
+"""Token-bucket request throttling.
+
+Every client gets one bucket per scope. The client is the user id when
+authenticated, otherwise the IP address. A bucket holds up to N tokens
+and refills at N per period, with rates written like DRF's
+DEFAULT_THROTTLE_RATES (``'20/min'``). Each request spends tokens by route.
+Most requests cost 1. Calls that hit Paystack or hash passwords cost more,
+so clients running up cheap calls cannot starve checkout.
+
+Anonymous clients are keyed on REMOTE_ADDR, or on X-Forwarded-For only as
+far back as REST_FRAMEWORK['NUM_PROXIES'] trusted proxies reach, so a
+client cannot pick a fresh bucket by sending its own header.
+
+Buckets live in the default Django cache so all workers share them. Run it
+on Redis in production: every request writes its bucket, and the file
+cache culls a random third of its entries once full, which refills the
+buckets it drops. If the cache is unreachable, the throttle falls back to
+per-process buckets instead of failing requests. The cache has no
+compare-and-set, so concurrent requests for one bucket can over-admit
+slightly. That is acceptable for abuse protection.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# url_name or (url_name, method) -> (scope, cost); the method-specific entry wins.
+# Unlisted routes use the 'user' or 'anon' scope at cost 1.
+DEFAULT_ROUTE_COSTS = {
+    'login': ('login', 1),
+    'register': ('login', 3),
+    # djoser registration; listing users and /me are ordinary reads
+    ('user-list', 'POST'): ('login', 3),
+    'jwt-create': ('login', 1),
+    'token_obtain_pair': ('login', 1),
+    'google_oauth_login': ('login', 1),
+    'google_oauth_callback': ('login', 2),
+    'place_order': ('checkout', 2),
+    'initiate_payment': ('checkout', 5),
+    'verify_payment': ('checkout', 3),
+    'initiate_membership_payment': ('checkout', 5),
+    'verify_membership_payment': ('checkout', 3),
+    'export_orders': ('user', 20),
+    # Paystack retries webhooks itself; never turn them away
+    'paystack_webhook': (None, 0),
+}
+
+DECISIONS = metrics.counter('throttle_decisions_total', 'Throttle decisions by scope', ['scope', 'decision'])
+FALLBACKS = metrics.counter('throttle_backend_fallbacks_total', 'Throttle checks served by in-process buckets')
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'20/min' -> (capacity 20, refill 20/60 tokens per second)"""
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period[0]]
+
+
+def take(state, now, capacity, refill, cost):
+    """Refill a (tokens, updated_at) bucket and try to spend cost.
+
+    Returns (allowed, new state, seconds until cost tokens are available).
+    """
+    tokens, updated_at = state if state else (capacity, now)
+    tokens = min(capacity, tokens + (now - updated_at) * refill)
+    if tokens >= cost:
+        return True, (tokens - cost, now), 0.0
+    return False, (tokens, now), (cost - tokens) / refill
+
+
+class LocalBuckets:
+    """In-process bucket store used when the shared cache is down"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def consume(self, key, now, capacity, refill, cost):
+        with self._lock:
+            allowed, state, wait = take(self._buckets.get(key), now, capacity, refill, cost)
+            self._buckets[key] = state
+        return allowed, wait
+
+
+local_buckets = LocalBuckets()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    cache = cache
+    timer = time.time
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def route_cost(self, request, view):
+        match = getattr(request, 'resolver_match', None)
+        routes = getattr(settings, 'THROTTLE_ROUTE_COSTS', DEFAULT_ROUTE_COSTS)
+        default_scope = 'user' if request.user and request.user.is_authenticated else 'anon'
+        if match:
+            for key in ((match.url_name, request.method), match.url_name):
+                if key in routes:
+                    return routes[key]
+        return default_scope, getattr(view, 'throttle_cost', 1)
+
+    def allow_request(self, request, view):
+        if not getattr(settings, 'THROTTLE_ENABLED', True):
+            return True
+        scope, cost = self.route_cost(request, view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope) if scope else None
+        if not rate or cost <= 0:
+            return True
+
+        capacity, refill = parse_rate(rate)
+        if request.user and request.user.is_authenticated:
+            ident = f'user:{request.user.pk}'
+        else:
+            ident = f'ip:{self.get_ident(request)}'
+        key = f'throttle:{scope}:{ident}'
+
+        allowed, self.wait_seconds = self.consume(key, capacity, refill, cost)
+        DECISIONS.inc(scope=scope, decision='allowed' if allowed else 'throttled')
+        return allowed
+
+    def consume(self, key, capacity, refill, cost):
+        now = self.timer()
+        try:
+            allowed, state, wait = take(self.cache.get(key), now, capacity, refill, cost)
+            # Keep the entry until the bucket would be full again anyway
+            self.cache.set(key, state, timeout=int(capacity / refill) + 1)
+        except Exception:
+            logger.warning('Throttle cache unavailable; using in-process buckets', exc_info=True)
+            FALLBACKS.inc()
+            allowed, wait = local_buckets.consume(key, now, capacity, refill, cost)
+        return allowed, wait
+
+    def wait(self):
+        return self.wait_seconds
@@ -4,6 +4,11 @@ from . import views
 from . import oauth_views
 from . import cart_views
 from . import payment_views
+from . import metrics_views
+from . import export_views
+from . import analytics_views
+from . import sync_views
+from . import admission_views
 
 router = DefaultRouter()
 router.register(r'teas', views.TeaViewSet)
@@ -35,10 +40,16 @@ urlpatterns = [
     path('cart/remove/', cart_views.remove_from_cart, name='remove_from_cart'),
     path('cart/clear/', cart_views.clear_cart, name='clear_cart'),
     path('checkout/place-order/', cart_views.place_order, name='place_order'),
+    path('checkout/queue/', admission_views.queue_status, name='checkout_queue'),
     path('payment/initiate/', payment_views.initiate_payment, name='initiate_payment'),
     path('payment/verify/', payment_views.verify_payment, name='verify_payment'),
     path('payment/webhook/', payment_views.paystack_webhook, name='paystack_webhook'),
     path('payment/membership/initiate/', payment_views.initiate_membership_payment, name='initiate_membership_payment'),
     path('payment/membership/verify/', payment_views.verify_membership_payment, name='verify_membership_payment'),
+    path('orders/export/<str:fmt>/', export_views.export_orders, name='export_orders'),
+    path('analytics/<str:dimension>/', analytics_views.sales_report, name='sales_report'),
+    path('catalog/sync/', sync_views.catalog_sync_feed, name='catalog_sync'),
     path('delivery-addresses/', views.DeliveryAddressViewSet.as_view({'get': 'list', 'post': 'create'}), name='delivery_addresses'),
+    # Monitoring
+    path('metrics/', metrics_views.metrics_endpoint, name='metrics'),
 ]
@@ -3,31 +3,82 @@ from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.authtoken.models import Token
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import RefreshToken, Token as JSONWebToken
 from django.contrib.auth.models import User
-from django.contrib.auth import authenticate
+from django.contrib.auth.signals import user_logged_in
 from django.utils import timezone
 from datetime import timedelta
 
 from .models import Tea, Ingredient, Cart, Order, Membership, PickupLocation, IngredientCategory, Subscription, Payment, Profile
 from .models import DeliveryAddress
+from . import jwt_auth, replicas, shaping, stock
+from .auth import authenticate_email
+from .cache import catalog_cache
 from .serializers import TeaSerializer, IngredientSerializer, CartSerializer, OrderSerializer, MembershipSerializer, CustomUserSerializer, CustomUserCreateSerializer, PickupLocationSerializer, DeliveryAddressSerializer, IngredientCategorySerializer, SubscriptionSerializer, PaymentSerializer, ProfileSerializer, UserDetailedSerializer
 
-class TeaViewSet(viewsets.ModelViewSet):
-    queryset = Tea.objects.all()
+class CachedListMixin:
+    """Serve list responses from the catalog cache; signals bump it on every change"""
+
+    def list(self, request, *args, **kwargs):
+        def render():
+            # A lagging replica would be cached as the current version
+            with replicas.primary():
+                return list(super(CachedListMixin, self).list(request, *args, **kwargs).data)
+
+        # Key on the absolute URL: image URLs in the payload include scheme and host
+        response = Response(catalog_cache.get_or_set(request.build_absolute_uri(), render))
+        # Same bytes until the catalog changes: CompressionMiddleware compresses them once
+        response.cache_compressed = True
+        return response
+
+
+class ShapedQuerysetMixin:
+    """Load only the columns and relations the ?fields=/?expand= shape renders (see shaping.py)"""
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method in shaping.SAFE_METHODS and self.action in ('list', 'retrieve'):
+            queryset = shaping.shape_queryset(queryset, self.get_serializer())
+        return queryset
+
+
+class ReplicaReadMixin:
+    """Serve safe requests from a read replica once DRF has authenticated the user (see replicas.py)"""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.reads_from_replica():
+            replicas.use_replica(request)
+
+    def reads_from_replica(self):
+        return True
+
+
+class StaffListReplicaMixin(ReplicaReadMixin):
+    """Only staff listings go to a replica; users read their own rows from the primary"""
+
+    def reads_from_replica(self):
+        user = self.request.user
+        return self.action == 'list' and (user.is_staff or user.is_superuser)
+
+
+class TeaViewSet(ReplicaReadMixin, CachedListMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
+    queryset = stock.with_available_stock(Tea.objects.all())
     serializer_class = TeaSerializer
     permission_classes = [AllowAny]
 
-class IngredientViewSet(viewsets.ModelViewSet):
-    queryset = Ingredient.objects.all()
+class IngredientViewSet(ReplicaReadMixin, CachedListMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
+    queryset = stock.with_available_stock(Ingredient.objects.all())
     serializer_class = IngredientSerializer
     permission_classes = [AllowAny]
 
-class CartViewSet(viewsets.ModelViewSet):
+class CartViewSet(ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = Cart.objects.all()
     serializer_class = CartSerializer
     permission_classes = [IsAuthenticated]
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(StaffListReplicaMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
@@ -42,13 +93,13 @@ class OrderViewSet(viewsets.ModelViewSet):
             return Order.objects.all()
         return Order.objects.filter(user=user)
 
-class MembershipViewSet(viewsets.ModelViewSet):
+class MembershipViewSet(ReplicaReadMixin, CachedListMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = Membership.objects.all()
     serializer_class = MembershipSerializer
     permission_classes = [AllowAny]  # Anyone can view membership tiers
 
 
-class SubscriptionViewSet(viewsets.ModelViewSet):
+class SubscriptionViewSet(StaffListReplicaMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     serializer_class = SubscriptionSerializer
     permission_classes = [IsAuthenticated]
 
@@ -112,7 +163,7 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
         return Response({'status': 'Subscription resumed'}, status=status.HTTP_200_OK)
 
 
-class PaymentViewSet(viewsets.ModelViewSet):
+class PaymentViewSet(ShapedQuerysetMixin, viewsets.ModelViewSet):
     serializer_class = PaymentSerializer
     permission_classes = [IsAuthenticated]
 
@@ -149,7 +200,7 @@ class PaymentViewSet(viewsets.ModelViewSet):
         )
 
 
-class ProfileViewSet(viewsets.ModelViewSet):
+class ProfileViewSet(ShapedQuerysetMixin, viewsets.ModelViewSet):
     serializer_class = ProfileSerializer
     permission_classes = [IsAuthenticated]
 
@@ -167,19 +218,19 @@ class ProfileViewSet(viewsets.ModelViewSet):
         return Response(ProfileSerializer(profile).data)
 
 
-class PickupLocationViewSet(viewsets.ModelViewSet):
+class PickupLocationViewSet(ReplicaReadMixin, CachedListMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = PickupLocation.objects.all()
     serializer_class = PickupLocationSerializer
     permission_classes = [AllowAny]
 
 
-class IngredientCategoryViewSet(viewsets.ModelViewSet):
+class IngredientCategoryViewSet(ReplicaReadMixin, CachedListMixin, ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = IngredientCategory.objects.all()
     serializer_class = IngredientCategorySerializer
     permission_classes = [AllowAny]
 
 
-class DeliveryAddressViewSet(viewsets.ModelViewSet):
+class DeliveryAddressViewSet(ShapedQuerysetMixin, viewsets.ModelViewSet):
     queryset = DeliveryAddress.objects.all()
     serializer_class = DeliveryAddressSerializer
     permission_classes = [IsAuthenticated]
@@ -204,6 +255,7 @@ def register(request):
         return Response({
             'user': CustomUserSerializer(user).data,
             'token': token.key,
+            **jwt_auth.tokens_for(user),
             'message': 'User registered successfully'
         }, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -222,26 +274,23 @@ def login(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    try:
-        user_obj = User.objects.get(email=email)
-        username = user_obj.username
-    except User.DoesNotExist:
-        return Response(
-            {'error': 'Invalid credentials'},
-            status=status.HTTP_401_UNAUTHORIZED
-        )
-
-    user = authenticate(username=username, password=password)
+    user = authenticate_email(email, password, request=request)
     if user is None:
         return Response(
             {'error': 'Invalid credentials'},
             status=status.HTTP_401_UNAUTHORIZED
         )
     
-    token, created = Token.objects.get_or_create(user=user)
+    # Sets last_login and lets audit receivers see the login
+    user_logged_in.send(sender=user.__class__, request=request, user=user)
+    try:
+        token = user.auth_token
+    except Token.DoesNotExist:
+        token = Token.objects.create(user=user)
     return Response({
         'user': CustomUserSerializer(user).data,
-        'token': token.key
+        'token': token.key,
+        **jwt_auth.tokens_for(user),
     }, status=status.HTTP_200_OK)
 
 
@@ -263,6 +312,15 @@ def user_profile(request):
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def logout(request):
-    """Logout user (delete token)"""
-    request.user.auth_token.delete()
+    """Logout user: delete the DRF token and revoke the JWTs sent with the request"""
+    Token.objects.filter(user_id=request.user.id).delete()
+    if isinstance(request.auth, JSONWebToken):
+        jwt_auth.revoke(request.auth)
+    if request.data.get('refresh'):
+        try:
+            refresh = RefreshToken(request.data['refresh'])
+        except TokenError:
+            return Response({'error': 'Invalid refresh token'}, status=status.HTTP_400_BAD_REQUEST)
+        if jwt_auth.token_user_id(refresh) == request.user.id:
+            jwt_auth.revoke(refresh)
     return Response({'message': 'Logged out successfully'}, status=status.HTTP_200_OK)